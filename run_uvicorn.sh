@@ -0,0 +1,5 @@
+#!/bin/bash
+# Xiang Wang(ramwin@qq.com)
+
+# 异步视图需要ASGI才能不阻塞worker, 见 school/async_views.py
+uvicorn schoolproject.asgi:application --workers 4 --host 0.0.0.0 --port 8001 --no-access-log
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class SchoolConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'school'
+
+    def ready(self):
+        from school import taskstats  # pylint: disable=import-outside-toplevel
+        taskstats.connect()
+        from school import requeststats  # pylint: disable=import-outside-toplevel
+        requeststats.connect()
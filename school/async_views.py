@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+只读的异步视图, 在ASGI下运行时等待数据库和redis不会占住worker
+
+    GET /api/async/students/<pk>/?fields=id,name  先查redis缓存(Student.cached.aget)
+    GET /api/async/students/?after=<pk>&size=20&fields=id,name  按主键翻页
+    GET /api/async/students/<pk>/exams/  学生的考试和总分
+    GET /api/async/exams/<pk>/
+
+redis用 redis.asyncio, 是真正异步的
+ORM的异步方法是在一个线程里依次执行同步查询, 同一个进程里的查询不会并发, 但不会阻塞事件循环
+WSGI下也能用, 每个请求会起一个事件循环, 比同步视图慢
+"""
+
+
+import logging
+from typing import List, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Sum
+from django.http import HttpRequest, JsonResponse
+
+from school.models import Exam, Student
+from school.serializers import CompiledSerializer, StudentSerializer
+
+
+LOGGER = logging.getLogger(__name__)
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class BadRequest(Exception):
+    pass
+
+
+def json_response(data, status: int = 200) -> JsonResponse:
+    return JsonResponse(data, status=status, encoder=DjangoJSONEncoder, safe=False)
+
+
+def get_fields(request: HttpRequest) -> Optional[List[str]]:
+    value = request.GET.get("fields")
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    unknown = set(fields) - set(StudentSerializer.Meta.fields)
+    if unknown:
+        raise BadRequest({"fields": f"不支持的字段: {', '.join(sorted(unknown))}"})
+    return fields
+
+
+def get_int(request: HttpRequest, name: str, default: int) -> int:
+    try:
+        return int(request.GET.get(name, default))
+    except ValueError as error:
+        raise BadRequest({name: "需要是整数"}) from error
+
+
+async def student_detail(request: HttpRequest, pk: int) -> JsonResponse:
+    try:
+        fields = get_fields(request)
+    except BadRequest as error:
+        return json_response(error.args[0], status=400)
+    try:
+        student = await Student.cached.aget(pk=pk)
+    except Student.DoesNotExist:
+        return json_response({"detail": "学生不存在"}, status=404)
+    return json_response(StudentSerializer(student, fields=fields).data)
+
+
+async def student_list(request: HttpRequest) -> JsonResponse:
+    try:
+        fields = get_fields(request)
+        after = get_int(request, "after", 0)
+        size = min(max(get_int(request, "size", PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    except BadRequest as error:
+        return json_response(error.args[0], status=400)
+    compiled = CompiledSerializer(StudentSerializer, fields=fields)
+    # 下一页从最后一个主键开始, 所以主键一定要查出来
+    index = compiled.add_lookup("id")
+    queryset = Student.objects.filter(pk__gt=after).order_by("pk").values_list(*compiled.lookups)[:size]
+    rows = [row async for row in queryset]
+    return json_response({
+        "next": rows[-1][index] if len(rows) == size else None,
+        "results": [compiled.to_representation(row) for row in rows],
+    })
+
+
+async def student_exams(request: HttpRequest, pk: int) -> JsonResponse:
+    queryset = Exam.objects.filter(student_id=pk)
+    summary = await queryset.aaggregate(count=Count("id"), total=Sum("score"))
+    exams = [exam async for exam in queryset.order_by("pk").values("id", "score")]
+    return json_response({"student": pk, **summary, "exams": exams})
+
+
+async def exam_detail(request: HttpRequest, pk: int) -> JsonResponse:
+    try:
+        exam = await Exam.objects.aget(pk=pk)
+    except Exam.DoesNotExist:
+        return json_response({"detail": "考试不存在"}, status=404)
+    return json_response({"id": exam.pk, "student": exam.student_id, "score": exam.score})
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+按场景跑ORM和缓存的性能测试, 命令行见 school/management/commands/bench.py
+
+每个场景是一个 Scenario 子类, 用 @register 注册
+    setup(): 准备数据, 不计时, 数据不够就 raise Skip
+    run(): 计时的一次操作, 处理 size 行
+    writes = True 的场景整个在事务里执行, 每次run都回滚到savepoint, 不改数据
+        on_commit 的回调(m2m_changed的批量处理)不会执行
+        redis不会跟着回滚, 所以缓存失效和布隆过滤器的写入换成空操作, 不影响线上的缓存
+
+结果:
+    {"meta": {...}, "results": {场景名: {"p50": 秒, "p95", "p99", "mean", "min", "max", "rows_per_sec", ...}}}
+compare 按p50比较, 慢了 threshold 以上算退化
+"""
+
+
+import contextlib
+import datetime
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Type
+
+import django
+from django.db import connection, transaction
+from django.db.models.functions import Lower
+
+from school.bloom import STUDENT_CODES
+from school.models import Klass, Student, managers
+from school.serializers import CompiledSerializer, StudentSerializer
+
+
+LOGGER = logging.getLogger(__name__)
+BASE_DIR = Path(__file__).resolve().parent.parent
+SCENARIOS: Dict[str, Type["Scenario"]] = {}
+THRESHOLD = 0.2
+
+
+class Skip(Exception):
+    """数据不够, 跳过这个场景"""
+
+
+class Rollback(Exception):
+    pass
+
+
+def register(cls: Type["Scenario"]) -> Type["Scenario"]:
+    SCENARIOS[cls.name] = cls
+    return cls
+
+
+def sample_pks(size: int) -> List[int]:
+    """从随机位置开始取连续的一段, 不用 order_by("?") 扫全表"""
+    bounds = Student.objects.order_by("pk").values_list("pk", flat=True)
+    first, last = bounds.first(), bounds.last()
+    if first is None or last is None:
+        return []
+    start = random.randint(first, max(first, last - size * 2))
+    return list(bounds.filter(pk__gte=start)[:size]) or [first]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """values 需要先排好序"""
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Scenario:
+    name = ""
+    description = ""
+    # 一次run处理多少行
+    size = 1
+    repeat = 1000
+    warmup = 100
+    writes = False
+
+    def setup(self) -> None:
+        pass
+
+    def run(self) -> None:
+        raise NotImplementedError
+
+    def teardown(self) -> None:
+        pass
+
+
+class SampleMixin:
+    sample_size = 1000
+
+    def setup(self) -> None:
+        self.pks = sample_pks(self.sample_size)
+        if not self.pks:
+            raise Skip("没有学生, 先执行 create_lots_of_students")
+
+
+@register
+class PkGet(SampleMixin, Scenario):
+    name = "pk_get"
+    description = "Student.objects.get(pk=)"
+
+    def run(self) -> None:
+        Student.objects.get(pk=random.choice(self.pks))
+
+
+@register
+class CodeGet(Scenario):
+    name = "code_iget"
+    description = "按code不区分大小写查一个学生, 走 lower(code) 唯一索引"
+
+    def setup(self) -> None:
+        codes = list(
+            Student.objects.filter(pk__in=sample_pks(1000)).exclude(code=None).values_list("code", flat=True)
+        )
+        if not codes:
+            raise Skip("学生没有code, 先执行 runscript code的性能测试 --script-args prepare")
+        self.codes = [code.swapcase() for code in codes if code]
+
+    def run(self) -> None:
+        Student.objects.annotate(code_lower=Lower("code")).get(code_lower=random.choice(self.codes).lower())
+
+
+@register
+class BulkCreate(Scenario):
+    name = "bulk_create"
+    description = "bulk_create 1000个学生"
+    size = 1000
+    repeat = 20
+    warmup = 2
+    writes = True
+
+    def run(self) -> None:
+        Student.objects.bulk_create([
+            Student(name=f"bench{index}", age=index % 20, info={"grade": index % 12})
+            for index in range(self.size)
+        ])
+
+
+@register
+class BulkUpdate(Scenario):
+    name = "bulk_update"
+    description = "bulk_update 1000个学生的age"
+    size = 1000
+    repeat = 20
+    warmup = 2
+    writes = True
+
+    def setup(self) -> None:
+        self.students = list(Student.objects.filter(pk__in=sample_pks(self.size)))
+        if not self.students:
+            raise Skip("没有学生, 先执行 create_lots_of_students")
+
+    def run(self) -> None:
+        for student in self.students:
+            student.age += 1
+        Student.objects.bulk_update(self.students, ["age"])
+
+
+@register
+class M2MEnroll(Scenario):
+    name = "m2m_enroll"
+    description = "一个班级 students.add 100个学生, 包括m2m_changed的记录"
+    size = 100
+    repeat = 50
+    warmup = 5
+    writes = True
+
+    def setup(self) -> None:
+        klass = Klass.objects.order_by("pk").first()
+        self.pks = sample_pks(self.size * 10)
+        if klass is None or not self.pks:
+            raise Skip("没有班级或者学生")
+        self.klass = klass
+
+    def run(self) -> None:
+        self.klass.students.add(*random.sample(self.pks, min(self.size, len(self.pks))))
+
+
+@register
+class InfoGrade(Scenario):
+    name = "info_grade"
+    description = "info_key_eq('grade', ) 取100个, 走表达式索引"
+    size = 100
+    repeat = 200
+    warmup = 20
+
+    def run(self) -> None:
+        list(Student.objects.info_key_eq("grade", random.randint(1, 12))[:self.size])
+
+
+@register
+class InfoContains(Scenario):
+    name = "info_contains"
+    description = "info_contains({'room': }) 取100个, 走GIN索引"
+    size = 100
+    repeat = 200
+    warmup = 20
+
+    def run(self) -> None:
+        list(Student.objects.info_contains({"room": random.randint(0, 9999)})[:self.size])
+
+
+@register
+class SerializerDump(Scenario):
+    name = "serializer_dump"
+    description = "StudentSerializer(many=True) 序列化100个已经查出来的学生, 不查数据库"
+    size = 100
+    repeat = 200
+    warmup = 20
+
+    def setup(self) -> None:
+        self.students = list(Student.objects.filter(pk__in=sample_pks(self.size)))
+        if not self.students:
+            raise Skip("没有学生, 先执行 create_lots_of_students")
+
+    def run(self) -> None:
+        StudentSerializer(self.students, many=True).data  # pylint: disable=expression-not-assigned
+
+
+@register
+class CompiledDump(Scenario):
+    name = "compiled_dump"
+    description = "CompiledSerializer 查询并序列化100个学生"
+    size = 100
+    repeat = 200
+    warmup = 20
+
+    def setup(self) -> None:
+        self.pks = sample_pks(self.size)
+        if not self.pks:
+            raise Skip("没有学生, 先执行 create_lots_of_students")
+
+    def run(self) -> None:
+        CompiledSerializer(StudentSerializer).serialize(Student.objects.filter(pk__in=self.pks))
+
+
+@register
+class CacheGet(SampleMixin, Scenario):
+    name = "cache_get"
+    description = "Student.cached.get(pk=), 预热以后都命中redis"
+
+    def setup(self) -> None:
+        super().setup()
+        Student.cached.get_many(self.pks)
+
+    def run(self) -> None:
+        Student.cached.get(pk=random.choice(self.pks))
+
+
+@register
+class CacheGetMany(SampleMixin, Scenario):
+    name = "cache_get_many"
+    description = "Student.cached.get_many 100个"
+    size = 100
+    repeat = 200
+    warmup = 20
+
+    def setup(self) -> None:
+        super().setup()
+        Student.cached.get_many(self.pks)
+
+    def run(self) -> None:
+        Student.cached.get_many(random.sample(self.pks, min(self.size, len(self.pks))))
+
+
+def skip(*args, **kwargs) -> None:
+    pass
+
+
+@contextlib.contextmanager
+def skip_redis_writes() -> Iterator[None]:
+    """写数据的场景里不删缓存, 不加布隆过滤器"""
+    patches = [(managers, "delete_cache"), (managers, "bump_generation"), (STUDENT_CODES, "add")]
+    originals = [vars(target).get(name) for target, name in patches]
+    for target, name in patches:
+        setattr(target, name, skip)
+    try:
+        yield
+    finally:
+        for (target, name), original in zip(patches, originals):
+            if original is None:
+                delattr(target, name)
+            else:
+                setattr(target, name, original)
+
+
+def measure(func: Callable[[], None], repeat: int, warmup: int, rollback: bool) -> List[float]:
+    durations: List[float] = []
+    for index in range(warmup + repeat):
+        savepoint = transaction.savepoint() if rollback else None
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if savepoint is not None:
+            transaction.savepoint_rollback(savepoint)
+        if index >= warmup:
+            durations.append(duration)
+    return durations
+
+
+def run_scenario(name: str, repeat: Optional[int] = None, warmup: Optional[int] = None) -> Dict[str, Any]:
+    scenario = SCENARIOS[name]()
+    repeat = scenario.repeat if repeat is None else repeat
+    warmup = scenario.warmup if warmup is None else warmup
+    try:
+        with transaction.atomic(), skip_redis_writes() if scenario.writes else contextlib.nullcontext():
+            scenario.setup()
+            try:
+                durations = measure(scenario.run, repeat, warmup, rollback=scenario.writes)
+            finally:
+                scenario.teardown()
+            if scenario.writes:
+                raise Rollback()
+    except Rollback:
+        pass
+    durations.sort()
+    mean = statistics.mean(durations)
+    return {
+        "description": scenario.description,
+        "size": scenario.size,
+        "repeat": repeat,
+        "warmup": warmup,
+        "mean": mean,
+        "min": durations[0],
+        "max": durations[-1],
+        "p50": percentile(durations, 0.5),
+        "p95": percentile(durations, 0.95),
+        "p99": percentile(durations, 0.99),
+        "rows_per_sec": scenario.size / mean if mean else 0.0,
+    }
+
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def get_meta() -> Dict[str, Any]:
+    return {
+        "created": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+        "git": get_git_commit(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "database": connection.vendor,
+    }
+
+
+def save(data: Dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def load(path: Path) -> Dict[str, Any]:
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def compare(
+        current: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+        threshold: float = THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    两次结果里都有的场景按p50比较
+    status: regression 慢了threshold以上, improvement 快了threshold以上, 其他是 same
+    """
+    result = []
+    for name, stats in current.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        ratio = stats["p50"] / base["p50"] if base["p50"] else 1.0
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 - threshold:
+            status = "improvement"
+        else:
+            status = "same"
+        result.append({
+            "name": name,
+            "status": status,
+            "ratio": ratio,
+            "p50": stats["p50"],
+            "baseline_p50": base["p50"],
+            "p95": stats["p95"],
+            "baseline_p95": base["p95"],
+        })
+    return result
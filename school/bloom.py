@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+redis位图实现的布隆过滤器, 用来在查数据库前判断Student.code是否"可能存在"
+
+    STUDENT_CODES.rebuild(codes, capacity=Student.objects.count())
+    STUDENT_CODES.contains(["a001", "a002"])  # [True, False]
+
+哈希: sha1(code) 的前两个32位整数 h1, h2, 第i个位置是 (h1 + i * h2) % size
+    python和lua(redis.sha1hex)算出来的位置一样, 所以可以在python里整体构建再一次性写入
+key:
+    <name>:bits 位图
+    <name>:meta size, hashes, count(加入的数量), deleted(删除的数量)
+    <name>:stats checked, probable, confirmed, 用来算误判率
+    <name>:pending 重建期间新加入的code, 重建完再补进去
+还没有重建过的时候 contains 全部返回True, 调用方会退化成查数据库
+删除的code没法从位图里去掉, 只会增加误判率, deleted太多了就重建
+"""
+
+
+import functools
+import hashlib
+import logging
+import math
+from typing import Dict, Iterable, List, Optional
+
+from django.db import connections, transaction
+
+from school.consts import REDIS, register_script
+
+
+LOGGER = logging.getLogger(__name__)
+
+ADD_SCRIPT = register_script("""
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('SADD', KEYS[3], unpack(ARGV))
+end
+local size = tonumber(redis.call('HGET', KEYS[2], 'size'))
+if not size then
+    return 0
+end
+local hashes = tonumber(redis.call('HGET', KEYS[2], 'hashes'))
+for i = 1, #ARGV do
+    local digest = redis.sha1hex(ARGV[i])
+    local h1 = tonumber(string.sub(digest, 1, 8), 16)
+    local h2 = tonumber(string.sub(digest, 9, 16), 16)
+    for j = 0, hashes - 1 do
+        redis.call('SETBIT', KEYS[1], (h1 + j * h2) % size, 1)
+    end
+end
+redis.call('HINCRBY', KEYS[2], 'count', #ARGV)
+return #ARGV
+""")
+CHECK_SCRIPT = register_script("""
+local size = tonumber(redis.call('HGET', KEYS[2], 'size'))
+if not size then
+    return false
+end
+local hashes = tonumber(redis.call('HGET', KEYS[2], 'hashes'))
+local result = {}
+for i = 1, #ARGV do
+    local digest = redis.sha1hex(ARGV[i])
+    local h1 = tonumber(string.sub(digest, 1, 8), 16)
+    local h2 = tonumber(string.sub(digest, 9, 16), 16)
+    result[i] = 1
+    for j = 0, hashes - 1 do
+        if redis.call('GETBIT', KEYS[1], (h1 + j * h2) % size) == 0 then
+            result[i] = 0
+            break
+        end
+    end
+end
+return result
+""")
+# pending里的第一个元素, 只用来让key存在
+PENDING_MARKER = ""
+
+
+def get_positions(value: str, size: int, hashes: int) -> List[int]:
+    digest = hashlib.sha1(value.encode()).hexdigest()
+    h1, h2 = int(digest[:8], 16), int(digest[8:16], 16)
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+def get_size(capacity: int, error_rate: float) -> Dict[str, int]:
+    """按容量和误判率算位图大小和哈希次数"""
+    capacity = max(capacity, 1)
+    size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    return {"size": size, "hashes": max(1, round(size / capacity * math.log(2)))}
+
+
+class BloomFilter:
+    ERROR_RATE = 0.01
+    # 重建的时候按现有数量的几倍预留容量
+    GROWTH = 2
+    BATCH_SIZE = 1000
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bits_key = f"{name}:bits"
+        self.meta_key = f"{name}:meta"
+        self.stats_key = f"{name}:stats"
+        self.pending_key = f"{name}:pending"
+
+    def get_keys(self) -> List[str]:
+        return [self.bits_key, self.meta_key, self.pending_key]
+
+    def add(self, values: Iterable[str]) -> None:
+        values = list(values)
+        for start in range(0, len(values), self.BATCH_SIZE):
+            ADD_SCRIPT(keys=self.get_keys(), args=values[start:start + self.BATCH_SIZE])
+
+    def add_on_commit(self, values: Iterable[str], using: str = "default") -> None:
+        """
+        马上加入, 提交之前别的进程就能查到
+        在事务里的话提交后再加一次: 提交前开始的重建读不到这些行, 替换位图以后就丢了
+            提交后再加的时候, 重建要么已经完成, 要么还在进行, 会记到pending里
+        """
+        values = list(values)
+        if not values:
+            return
+        self.add(values)
+        if connections[using].in_atomic_block:
+            transaction.on_commit(functools.partial(self.add, values), using=using)
+
+    def mark_deleted(self, count: int = 1) -> None:
+        REDIS.hincrby(self.meta_key, "deleted", count)
+
+    def contains(self, values: Iterable[str]) -> List[bool]:
+        """没有重建过的时候返回全True"""
+        values = list(values)
+        result: List[bool] = []
+        for start in range(0, len(values), self.BATCH_SIZE):
+            batch = values[start:start + self.BATCH_SIZE]
+            flags = CHECK_SCRIPT(keys=self.get_keys(), args=batch)
+            if flags is None:
+                result.extend(True for _ in batch)
+            else:
+                result.extend(bool(flag) for flag in flags)
+        return result
+
+    def rebuild(
+            self, values: Iterable[Optional[str]], capacity: int,
+            error_rate: Optional[float] = None) -> int:
+        """
+        values可以是数据库的流式查询, 在内存里构建位图后一次性替换
+        重建期间save的code记在pending里, 替换后再补进去
+        """
+        params = get_size(capacity * self.GROWTH, error_rate or self.ERROR_RATE)
+        size, hashes = params["size"], params["hashes"]
+        LOGGER.info("重建布隆过滤器 %s: %d 位, %d 个哈希", self.name, size, hashes)
+        pipeline = REDIS.pipeline()
+        pipeline.delete(self.pending_key)
+        pipeline.sadd(self.pending_key, PENDING_MARKER)
+        pipeline.execute()
+        bits = bytearray((size + 7) // 8)
+        count = 0
+        for value in values:
+            if not value:
+                continue
+            for position in get_positions(value, size, hashes):
+                # redis的SETBIT里0号位是第一个字节的最高位
+                bits[position >> 3] |= 0x80 >> (position & 7)
+            count += 1
+        tmp_key = f"{self.bits_key}:tmp"
+        pipeline = REDIS.pipeline()
+        pipeline.set(tmp_key, bytes(bits))
+        pipeline.rename(tmp_key, self.bits_key)
+        pipeline.delete(self.meta_key, self.stats_key)
+        pipeline.hset(self.meta_key, mapping={**params, "count": count, "deleted": 0})
+        pipeline.smembers(self.pending_key)
+        pipeline.delete(self.pending_key)
+        pending = pipeline.execute()[-2]
+        pending = [value.decode() for value in pending if value.decode() != PENDING_MARKER]
+        if pending:
+            LOGGER.info("补充重建期间加入的 %d 个值", len(pending))
+            self.add(pending)
+        return count
+
+    def record(self, checked: int, probable: int, confirmed: int) -> None:
+        pipeline = REDIS.pipeline(transaction=False)
+        pipeline.hincrby(self.stats_key, "checked", checked)
+        pipeline.hincrby(self.stats_key, "probable", probable)
+        pipeline.hincrby(self.stats_key, "confirmed", confirmed)
+        pipeline.execute()
+
+    def stats(self) -> Dict[str, float]:
+        """
+        false_positive_rate: 不存在的值里被判断成可能存在的比例
+        queries_saved: 和逐个查数据库相比少查的次数
+        """
+        data = {key.decode(): int(value) for key, value in REDIS.hgetall(self.stats_key).items()}
+        meta = {key.decode(): int(value) for key, value in REDIS.hgetall(self.meta_key).items()}
+        checked = data.get("checked", 0)
+        probable = data.get("probable", 0)
+        confirmed = data.get("confirmed", 0)
+        negatives = checked - confirmed
+        return {
+            **meta,
+            "checked": checked,
+            "probable": probable,
+            "confirmed": confirmed,
+            "false_positive_rate": (probable - confirmed) / negatives if negatives else 0.0,
+            "queries_saved": checked - probable,
+        }
+
+    def reset_stats(self) -> None:
+        REDIS.delete(self.stats_key)
+
+    def clear(self) -> None:
+        REDIS.delete(self.bits_key, self.meta_key, self.stats_key, self.pending_key)
+
+
+STUDENT_CODES = BloomFilter("school:student.code:bloom")
+
+
+def add_code(sender, instance, using: str = "default", **kwargs) -> None:
+    """
+    post_save 的receiver, update和bulk_create由 StudentQuerySet 处理
+    事务回滚的话只是多一个误判, 不影响正确性
+    """
+    if instance.code:
+        STUDENT_CODES.add_on_commit([instance.code.lower()], using=using)
+
+
+def forget_code(sender, instance, **kwargs) -> None:
+    if instance.code:
+        STUDENT_CODES.mark_deleted()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+school里通用的Command基类
+"""
+
+
+import logging
+import time
+from multiprocessing import Pool
+from typing import Dict, Generic, List, Tuple
+
+from django.core.management.base import CommandError, CommandParser
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from django_commands.commands import LargeQuerysetMutiProcessHandlerCommand
+
+from school.jobs import LEASE, RangeJob
+from school.planner import plan_ranges
+from school.sharding import get_shards
+from school.writeback import WRITE_MODES, M, WriteBack, WriteMode
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class WriteBackCommand(LargeQuerysetMutiProcessHandlerCommand, Generic[M]):
+    """
+    按pk范围处理大表, 每个范围内的修改一次性写回
+
+    子类需要:
+        WRITE_FIELDS: 会修改的字段
+        handle_object: 在python里修改单个对象
+        get_update_expressions: 可选, 如果修改可以写成F表达式,
+            --write-mode=sql 时直接一条UPDATE, 不再把数据读出来
+
+    每个任务是 (数据库, 起始pk, 结束pk), --sharded 时每个分片分别拆分范围
+    --celery 时不在本机的进程池执行, 交给所有celery worker, 见 school/jobs.py
+    """
+    WRITE_FIELDS: List[str] = []
+    write_mode: WriteMode = "bulk"
+    databases: List[str] = []
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument(
+                "--write-mode", choices=WRITE_MODES, default="bulk",
+                help="row: 逐行save; bulk: bulk_update; sql: F表达式或COPY+UPDATE FROM")
+        parser.add_argument(
+                "--sharded", action="store_true",
+                help="在所有分片上执行, 见 school/sharding.py")
+        parser.add_argument(
+                "--celery", action="store_true",
+                help="把范围派发给所有celery worker, 本机只等待和重新派发超时的范围")
+        parser.add_argument(
+                "--lease", type=int, default=LEASE,
+                help="--celery 时一个范围超过多少秒没完成就重新派发")
+        super().add_arguments(parser)
+
+    def get_databases(self) -> List[str]:
+        return self.databases or [self.get_queryset().db]
+
+    def get_ranges(self) -> List[Tuple[str, int, int]]:
+        """父类的 get_tasks 只有 (起始pk, 结束pk), 这里多了数据库"""
+        tasks: List[Tuple[str, int, int]] = []
+        for alias in self.get_databases():
+            if len(tasks) >= self.MAX_TASK:
+                break
+            for start, end in plan_ranges(self.get_queryset().using(alias), chunk_rows=self.BATCH_SIZE):
+                if len(tasks) >= self.MAX_TASK:
+                    break
+                tasks.append((alias, start, end))
+        connections.close_all()
+        return tasks
+
+    def handle(
+            self, *args, jobs=None, write_mode: WriteMode = "bulk", sharded=False,
+            celery=False, lease=LEASE, **kwargs):
+        # 放在类属性上, fork出来的子进程也能拿到
+        type(self).write_mode = write_mode
+        self.databases = get_shards() if sharded else []
+        start = time.time()
+        tasks = self.get_ranges()
+        LOGGER.info("共 %d 个范围, 写回模式: %s", len(tasks), write_mode)
+        rows = 0
+        if celery:
+            job = RangeJob.create(
+                    f"{type(self).__module__}.{type(self).__name__}", tasks,
+                    {"write_mode": write_mode}, lease=lease)
+            job.dispatch()
+            progress = job.wait()
+            if progress["counts"]["failed"]:
+                failed = job.get_failed()
+                raise CommandError(f"任务 {job.job_id} 有 {len(failed)} 个范围失败: " + ", ".join(
+                    f"{field} {error}" for field, error in sorted(failed.items())))
+            rows = progress["rows"]
+        else:
+            with Pool(jobs) as p:
+                for result in p.imap_unordered(self.handle_single_task, tasks):
+                    rows += result
+        duration = time.time() - start
+        LOGGER.info(
+                "写回完成: %d 行, 耗时: %.2fs, rows/sec: %.1f",
+                rows, duration, rows / duration if duration else 0)
+
+    @classmethod
+    def run_range(cls, task: Tuple[str, int, int], write_mode: WriteMode = "bulk") -> int:
+        """celery worker里执行一个范围, 见 RangeJob.run"""
+        cls.write_mode = write_mode
+        return cls.handle_single_task(task)
+
+    @classmethod
+    def get_range_queryset(cls, task: Tuple[str, int, int]) -> QuerySet:
+        alias, start, end = task
+        return cls.queryset.using(alias).filter(pk__gte=start, pk__lte=end)
+
+    @classmethod
+    def get_update_expressions(cls) -> Dict:
+        return {}
+
+    @classmethod
+    def handle_object(cls, obj: M) -> None:
+        raise NotImplementedError
+
+    @classmethod
+    def handle_single_task(cls, task: Tuple[str, int, int]) -> int:
+        LOGGER.info("处理范围: %s %d => %d", *task)
+        queryset = cls.get_range_queryset(task)
+        expressions = cls.get_update_expressions()
+        if cls.write_mode == "sql" and expressions:
+            now = timezone.now()
+            for field in queryset.model._meta.concrete_fields:
+                if getattr(field, "auto_now", False):
+                    expressions.setdefault(field.name, now)
+            return queryset.update(**expressions)
+        writeback = WriteBack(queryset.model, cls.WRITE_FIELDS, mode=cls.write_mode, using=queryset.db)
+        for obj in queryset.order_by("pk").iterator():
+            cls.handle_object(obj)
+            writeback.add(obj)
+        return writeback.flush()
@@ -3,9 +3,81 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+import asyncio
+import hashlib
+import weakref
+from typing import Any, AsyncGenerator, Awaitable, List, Optional, Tuple, cast
+
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
 from django_redis import get_redis_connection
+from redis import Redis
+from redis import asyncio as aioredis
+from redis.commands.core import Script
+from redis.exceptions import NoScriptError
+
+
+# 第一次使用的时候才创建, import的时候不会加载django_redis的client, 也不会按import时的settings初始化
+# redis-py 把返回值标注成 Awaitable | 值, 同步调用的时候没法用, 所以还是当成Any
+REDIS: Any = SimpleLazyObject(lambda: get_redis_connection("default"))
+# 异步的连接池只能在创建它的事件循环里用, 每个事件循环一个, 事件循环结束的时候关闭, 见 close_on_shutdown
+ASYNC_REDIS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[aioredis.Redis, AsyncGenerator[None, None]]]" = (
+    weakref.WeakKeyDictionary())
+
+
+class LazyScript:
+    """和 REDIS.register_script 一样调用, 第一次调用的时候才注册, 不会在import的时候创建REDIS"""
+
+    def __init__(self, script: str):
+        self.script = script
+        self.registered: Optional[Script] = None
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+
+    def __call__(self, keys: Optional[List] = None, args: Optional[List] = None, client: Optional[Redis] = None):
+        if self.registered is None:
+            self.registered = REDIS.register_script(self.script)
+        return self.registered(keys=keys, args=args, client=client)
+
+    async def acall(self, client: aioredis.Redis, keys: Optional[List] = None, args: Optional[List] = None) -> Any:
+        """用异步的连接执行, 服务端没有这个脚本的时候再加载"""
+        keys = keys or []
+        args = args or []
+        # 异步client的返回值也标注成了 Awaitable | 值
+        try:
+            return await cast(Awaitable[Any], client.evalsha(self.sha, len(keys), *keys, *args))
+        except NoScriptError:
+            await client.script_load(self.script)
+            return await cast(Awaitable[Any], client.evalsha(self.sha, len(keys), *keys, *args))
+
+
+def register_script(script: str) -> LazyScript:
+    return LazyScript(script)
+
 
+async def close_on_shutdown(client: aioredis.Redis) -> AsyncGenerator[None, None]:
+    """
+    WSGI下的异步视图每个请求都是 async_to_sync 新建的事件循环, 连接池不关闭的话会越来越多
+    asyncio.run 结束前会调用 loop.shutdown_asyncgens, 关闭还没结束的async generator, 在这里关闭连接池
+    """
+    try:
+        yield
+    finally:
+        # 不引用loop, ASYNC_REDIS 的值里有这个generator
+        ASYNC_REDIS.pop(asyncio.get_running_loop(), None)
+        await client.aclose()
 
 
-# 这个有很大的隐患，因为test的时候返回的时已经初始化了的。
-REDIS = get_redis_connection("default")
+def get_async_redis() -> aioredis.Redis:
+    """和REDIS连同一个redis, 给异步视图用"""
+    loop = asyncio.get_running_loop()
+    if loop not in ASYNC_REDIS:
+        from school.requeststats import AsyncInstrumentedRedis  # pylint: disable=import-outside-toplevel
+        client = AsyncInstrumentedRedis.from_url(settings.CACHES["default"]["LOCATION"])
+        closer = close_on_shutdown(client)
+        # 同步地执行到yield, 事件循环记下这个generator(只是弱引用, 所以放进ASYNC_REDIS)
+        try:
+            closer.asend(None).send(None)
+        except StopIteration:
+            pass
+        ASYNC_REDIS[loop] = (client, closer)
+    return ASYNC_REDIS[loop][0]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+流式导出学生, 可以带上考试的聚合数据
+
+    for chunk in export(get_queryset(with_exams=True), "csv", fields=["id", "exam_total"], compress=True):
+        file.write(chunk)
+
+用服务端游标(iterator(chunk_size)) 一批批读取, 每批编码成一个bytes
+内存里最多只有一批数据, 和表有多大没有关系
+分片以后没有指定 using() 的queryset依次导出每个分片, 只在分片内按主键排序
+"""
+
+
+import csv
+import io
+import itertools
+import json
+import logging
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Literal, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, QuerySet, Sum
+
+from school.models import Student
+from school.serializers import CompiledSerializer, StudentExamSerializer, StudentSerializer
+from school.sharding import get_shards, get_using, is_sharding_enabled
+
+
+LOGGER = logging.getLogger(__name__)
+Format = Literal["ndjson", "csv"]
+FORMATS = ["ndjson", "csv"]
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class Counter:
+    """导出过程中统计行数和字节数"""
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+
+
+def get_queryset(with_exams: bool = False) -> QuerySet:
+    queryset = Student.objects.order_by("pk")
+    if with_exams:
+        queryset = queryset.annotate(
+            exam_count=Count("exam"),
+            exam_total=Sum("exam__score"),
+            exam_max=Max("exam__score"),
+        )
+    return queryset
+
+
+def get_serializer(with_exams: bool = False, fields: Optional[List[str]] = None) -> CompiledSerializer:
+    serializer_class = StudentExamSerializer if with_exams else StudentSerializer
+    unknown = set(fields or []) - set(serializer_class.Meta.fields)
+    if unknown:
+        raise ValueError(f"不支持的字段: {', '.join(sorted(unknown))}")
+    return CompiledSerializer(serializer_class, fields=fields)
+
+
+def encode_ndjson(rows: List[Dict[str, Any]]) -> bytes:
+    return "".join(
+        json.dumps(row, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n" for row in rows
+    ).encode()
+
+
+def write_csv(rows: Iterable[Iterable[Any]]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def encode_csv(rows: List[Dict[str, Any]]) -> bytes:
+    """info这种json字段在csv里是json字符串"""
+    return write_csv(
+        [
+            json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else value
+            for value in row.values()
+        ]
+        for row in rows
+    )
+
+
+def gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # 31: gzip格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(
+        queryset: QuerySet,
+        file_format: Format = "ndjson",
+        fields: Optional[List[str]] = None,
+        with_exams: bool = False,
+        compress: bool = False,
+        chunk_size: int = 2000,
+        counter: Optional[Counter] = None) -> Iterator[bytes]:
+    """字段不对的话马上抛ValueError, 不会等到开始读取"""
+    serializer = get_serializer(with_exams, fields)
+    encode = encode_csv if file_format == "csv" else encode_ndjson
+    counter = counter or Counter()
+    if is_sharding_enabled() and get_using(queryset) is None:
+        querysets = [queryset.using(alias) for alias in get_shards()]
+    else:
+        querysets = [queryset]
+
+    def chunks() -> Iterator[bytes]:
+        if file_format == "csv":
+            yield write_csv([serializer.names])
+        batch: List[Dict[str, Any]] = []
+        rows = itertools.chain.from_iterable(
+            serializer.iterator(item, chunk_size=chunk_size) for item in querysets)
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                yield encode(batch)
+                counter.rows += len(batch)
+                batch = []
+        if batch:
+            yield encode(batch)
+            counter.rows += len(batch)
+
+    def count(items: Iterable[bytes]) -> Iterator[bytes]:
+        for chunk in items:
+            counter.bytes += len(chunk)
+            yield chunk
+
+    return count(gzip_chunks(chunks()) if compress else chunks())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+Parent/Child 的家庭关系
+
+    families = load_families([parent1, parent2])  # 固定2次查询
+    for child in families[parent1.pk].children:
+        child.mother.name, child.father.name  # 不会再查询
+"""
+
+
+import logging
+from typing import Dict, Iterable, List, Union
+
+from django.db.models import Q
+
+from school.models.relations import Child, Parent
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Family:
+
+    def __init__(self, parent: Parent):
+        self.parent = parent
+        self.children: List[Child] = []
+
+    @property
+    def partners(self) -> List[Parent]:
+        """和这个家长一起有孩子的其他家长"""
+        result: Dict[int, Parent] = {}
+        for child in self.children:
+            for other in [child.mother, child.father]:
+                if other.pk != self.parent.pk:
+                    result[other.pk] = other
+        return list(result.values())
+
+    def __repr__(self) -> str:
+        return f"<Family {self.parent.pk}: {len(self.children)} children>"
+
+
+def load_families(parents: Iterable[Union[Parent, int]], using: str = "default") -> Dict[int, Family]:
+    """
+    第1次查询: 这些家长作为父亲或母亲的所有孩子
+    第2次查询: 这些家长和孩子的另一个家长
+    孩子的mother/father都会放进缓存
+    """
+    parent_ids = {parent if isinstance(parent, int) else parent.pk for parent in parents}
+    if not parent_ids:
+        return {}
+    children = list(
+        Child.objects.using(using).filter(
+            Q(mother_id__in=parent_ids) | Q(father_id__in=parent_ids)
+        ).order_by("pk")
+    )
+    needed = parent_ids | {child.mother_id for child in children} | {child.father_id for child in children}
+    loaded = Parent.objects.using(using).in_bulk(needed)
+    families = {pk: Family(loaded[pk]) for pk in parent_ids if pk in loaded}
+    for child in children:
+        Child.mother.field.set_cached_value(child, loaded[child.mother_id])
+        Child.father.field.set_cached_value(child, loaded[child.father_id])
+        for pk in {child.mother_id, child.father_id} & families.keys():
+            families[pk].children.append(child)
+    return families
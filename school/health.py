@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+健康检查: 后台定时执行 django-health-check 的插件, 探针只读缓存的结果
+
+    /health/live/  存活探针, 不访问数据库和redis, 进程能处理请求就返回200
+    /health/  就绪探针, 返回最近一次检查的结果, 有关键服务异常或者结果太旧(HEALTH_MAX_AGE)返回503
+
+每个进程第一次收到探针时启动一个后台线程, 每 HEALTH_INTERVAL 秒:
+    抢到这台机器的redis锁的进程执行所有检查(celery检查会发一个任务等结果), 结果带上时间写入redis
+    其他进程直接读redis里的结果
+    所以每台机器每个周期只检查一次, 和探针的频率, 进程数没有关系
+    磁盘和内存是本机的, 所以结果按机器分开存
+    redis连不上的时候每个进程自己检查, redis的检查会失败
+结果放在进程内存里, 探针不会等待检查, 也不会访问redis
+
+key:
+    school:health:<host>  json, 最近一次检查结果
+    school:health:lock:<host>  一个周期内只有一个进程执行检查
+"""
+
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, JsonResponse
+from health_check.mixins import CheckMixin
+from redis.exceptions import RedisError
+
+from school.consts import REDIS
+
+
+LOGGER = logging.getLogger(__name__)
+PREFIX = "school:health:"
+HOST = socket.gethostname()
+
+
+def get_key() -> str:
+    return f"{PREFIX}{HOST}"
+
+
+def get_lock_key() -> str:
+    return f"{PREFIX}lock:{HOST}"
+
+
+class Checks(CheckMixin):
+    """names 不是None的时候只执行这些插件, 一个都没有就什么都不执行"""
+
+    def __init__(self, names: Optional[List[str]] = None):
+        self.names = names
+
+    def filter_plugins(self, subset=None):
+        plugins = super().filter_plugins(subset=subset)
+        if self.names is None:
+            return plugins
+        return {identifier: plugin for identifier, plugin in plugins.items() if identifier in self.names}
+
+
+def run_checks(names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """执行所有插件, names 只执行这些, 默认 HEALTH_CHECKS"""
+    names = names if names is not None else settings.HEALTH_CHECKS
+    checks = Checks(names)
+    plugins = checks.filter_plugins()
+    if names and not plugins:
+        LOGGER.warning("没有找到要执行的健康检查插件: %s", names)
+    start = time.time()
+    errors = checks.run_check()
+    return {
+        "time": start,
+        "took": time.time() - start,
+        "host": HOST,
+        "healthy": not errors,
+        "checks": {
+            identifier: {
+                "ok": not plugin.errors,
+                "critical": plugin.critical_service,
+                "status": str(plugin.pretty_status()),
+                "took": plugin.time_taken,
+            }
+            for identifier, plugin in plugins.items()
+        },
+    }
+
+
+class HealthCache:
+
+    def __init__(self):
+        self.result: Optional[Dict[str, Any]] = None
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+
+    def start(self) -> None:
+        """每个进程一个后台线程, fork出来的子进程需要重新启动"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.loop, name="school-health", daemon=True).start()
+
+    def loop(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # 线程不能退出, 结果过期以后探针会返回503
+                LOGGER.exception("健康检查失败")
+            time.sleep(settings.HEALTH_INTERVAL)
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        data = REDIS.get(get_key())
+        if data is not None:
+            self.result = json.loads(data)
+        return self.result
+
+    def refresh(self) -> Optional[Dict[str, Any]]:
+        """抢到锁就执行检查并写入redis, 否则读别的进程的结果"""
+        try:
+            acquired = bool(REDIS.set(get_lock_key(), os.getpid(), nx=True, ex=max(1, int(settings.HEALTH_INTERVAL))))
+        except RedisError:
+            # redis连不上, 自己检查
+            acquired = True
+        if not acquired:
+            return self.load()
+        result = run_checks()
+        self.result = result
+        if not result["healthy"]:
+            LOGGER.warning(
+                    "健康检查失败: %s",
+                    {name: check["status"] for name, check in result["checks"].items() if not check["ok"]})
+        try:
+            REDIS.set(get_key(), json.dumps(result), ex=max(1, int(settings.HEALTH_MAX_AGE)))
+        except RedisError:
+            LOGGER.warning("健康检查结果写入redis失败")
+        return result
+
+    def get(self) -> Optional[Dict[str, Any]]:
+        self.start()
+        return self.result
+
+
+CACHE = HealthCache()
+
+
+def live(request: HttpRequest) -> HttpResponse:
+    return HttpResponse("ok", content_type="text/plain")
+
+
+def ready(request: HttpRequest) -> JsonResponse:
+    result = CACHE.get()
+    if result is None:
+        # 进程刚启动, 后台线程还没有结果, 先看看别的进程有没有
+        try:
+            result = CACHE.load()
+        except RedisError:
+            result = None
+    if result is None:
+        return JsonResponse({"healthy": False, "status": "starting"}, status=503)
+    age = time.time() - result["time"]
+    healthy = result["healthy"] and age < settings.HEALTH_MAX_AGE
+    return JsonResponse({**result, "age": age, "healthy": healthy}, status=200 if healthy else 503)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+从文件流式导入学生, 格式和 export 导出的一样, 按code新建或更新
+
+    with open_input("students.csv.gz") as file:
+        for result in ingest(read_rows(file, "csv"), update_fields=["name"]):
+            ...
+
+每次只读 batch_size 行交给 Student.objects.upsert_by_code, 内存和文件有多大没有关系
+解析失败的行原样交给serializer, 会和不合法的行一样记到 errors 里, 不会中断导入
+"""
+
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import logging
+import sys
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, TextIO, Union
+
+from school.export import FORMATS, Format
+from school.models import Student
+from school.models.managers import UPSERT_BATCH
+
+
+LOGGER = logging.getLogger(__name__)
+Row = Union[Dict[str, Any], str]
+
+
+def get_format(path: str) -> Format:
+    """按后缀判断格式, 默认ndjson"""
+    return "csv" if path.removesuffix(".gz").endswith(".csv") else "ndjson"
+
+
+def open_input(path: str) -> TextIO:
+    """- 表示标准输入, .gz结尾的边读边解压"""
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")  # pylint: disable=consider-using-with
+
+
+def read_ndjson(lines: Iterable[str]) -> Iterator[Row]:
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            yield line
+
+
+def read_csv(lines: Iterable[str]) -> Iterator[Row]:
+    """空字符串当成没有这一列, info是json"""
+    for row in csv.DictReader(lines):
+        row = {key: value for key, value in row.items() if value != ""}
+        if "info" in row:
+            try:
+                row["info"] = json.loads(row["info"])
+            except json.JSONDecodeError:
+                yield json.dumps(row, ensure_ascii=False)
+                continue
+        yield row
+
+
+def read_rows(lines: Iterable[str], file_format: Format = "ndjson") -> Iterator[Row]:
+    if file_format not in FORMATS:
+        raise ValueError(f"不支持的格式: {file_format}")
+    return read_csv(lines) if file_format == "csv" else read_ndjson(lines)
+
+
+def ingest(
+        rows: Iterable[Row], update_fields: Optional[Sequence[str]] = None,
+        batch_size: int = UPSERT_BATCH, using: str = "default") -> Iterator[Dict[str, Any]]:
+    """每批返回一个结果, errors里的行号是从0开始的数据行号"""
+    rows = iter(rows)
+    offset = 0
+    while batch := list(itertools.islice(rows, batch_size)):
+        for result in Student.objects.using(using).upsert_by_code(
+                batch, update_fields=update_fields, batch_size=batch_size):
+            result["errors"] = [(offset + index, detail) for index, detail in result["errors"]]
+            yield result
+        offset += len(batch)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+用celery把大表按主键范围分给所有机器的worker执行, 进度记在redis里
+
+    job = RangeJob.create("school.management.commands.student_grow.Command", tasks, {"write_mode": "sql"})
+    job.dispatch()  # 一个group, 每个范围一个 school.tasks.run_range
+    job.progress()  # 汇总: 每种状态的范围数, 行数, 速度, 每个worker的吞吐
+    job.redistribute()  # 超时没完成的和失败的范围重新派发
+
+handler: import路径, 有 run_range(task, **options) 就调用它, 否则直接调用, 返回处理的行数
+    task 是 (数据库, 起始pk, 结束pk)
+
+key:
+    school:job:<id>:meta  hash, handler, options, lease, created
+    school:job:<id>:ranges  hash, "<数据库>:<起始pk>:<结束pk>" => json的状态
+    school:job:ids  有序集合, 最近创建的job
+范围的状态: pending -> running -> done/failed
+    worker开始前用lua领取范围, 同一时间只有一个worker持有, 领取时写入token和lease_until
+    超过lease_until还没完成就认为worker死掉了或者太慢, redistribute后别的worker可以重新领取
+    原来的worker完成时token对不上, 回滚自己的事务, 不会重复处理
+"""
+
+
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from celery import group, signature
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from school.consts import REDIS, register_script
+
+
+LOGGER = logging.getLogger(__name__)
+PREFIX = "school:job:"
+IDS_KEY = PREFIX + "ids"
+# 一个范围最多执行多久, 超过就可以被别的worker重新领取
+LEASE = 600
+MAX_ATTEMPTS = 3
+EXPIRE = 7 * 24 * 3600
+STATUSES = ["pending", "running", "done", "failed"]
+# 按名字派发, 不用导入 school.tasks
+RUN_RANGE_TASK = "school.tasks.run_range"
+Task = Tuple[str, int, int]
+
+CLAIM_SCRIPT = register_script("""
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value then
+    return 0
+end
+local state = cjson.decode(value)
+local now = tonumber(ARGV[4])
+if state.status == 'done' then
+    return 0
+end
+if state.status == 'running' and tonumber(state.lease_until) > now then
+    return 0
+end
+state.status = 'running'
+state.token = ARGV[2]
+state.worker = ARGV[3]
+state.started = now
+state.lease_until = now + tonumber(ARGV[5])
+state.attempts = (state.attempts or 0) + 1
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(state))
+return 1
+""")
+FINISH_SCRIPT = register_script("""
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value then
+    return 0
+end
+local state = cjson.decode(value)
+if state.token ~= ARGV[2] then
+    return 0
+end
+state.status = ARGV[3]
+state.finished = tonumber(ARGV[4])
+state.rows = tonumber(ARGV[5])
+state.error = ARGV[6]
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(state))
+return 1
+""")
+REQUEUE_SCRIPT = register_script("""
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if not value then
+    return 0
+end
+local state = cjson.decode(value)
+local now = tonumber(ARGV[2])
+local expired = state.status == 'running' and tonumber(state.lease_until) <= now
+local retry = state.status == 'failed' and (state.attempts or 0) < tonumber(ARGV[3])
+if not expired and not retry then
+    return 0
+end
+state.status = 'pending'
+state.token = false
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(state))
+return 1
+""")
+
+
+class Superseded(Exception):
+    """范围已经被别的worker重新领取了"""
+
+
+def dump_task(task: Task) -> str:
+    return ":".join(str(item) for item in task)
+
+
+def load_task(field: str) -> Task:
+    alias, start, end = field.rsplit(":", 2)
+    return alias, int(start), int(end)
+
+
+def get_worker() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class RangeJob:
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.meta_key = f"{PREFIX}{job_id}:meta"
+        self.ranges_key = f"{PREFIX}{job_id}:ranges"
+
+    @classmethod
+    def create(
+            cls, handler: str, tasks: Iterable[Task],
+            options: Optional[Dict[str, Any]] = None, lease: int = LEASE) -> "RangeJob":
+        job = cls(uuid.uuid4().hex[:12])
+        now = time.time()
+        pipeline = REDIS.pipeline()
+        pipeline.hset(job.meta_key, mapping={
+            "handler": handler,
+            "options": json.dumps(options or {}),
+            "lease": lease,
+            "created": now,
+        })
+        count = 0
+        for task in tasks:
+            pipeline.hset(job.ranges_key, dump_task(task), json.dumps({"status": "pending"}))
+            count += 1
+        pipeline.expire(job.meta_key, EXPIRE)
+        pipeline.expire(job.ranges_key, EXPIRE)
+        pipeline.zadd(IDS_KEY, {job.job_id: now})
+        pipeline.execute()
+        LOGGER.info("创建任务 %s: %s, %d 个范围", job.job_id, handler, count)
+        return job
+
+    @classmethod
+    def recent(cls, n: int = 10) -> List["RangeJob"]:
+        return [cls(job_id.decode()) for job_id in REDIS.zrevrange(IDS_KEY, 0, n - 1)]
+
+    def get_meta(self) -> Dict[str, Any]:
+        meta = {key.decode(): value.decode() for key, value in REDIS.hgetall(self.meta_key).items()}
+        if not meta:
+            raise ValueError(f"任务不存在或者已经过期: {self.job_id}")
+        return {
+            "handler": meta["handler"],
+            "options": json.loads(meta["options"]),
+            "lease": int(meta["lease"]),
+            "created": float(meta["created"]),
+        }
+
+    def get_states(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            field.decode(): json.loads(value)
+            for field, value in REDIS.hgetall(self.ranges_key).items()
+        }
+
+    def get_failed(self) -> Dict[str, str]:
+        """失败的范围 => 最后一次的错误"""
+        return {
+            field: state.get("error", "")
+            for field, state in self.get_states().items() if state["status"] == "failed"
+        }
+
+    def dispatch(self, fields: Optional[Iterable[str]] = None) -> None:
+        """默认派发所有没完成的范围"""
+        if fields is None:
+            fields = [field for field, state in self.get_states().items() if state["status"] != "done"]
+        signatures = [signature(RUN_RANGE_TASK, args=(self.job_id, field)) for field in fields]
+        if signatures:
+            group(signatures).apply_async()
+        LOGGER.info("任务 %s 派发 %d 个范围", self.job_id, len(signatures))
+
+    def claim(self, field: str, token: str, lease: int, now: Optional[float] = None) -> bool:
+        return bool(CLAIM_SCRIPT(
+            keys=[self.ranges_key],
+            args=[field, token, get_worker(), now or time.time(), lease]))
+
+    def finish(self, field: str, token: str, rows: int, status: str = "done", error: str = "") -> bool:
+        """token对不上说明已经被别人重新领取了, 返回False"""
+        return bool(FINISH_SCRIPT(
+            keys=[self.ranges_key],
+            args=[field, token, status, time.time(), rows, error]))
+
+    def run(self, field: str) -> int:
+        """worker里执行一个范围, 返回处理的行数, 没领到或者被别人接手了返回0"""
+        meta = self.get_meta()
+        token = uuid.uuid4().hex
+        if not self.claim(field, token, meta["lease"]):
+            LOGGER.info("任务 %s 范围 %s 已经完成或者正在执行, 跳过", self.job_id, field)
+            return 0
+        task = load_task(field)
+        handler = import_string(meta["handler"])
+        func: Callable[..., int] = getattr(handler, "run_range", handler)
+        try:
+            # 在提交前确认自己还持有这个范围, 被别人接手了就回滚
+            with transaction.atomic(using=task[0]):
+                rows = func(task, **meta["options"])
+                if not self.finish(field, token, rows):
+                    raise Superseded(field)
+        except Superseded:
+            LOGGER.warning("任务 %s 范围 %s 超时后被别的worker接手, 回滚", self.job_id, field)
+            return 0
+        except Exception as error:
+            self.finish(field, token, 0, "failed", repr(error))
+            raise
+        LOGGER.debug("任务 %s 范围 %s 完成: %d 行", self.job_id, field, rows)
+        return rows
+
+    def redistribute(self, max_attempts: int = MAX_ATTEMPTS) -> List[str]:
+        """超时的和失败次数没到上限的范围改回pending并重新派发"""
+        now = time.time()
+        # 先在python里筛选, lua里再确认一次, 避免和worker同时修改
+        candidates = [
+            field for field, state in self.get_states().items()
+            if (state["status"] == "running" and state["lease_until"] <= now)
+            or (state["status"] == "failed" and state["attempts"] < max_attempts)
+        ]
+        fields = [
+            field for field in candidates
+            if REQUEUE_SCRIPT(keys=[self.ranges_key], args=[field, now, max_attempts])
+        ]
+        if fields:
+            LOGGER.warning("任务 %s 重新派发 %d 个范围: %s", self.job_id, len(fields), fields[:10])
+            self.dispatch(fields)
+        return fields
+
+    def progress(self) -> Dict[str, Any]:
+        """
+        counts: 每种状态的范围数
+        stale: 正在执行但是已经超时的范围数
+        rows_per_sec: 从创建到现在的平均速度
+        workers: 每个worker完成的范围数, 行数, 执行耗时和吞吐
+        """
+        meta = self.get_meta()
+        now = time.time()
+        counts = {status: 0 for status in STATUSES}
+        workers: Dict[str, Dict[str, float]] = {}
+        rows = 0
+        stale = 0
+        finished = meta["created"]
+        for state in self.get_states().values():
+            counts[state["status"]] += 1
+            if state["status"] == "running" and state["lease_until"] <= now:
+                stale += 1
+            if state["status"] != "done":
+                continue
+            rows += state["rows"]
+            finished = max(finished, state["finished"])
+            worker = workers.setdefault(state["worker"], {"ranges": 0, "rows": 0, "seconds": 0.0})
+            worker["ranges"] += 1
+            worker["rows"] += state["rows"]
+            worker["seconds"] += state["finished"] - state["started"]
+        for worker in workers.values():
+            worker["rows_per_sec"] = worker["rows"] / worker["seconds"] if worker["seconds"] else 0.0
+        total = sum(counts.values())
+        complete = counts["done"] == total
+        duration = (finished if complete else now) - meta["created"]
+        return {
+            "job_id": self.job_id,
+            "handler": meta["handler"],
+            "total": total,
+            "counts": counts,
+            "stale": stale,
+            "complete": complete,
+            "rows": rows,
+            "duration": duration,
+            "rows_per_sec": rows / duration if duration else 0.0,
+            "workers": workers,
+        }
+
+    def wait(self, interval: float = 5, max_attempts: int = MAX_ATTEMPTS) -> Dict[str, Any]:
+        """
+        等待所有范围完成, 每隔interval秒打印进度并重新派发超时的范围
+        失败次数到上限的范围不再重试, 有这种范围的话直接返回
+        """
+        while True:
+            progress = self.progress()
+            LOGGER.info(
+                    "任务 %s: %s, %d 行, %.1f rows/sec",
+                    self.job_id, progress["counts"], progress["rows"], progress["rows_per_sec"])
+            if progress["complete"]:
+                return progress
+            requeued = self.redistribute(max_attempts)
+            counts = progress["counts"]
+            if not requeued and counts["failed"] and not counts["running"] and not counts["pending"]:
+                LOGGER.error("任务 %s 有 %d 个范围失败次数达到上限", self.job_id, counts["failed"])
+                return progress
+            time.sleep(interval)
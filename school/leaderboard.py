@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+redis有序集合实现的考试排行榜, 分数是学生所有考试的总分
+
+    Leaderboard.of_global().top(10)  # [(student_id, 总分), ...]
+    Leaderboard.of_klass(klass_id).rank(student_id)  # 从1开始, 不在榜上是None
+
+key:
+    school:leaderboard:global
+    school:leaderboard:school:<school_id>
+    school:leaderboard:klass:<klass_id>
+    school:leaderboard:memberships  hash, 学生 => 上次写入的班级/学校, 用来从旧的榜上移除
+没有考试的学生不上榜
+Exam和班级成员变化时, 事务提交后按学生重新计算总分和所在的榜(sync_students), 不会累计误差
+queryset.update/bulk_create不会触发signal, 用 check_leaderboards 检查并修复
+"""
+
+
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from django.db.models import OuterRef, Subquery, Sum
+
+from school.consts import REDIS
+from school.models.base import Exam, Student
+from school.sharding import FanOut, get_shards, is_sharding_enabled, shard_for_pk
+from school.signals import batched
+
+
+LOGGER = logging.getLogger(__name__)
+PREFIX = "school:leaderboard:"
+MEMBERSHIPS_KEY = PREFIX + "memberships"
+# 同一个学生在同一个学校的多个班级, 学校榜上只算一次
+Memberships = Tuple[Set[int], Set[int]]
+
+
+class Leaderboard:
+
+    def __init__(self, key: str):
+        self.key = key
+
+    @classmethod
+    def of_global(cls) -> "Leaderboard":
+        return cls(PREFIX + "global")
+
+    @classmethod
+    def of_school(cls, school_id: int) -> "Leaderboard":
+        return cls(f"{PREFIX}school:{school_id}")
+
+    @classmethod
+    def of_klass(cls, klass_id: int) -> "Leaderboard":
+        return cls(f"{PREFIX}klass:{klass_id}")
+
+    def top(self, n: int = 10, offset: int = 0) -> List[Tuple[int, int]]:
+        return [
+            (int(member), int(score))
+            for member, score in REDIS.zrevrange(self.key, offset, offset + n - 1, withscores=True)
+        ]
+
+    def rank(self, student_id: int) -> Optional[int]:
+        """总分从高到低的名次, 从1开始"""
+        rank = REDIS.zrevrank(self.key, student_id)
+        return None if rank is None else rank + 1
+
+    def score(self, student_id: int) -> Optional[int]:
+        score = REDIS.zscore(self.key, student_id)
+        return None if score is None else int(score)
+
+    def count(self) -> int:
+        return REDIS.zcard(self.key)
+
+    def scan(self) -> Iterator[Tuple[int, int]]:
+        for member, score in REDIS.zscan_iter(self.key, count=1000):
+            yield int(member), int(score)
+
+    def delete(self) -> None:
+        REDIS.delete(self.key)
+
+
+def get_totals(using: str, student_ids: Iterable[int]) -> Dict[int, int]:
+    return dict(
+        Exam.objects.using(using).filter(student_id__in=student_ids).values(
+            "student_id").annotate(total=Sum("score")).order_by().values_list("student_id", "total")
+    )
+
+
+def get_memberships(using: str, student_ids: Iterable[int]) -> Dict[int, Memberships]:
+    result: Dict[int, Memberships] = {}
+    queryset = Student.klass_set.through.objects.using(using).filter(
+        student_id__in=student_ids).values_list("student_id", "klass_id", "klass__school_id")
+    for student_id, klass_id, school_id in queryset:
+        klasses, schools = result.setdefault(student_id, (set(), set()))
+        klasses.add(klass_id)
+        schools.add(school_id)
+    return result
+
+
+def dump_memberships(memberships: Memberships) -> str:
+    return json.dumps([sorted(memberships[0]), sorted(memberships[1])])
+
+
+def load_memberships(value: Optional[bytes]) -> Memberships:
+    if value is None:
+        return set(), set()
+    klasses, schools = json.loads(value)
+    return set(klasses), set(schools)
+
+
+def get_keys(memberships: Memberships) -> Set[str]:
+    klasses, schools = memberships
+    return {
+        *(Leaderboard.of_klass(klass_id).key for klass_id in klasses),
+        *(Leaderboard.of_school(school_id).key for school_id in schools),
+    }
+
+
+def sync_students(using: str, student_ids: Iterable[int]) -> None:
+    """
+    按数据库重新写入这些学生的总分和所在的榜
+    一次总分查询 + 一次班级查询 + 一次HMGET + 一次pipeline
+    """
+    student_ids = sorted(set(student_ids))
+    if not student_ids:
+        return
+    totals = get_totals(using, student_ids)
+    memberships = get_memberships(using, student_ids)
+    previous = REDIS.hmget(MEMBERSHIPS_KEY, student_ids)
+    pipeline = REDIS.pipeline(transaction=False)
+    global_key = Leaderboard.of_global().key
+    for student_id, old_value in zip(student_ids, previous):
+        old_keys = get_keys(load_memberships(old_value))
+        if student_id not in totals:
+            pipeline.zrem(global_key, student_id)
+            for key in old_keys:
+                pipeline.zrem(key, student_id)
+            pipeline.hdel(MEMBERSHIPS_KEY, student_id)
+            continue
+        current = memberships.get(student_id, (set(), set()))
+        new_keys = get_keys(current)
+        for key in old_keys - new_keys:
+            pipeline.zrem(key, student_id)
+        for key in {global_key, *new_keys}:
+            pipeline.zadd(key, {student_id: totals[student_id]})
+        pipeline.hset(MEMBERSHIPS_KEY, student_id, dump_memberships(current))
+    pipeline.execute()
+    LOGGER.debug("同步排行榜: %d 个学生", len(student_ids))
+
+
+def capture_student(sender, instance, **kwargs) -> Dict[str, Any]:
+    return {"student_id": instance.student_id}
+
+
+@batched(prepare=capture_student)
+def exams_changed(sender, using, calls, **kwargs):
+    """Exam的post_save/post_delete, 事务提交后一次同步所有涉及的学生"""
+    sync_students(using, (call["student_id"] for call in calls))
+
+
+def klass_deleted(sender, instance, **kwargs) -> None:
+    Leaderboard.of_klass(instance.pk).delete()
+
+
+def school_deleted(sender, instance, **kwargs) -> None:
+    Leaderboard.of_school(instance.pk).delete()
+
+
+def get_databases() -> List[str]:
+    return get_shards() if is_sharding_enabled() else ["default"]
+
+
+def iter_scoped_totals(chunk_size: int = 10000) -> Iterator[Tuple[int, int, int, int]]:
+    """所有班级成员和总分: (student_id, klass_id, school_id, total), 没有考试的学生不返回"""
+    total = Exam.objects.filter(student_id=OuterRef("student_id")).values(
+        "student_id").annotate(total=Sum("score")).values("total")
+    # django-stubs 不认识中间表上 annotate 出来的字段
+    queryset = Student.klass_set.through.objects.annotate(
+        total=Subquery(total)).filter(total__isnull=False).values_list(  # type: ignore[misc]
+        "student_id", "klass_id", "klass__school_id", "total")
+    yield from FanOut(queryset, get_databases()).iterator(chunk_size=chunk_size)
+
+
+def iter_totals(chunk_size: int = 10000) -> Iterator[Tuple[int, int]]:
+    queryset = Exam.objects.values("student_id").annotate(
+        total=Sum("score")).order_by().values_list("student_id", "total")
+    yield from FanOut(queryset, get_databases()).iterator(chunk_size=chunk_size)
+
+
+def rebuild(batch_size: int = 10000) -> int:
+    """
+    流式读取总分, 每batch_size个成员用一个pipeline写入临时key, 全部写完后一起RENAME替换
+    返回上榜的学生数量
+    """
+    tmp_keys: Set[str] = set()
+    count = 0
+    # 同一个榜的成员合并成一条ZADD
+    buffer: Dict[str, Dict[int, int]] = {}
+    buffered = 0
+
+    def flush() -> None:
+        pipeline = REDIS.pipeline(transaction=False)
+        for tmp_key, mapping in buffer.items():
+            if tmp_key not in tmp_keys:
+                tmp_keys.add(tmp_key)
+                pipeline.delete(tmp_key)
+            pipeline.zadd(tmp_key, mapping)
+        pipeline.execute()
+        buffer.clear()
+
+    def zadd(key: str, student_id: int, total: int) -> None:
+        nonlocal buffered
+        buffer.setdefault(key + ":tmp", {})[student_id] = total
+        buffered += 1
+        if buffered >= batch_size:
+            flush()
+            buffered = 0
+
+    for student_id, total in iter_totals(batch_size):
+        zadd(Leaderboard.of_global().key, student_id, total)
+        count += 1
+    memberships: Dict[int, Memberships] = {}
+    for student_id, klass_id, school_id, total in iter_scoped_totals(batch_size):
+        klasses, schools = memberships.setdefault(student_id, (set(), set()))
+        if school_id not in schools:
+            zadd(Leaderboard.of_school(school_id).key, student_id, total)
+        zadd(Leaderboard.of_klass(klass_id).key, student_id, total)
+        klasses.add(klass_id)
+        schools.add(school_id)
+    flush()
+    memberships_tmp = MEMBERSHIPS_KEY + ":tmp"
+    REDIS.delete(memberships_tmp)
+    items = list(memberships.items())
+    for start in range(0, len(items), batch_size):
+        REDIS.hset(memberships_tmp, mapping={
+            student_id: dump_memberships(value)
+            for student_id, value in items[start:start + batch_size]
+        })
+    if items:
+        tmp_keys.add(memberships_tmp)
+    old_keys = {
+        key.decode() for key in REDIS.scan_iter(PREFIX + "*", count=1000)
+        if not key.endswith(b":tmp")
+    }
+    pipeline = REDIS.pipeline()
+    for tmp_key in tmp_keys:
+        pipeline.rename(tmp_key, tmp_key[:-len(":tmp")])
+    stale = old_keys - {tmp_key[:-len(":tmp")] for tmp_key in tmp_keys}
+    if stale:
+        pipeline.delete(*stale)
+    pipeline.execute()
+    LOGGER.info("重建排行榜: %d 个学生, %d 个榜, 删除 %d 个旧的榜", count, len(tmp_keys), len(stale))
+    return count
+
+
+def compare(board: Leaderboard, expected: Dict[int, int]) -> Set[int]:
+    """返回分数不一致, 缺失或多出来的学生"""
+    actual = dict(board.scan())
+    drift = {
+        student_id for student_id, total in expected.items()
+        if actual.get(student_id) != total
+    }
+    drift.update(actual.keys() - expected.keys())
+    if drift:
+        LOGGER.warning("%s 和数据库不一致: %d 个学生", board.key, len(drift))
+    return drift
+
+
+def check(chunk_size: int = 10000) -> Set[int]:
+    """
+    和数据库对比所有的榜, 返回不一致的学生
+    需要把每个榜读到内存里, 只适合离线检查
+    """
+    drift = compare(Leaderboard.of_global(), dict(iter_totals(chunk_size)))
+    scoped: Dict[str, Dict[int, int]] = {}
+    for student_id, klass_id, school_id, total in iter_scoped_totals(chunk_size):
+        scoped.setdefault(Leaderboard.of_klass(klass_id).key, {})[student_id] = total
+        scoped.setdefault(Leaderboard.of_school(school_id).key, {})[student_id] = total
+    for key in REDIS.scan_iter(PREFIX + "*", count=1000):
+        key = key.decode()
+        if key.startswith((PREFIX + "school:", PREFIX + "klass:")) and not key.endswith(":tmp"):
+            scoped.setdefault(key, {})
+    for key, expected in scoped.items():
+        drift.update(compare(Leaderboard(key), expected))
+    return drift
+
+
+def fix(student_ids: Iterable[int]) -> None:
+    databases: Dict[str, List[int]] = {}
+    for student_id in student_ids:
+        alias = shard_for_pk(student_id) if is_sharding_enabled() else "default"
+        databases.setdefault(alias, []).append(student_id)
+    for alias, pks in databases.items():
+        for start in range(0, len(pks), 10000):
+            sync_students(alias, pks[start:start + 10000])
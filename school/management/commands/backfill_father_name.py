@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+
+from school.models.relations import Child, update_father_name
+from school.planner import plan_ranges
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "按主键范围批量回填Child.father_name, 每个范围一条UPDATE"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("-b", "--batch-size", type=int, default=10000, help="每个范围多少行")
+
+    def handle(self, *args, batch_size=10000, **kwargs):
+        start = time.time()
+        rows = 0
+        for index, (low, high) in enumerate(plan_ranges(Child.objects.all(), chunk_rows=batch_size)):
+            # 每个范围单独提交, 不会长时间锁住整张表
+            with transaction.atomic():
+                rows += update_father_name(Child.objects.filter(pk__gte=low, pk__lte=high))
+            LOGGER.debug("第 %d 个范围 %d => %d, 累计更新 %d 行", index, low, high, rows)
+        end = time.time()
+        LOGGER.info("更新 %d 行, 耗时: %.2f, ops: %.1f", rows, end - start, rows / (end - start))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+ORM和缓存的性能测试, 场景见 school/bench.py
+
+    python3 manage.py bench --list
+    python3 manage.py bench  # 所有场景, 结果写到 log/bench/<时间>.json
+    python3 manage.py bench pk_get cache_get --repeat 5000 --output baseline.json
+    python3 manage.py bench --compare baseline.json  # p50慢了20%以上的场景报错退出
+    python3 manage.py bench --input new.json --compare baseline.json  # 不重新跑, 只比较两个文件
+"""
+
+
+import datetime
+import logging
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from school import bench
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.3f}ms"
+
+
+class Command(BaseCommand):
+
+    help = "按场景测试ORM和缓存的延迟分位数, 结果存成json, 可以和之前的结果比较"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("scenarios", nargs="*", help="默认全部")
+        parser.add_argument("--list", action="store_true", help="列出所有场景")
+        parser.add_argument("--repeat", type=int, help="每个场景计时多少次, 默认用场景自己的")
+        parser.add_argument("--warmup", type=int, help="计时前先执行多少次, 默认用场景自己的")
+        parser.add_argument("--output", type=Path, help="结果写到哪里, 默认 log/bench/<时间>.json")
+        parser.add_argument("--input", type=Path, help="不跑测试, 直接读这个结果文件")
+        parser.add_argument("--compare", type=Path, help="和这个结果文件比较")
+        parser.add_argument("--threshold", type=float, default=bench.THRESHOLD, help="p50慢了多少算退化")
+
+    def handle(
+            self, *args, scenarios=(), list=False, repeat=None, warmup=None,  # pylint: disable=redefined-builtin
+            output=None, input=None, compare=None, threshold=bench.THRESHOLD, **kwargs):
+        if list:
+            for name, scenario in bench.SCENARIOS.items():
+                LOGGER.info("%-16s %s", name, scenario.description)
+            return
+        if repeat is not None and repeat < 1:
+            raise CommandError("--repeat 至少是1")
+        if warmup is not None and warmup < 0:
+            raise CommandError("--warmup 不能是负数")
+        unknown = set(scenarios) - set(bench.SCENARIOS)
+        if unknown:
+            raise CommandError(f"没有这些场景: {', '.join(sorted(unknown))}, 用 --list 查看")
+        if input:
+            data = bench.load(input)
+        else:
+            data = {"meta": bench.get_meta(), "results": {}}
+            for name in scenarios or bench.SCENARIOS:
+                try:
+                    stats = bench.run_scenario(name, repeat, warmup)
+                except bench.Skip as error:
+                    LOGGER.warning("跳过 %s: %s", name, error)
+                    continue
+                data["results"][name] = stats
+                LOGGER.info(
+                        "%-16s p50: %s, p95: %s, p99: %s, %.0f rows/s (%d次, 每次%d行)",
+                        name, format_ms(stats["p50"]), format_ms(stats["p95"]), format_ms(stats["p99"]),
+                        stats["rows_per_sec"], stats["repeat"], stats["size"])
+            output = output or Path("log") / "bench" / f"{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+            bench.save(data, output)
+            LOGGER.info("结果写入 %s", output)
+        if not compare:
+            return
+        baseline = bench.load(compare)
+        LOGGER.info("和 %s (git: %s) 比较:", compare, baseline["meta"].get("git"))
+        regressions = []
+        for item in bench.compare(data["results"], baseline["results"], threshold):
+            log = LOGGER.warning if item["status"] == "regression" else LOGGER.info
+            log(
+                    "%-16s %-11s p50: %s => %s (%.2f倍), p95: %s => %s",
+                    item["name"], item["status"],
+                    format_ms(item["baseline_p50"]), format_ms(item["p50"]), item["ratio"],
+                    format_ms(item["baseline_p95"]), format_ms(item["p95"]))
+            if item["status"] == "regression":
+                regressions.append(item["name"])
+        if regressions:
+            raise CommandError(f"性能退化: {', '.join(regressions)}")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from typing import Dict, Optional
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from school import taskstats
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def format_percentiles(values: Dict[float, Optional[float]]) -> str:
+    return " ".join(f"p{round(key * 100)}={format_seconds(value)}" for key, value in values.items())
+
+
+class Command(BaseCommand):
+
+    help = "celery任务的排队时间, 执行时间的p50/p95/p99, 吞吐量和没有意义的结果写入"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("--task", action="append", help="只看这些任务, 默认全部")
+        parser.add_argument("--minutes", type=int, default=5, help="按最近几分钟算吞吐量")
+        parser.add_argument("--reset", action="store_true", help="清空统计数据")
+
+    def handle(self, *args, task=None, minutes=5, reset=False, **kwargs):
+        if reset:
+            taskstats.reset()
+            LOGGER.info("已清空celery任务统计")
+            return
+        names = task or taskstats.get_names()
+        if not names:
+            LOGGER.info("还没有任务统计数据")
+            return
+        throughput = taskstats.get_throughput(names, minutes)
+        wasted = []
+        for name in names:
+            stats = taskstats.get_stats(name)
+            LOGGER.info(
+                    "%s: %d 次, 失败 %d 次, 最近%d分钟 %.1f 次/分钟",
+                    name, stats["count"], stats["failure"], minutes, throughput[name])
+            LOGGER.info(
+                    "    排队: 平均 %s %s",
+                    format_seconds(stats["wait_avg"]), format_percentiles(stats["wait"]))
+            LOGGER.info(
+                    "    执行: 平均 %s %s",
+                    format_seconds(stats["run_avg"]), format_percentiles(stats["run"]))
+            if stats["none_results"]:
+                wasted.append(stats)
+        for stats in sorted(wasted, key=lambda item: item["none_results"], reverse=True):
+            LOGGER.warning(
+                    "%s 写了 %d 次结果backend, 其中 %d 次返回None, 可以设置 ignore_result=True",
+                    stats["name"], stats["result_writes"], stats["none_results"])
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from school import leaderboard
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "检查排行榜和数据库是否一致"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("--fix", action="store_true", help="按数据库重新同步不一致的学生")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="每次从数据库读多少行")
+
+    def handle(self, *args, fix=False, chunk_size=10000, **kwargs):
+        drift = leaderboard.check(chunk_size=chunk_size)
+        LOGGER.info("不一致的学生: %d 个", len(drift))
+        if not drift:
+            return
+        LOGGER.info("例如: %s", sorted(drift)[:10])
+        if not fix:
+            raise CommandError(f"排行榜和数据库不一致: {len(drift)} 个学生")
+        leaderboard.fix(drift)
+        drift = leaderboard.check(chunk_size=chunk_size)
+        LOGGER.info("修复后不一致的学生: %d 个", len(drift))
@@ -3,35 +3,152 @@
 # Xiang Wang <ramwin@qq.com>
 
 
-import time
+import io
 import logging
+import time
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Tuple
+
 from faker import Faker
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections
+from django.utils import timezone
 
 from school.models import Student
+from school.sharding import get_shards
 
 
 LOGGER = logging.getLogger(__name__)
+NAMES: List[str] = []
+
+
+class RowStream(io.TextIOBase):
+    """
+    把生成器包装成只读文件给 COPY FROM STDIN 用
+    内存里最多只有一个batch
+    """
+
+    def __init__(self, batches: Iterator[str]):
+        super().__init__()
+        self.batches = batches
+        self.buffer = ""
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> str:
+        while size is None or size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.batches)
+            except StopIteration:
+                break
+        if size is None or size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+
+def init_worker(names: List[str]) -> None:
+    global NAMES  # pylint: disable=global-statement
+    NAMES = names
+    connections.close_all()
+
+
+def generate_batches(start: int, count: int, batch_size: int, timer: List[float]) -> Iterator[str]:
+    """
+    按batch生成 COPY 的text格式数据, 生成耗时累加到timer[0]
+    """
+    now = timezone.now().isoformat()
+    for batch_start in range(start, start + count, batch_size):
+        begin = time.perf_counter()
+        batch_end = min(batch_start + batch_size, start + count)
+        batch = "".join(
+            f"{NAMES[i % len(NAMES)]}\t{now}\t{i % 20}\t{{}}\n"
+            for i in range(batch_start, batch_end)
+        )
+        timer[0] += time.perf_counter() - begin
+        yield batch
+
+
+def copy_students(args: Tuple[str, int, int, int]) -> Tuple[int, float, float]:
+    """
+    单个进程用一条COPY写入count个学生
+    返回: 行数, 生成耗时, 总耗时
+    """
+    alias, start, count, batch_size = args
+    timer = [0.0]
+    begin = time.perf_counter()
+    connection = connections[alias]
+    table = connection.ops.quote_name(Student._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} (name, update_datetime, age, info) FROM STDIN",
+            RowStream(generate_batches(start, count, batch_size, timer)),
+        )
+    return count, timer[0], time.perf_counter() - begin
+
+
+def bulk_create_students(args: Tuple[str, int, int, int]) -> Tuple[int, float, float]:
+    alias, start, count, batch_size = args
+    generate_duration = 0.0
+    begin = time.perf_counter()
+    for batch_start in range(start, start + count, batch_size):
+        generate_begin = time.perf_counter()
+        students = [
+            Student(name=NAMES[i % len(NAMES)], age=i % 20, info={})
+            for i in range(batch_start, min(batch_start + batch_size, start + count))
+        ]
+        generate_duration += time.perf_counter() - generate_begin
+        Student.objects.using(alias).bulk_create(students)
+    return count, generate_duration, time.perf_counter() - begin
 
 
 class Command(BaseCommand):
 
-    def handle(self, *args, **kwargs):
+    help = "批量创建学生, 用来准备性能测试数据"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("-n", "--count", type=int, default=1000, help="创建多少个学生")
+        parser.add_argument("-b", "--batch-size", type=int, default=1000, help="每批多少行")
+        parser.add_argument("-j", "--workers", type=int, default=1, help="多少个进程并行写入")
+        parser.add_argument(
+                "--mode", choices=["bulk", "copy"], default="bulk",
+                help="bulk: bulk_create; copy: COPY FROM STDIN")
+        parser.add_argument("--name-pool", type=int, default=10000, help="预先用faker生成多少个名字")
+        parser.add_argument(
+                "--sharded", action="store_true",
+                help="把进程平均分给所有分片, 主键由分片的序列生成, 见 shard_sequences")
+
+    def handle(
+            self, *args, count=1000, batch_size=1000, workers=1,
+            mode="bulk", name_pool=10000, sharded=False, **kwargs):
+        if count <= 0 or workers <= 0 or batch_size <= 0:
+            raise CommandError("--count, --workers, --batch-size 都必须大于0")
         faker = Faker("zh-cn")
-        iteration_count = 1
-        bulk_size = 1000
-        LOGGER.info("创建 %d 个学生", iteration_count * bulk_size)
+        names = [faker.name() for _ in range(min(name_pool, count) or 1)]
+        databases = get_shards() if sharded else ["default"]
+        LOGGER.info("创建 %d 个学生, 模式: %s, 进程数: %d, 数据库: %s", count, mode, workers, databases)
+        chunk = -(-count // workers)
+        tasks = [
+            (databases[index % len(databases)], start, min(chunk, count - start), batch_size)
+            for index, start in enumerate(range(0, count, chunk))
+        ]
+        func = copy_students if mode == "copy" else bulk_create_students
+        connections.close_all()
         start = time.time()
-        for _ in range(iteration_count):
-            students = []
-            for _ in range(bulk_size):
-                students.append(
-                        Student(
-                            name=faker.name(),
-                            info={},
-                        )
-                )
-            Student.objects.bulk_create(students)
+        rows, generate_duration, total_duration = 0, 0.0, 0.0
+        with Pool(workers, initializer=init_worker, initargs=(names,)) as p:
+            for result in p.imap_unordered(func, tasks):
+                rows += result[0]
+                generate_duration += result[1]
+                total_duration += result[2]
         end = time.time()
-        LOGGER.info("耗时: %d, ops: %s", end - start, bulk_size * iteration_count / (end-start))
+        insert_duration = total_duration - generate_duration
+        LOGGER.info("耗时: %.2f, ops: %.1f", end - start, rows / (end - start))
+        LOGGER.info(
+                "    生成: %.2f 进程秒, %.1f rows/s/进程",
+                generate_duration, rows / generate_duration if generate_duration else 0)
+        LOGGER.info(
+                "    写入: %.2f 进程秒, %.1f rows/s/进程",
+                insert_duration, rows / insert_duration if insert_duration else 0)
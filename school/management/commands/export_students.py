@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import sys
+import time
+
+import psutil
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from school import export
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "流式导出学生, 支持ndjson/csv, gzip和选择字段"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("-o", "--output", default="-", help="输出文件, - 表示标准输出")
+        parser.add_argument("--format", choices=export.FORMATS, default="ndjson")
+        parser.add_argument("--fields", help="逗号分隔的字段, 默认全部")
+        parser.add_argument("--with-exams", action="store_true", help="带上考试次数/总分/最高分")
+        parser.add_argument("--gzip", action="store_true", help="gzip压缩")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="服务端游标每次读多少行")
+
+    def handle(
+            self, *args, output="-", format="ndjson",  # pylint: disable=redefined-builtin
+            fields=None, with_exams=False, gzip=False, chunk_size=2000, **kwargs):
+        counter = export.Counter()
+        try:
+            chunks = export.export(
+                    export.get_queryset(with_exams),
+                    file_format=format,
+                    fields=fields.split(",") if fields else None,
+                    with_exams=with_exams,
+                    compress=gzip,
+                    chunk_size=chunk_size,
+                    counter=counter)
+        except ValueError as error:
+            raise CommandError(str(error)) from error
+        process = psutil.Process()
+        peak = process.memory_info().rss
+        start = time.time()
+        file = sys.stdout.buffer if output == "-" else open(output, "wb")  # pylint: disable=consider-using-with
+        try:
+            for chunk in chunks:
+                file.write(chunk)
+                if counter.rows % (chunk_size * 50) == 0:
+                    peak = max(peak, process.memory_info().rss)
+        finally:
+            if file is not sys.stdout.buffer:
+                file.close()
+        end = time.time()
+        peak = max(peak, process.memory_info().rss)
+        LOGGER.info(
+                "导出 %d 行, %.1f MB, 耗时: %.2f, ops: %.1f, 内存峰值: %.1f MB",
+                counter.rows, counter.bytes / 2 ** 20, end - start,
+                counter.rows / (end - start), peak / 2 ** 20)
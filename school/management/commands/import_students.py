@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from school import ingest
+from school.models.managers import UPSERT_BATCH, UPSERT_FIELDS
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "从ndjson/csv(可以gzip)流式导入学生, 按code不区分大小写新建或更新"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("input", help="输入文件, - 表示标准输入")
+        parser.add_argument("--format", choices=ingest.FORMATS, help="默认按后缀判断, 其他都是ndjson")
+        parser.add_argument(
+                "--update-fields", default=",".join(UPSERT_FIELDS),
+                help="已存在的学生更新哪些字段, 逗号分隔, 空字符串表示只新建不更新")
+        parser.add_argument("-b", "--batch-size", type=int, default=UPSERT_BATCH, help="每批多少行")
+        parser.add_argument("--database", default="default")
+        parser.add_argument("--max-errors", type=int, default=20, help="最多打印多少条错误")
+
+    def handle(
+            self, *args, input="-", format=None,  # pylint: disable=redefined-builtin
+            update_fields="", batch_size=UPSERT_BATCH, database="default", max_errors=20, **kwargs):
+        file_format = format or ingest.get_format(input)
+        fields = [name for name in update_fields.split(",") if name]
+        totals = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "rejected": 0}
+        start = time.time()
+        with ingest.open_input(input) as file:
+            try:
+                results = ingest.ingest(
+                        ingest.read_rows(file, file_format), update_fields=fields,
+                        batch_size=batch_size, using=database)
+                for index, result in enumerate(results):
+                    for key in totals:
+                        totals[key] += result[key]
+                    for line, detail in result["errors"]:
+                        if max_errors > 0:
+                            max_errors -= 1
+                            LOGGER.warning("第 %d 行不合法: %s", line + 1, detail)
+                    LOGGER.debug("第 %d 批: %s", index, {
+                        key: value for key, value in result.items() if key != "errors"})
+            except ValueError as error:
+                raise CommandError(str(error)) from error
+        end = time.time()
+        LOGGER.info(
+                "导入 %(rows)d 行, 新建 %(created)d, 更新 %(updated)d, "
+                "没有变化 %(unchanged)d, 不合法 %(rejected)d", totals)
+        LOGGER.info("耗时: %.2f, ops: %.1f", end - start, totals["rows"] / (end - start))
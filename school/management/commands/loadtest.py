@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比同步(WSGI)和异步(ASGI)接口的压测
+
+    ./run_gunicorn.sh  # 8000, WSGI
+    ./run_uvicorn.sh  # 8001, ASGI
+    python3 manage.py loadtest \\
+        http://127.0.0.1:8000/api/students/{pk}/ \\
+        http://127.0.0.1:8001/api/async/students/{pk}/ \\
+        -c 64 -d 10
+
+url里的 {pk} 每次随机换成一个存在的学生主键
+客户端是asyncio写的HTTP/1.1, 每个并发一个keep-alive连接, 服务端关闭连接就重新连
+"""
+
+
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from school.bench import percentile, sample_pks
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Connection:
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: asyncio.StreamReader
+        self.writer: asyncio.StreamWriter
+        self.connected = False
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.connected = True
+
+    def close(self) -> None:
+        if self.connected:
+            self.writer.close()
+            self.connected = False
+
+    async def get(self, path: str) -> int:
+        """返回状态码, 读完整个body"""
+        if not self.connected:
+            await self.connect()
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n\r\n".encode())
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("服务端关闭了连接")
+        headers: Dict[str, str] = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip().lower()
+        if "content-length" in headers:
+            await self.reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            await self.reader.read()
+            self.close()
+        if headers.get("connection") == "close":
+            self.close()
+        return int(status_line.split()[1])
+
+
+async def worker(
+        url: str, pks: List[int], end: float,
+        latencies: List[float], statuses: Dict[int, int]) -> None:
+    parts = urlsplit(url)
+    connection = Connection(parts.hostname or "127.0.0.1", parts.port or 80)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    try:
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            try:
+                status = await connection.get(path.replace("{pk}", str(random.choice(pks))))
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                connection.close()
+                status = 0
+            latencies.append(time.perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+    finally:
+        connection.close()
+
+
+async def run(url: str, pks: List[int], concurrency: int, duration: float) -> Tuple[List[float], Dict[int, int]]:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    end = time.perf_counter() + duration
+    await asyncio.gather(*(
+        worker(url, pks, end, latencies, statuses) for _ in range(concurrency)
+    ))
+    return latencies, statuses
+
+
+class Command(BaseCommand):
+
+    help = "用asyncio压测多个url, 对比每秒请求数和延迟分位数"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("urls", nargs="+", help="url里的 {pk} 会换成随机的学生主键")
+        parser.add_argument("-c", "--concurrency", type=int, default=64)
+        parser.add_argument("-d", "--duration", type=float, default=10, help="每个url压测多少秒")
+        parser.add_argument("--warmup", type=float, default=1, help="正式压测前预热多少秒")
+        parser.add_argument("--pks", type=int, default=1000, help="随机取多少个学生主键")
+
+    def handle(self, *args, urls=(), concurrency=64, duration=10.0, warmup=1.0, pks=1000, **kwargs):
+        pk_list = sample_pks(pks) or [1]
+        for url in urls:
+            if warmup:
+                asyncio.run(run(url, pk_list, concurrency, warmup))
+            latencies, statuses = asyncio.run(run(url, pk_list, concurrency, duration))
+            latencies.sort()
+            LOGGER.info(
+                    "%s 并发 %d: %d 个请求, %.1f req/s, p50: %.1fms, p95: %.1fms, p99: %.1fms, max: %.1fms, 状态码: %s",
+                    url, concurrency, len(latencies), len(latencies) / duration,
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+                    percentile(latencies, 0.99) * 1000, latencies[-1] * 1000, statuses)
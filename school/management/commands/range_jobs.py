@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from school.jobs import MAX_ATTEMPTS, RangeJob
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "查看celery按主键范围执行的任务进度, 不指定job_id时列出最近的任务"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("job_id", nargs="?")
+        parser.add_argument("-n", type=int, default=10, help="列出最近多少个任务")
+        parser.add_argument("--redistribute", action="store_true", help="重新派发超时和失败的范围")
+        parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+        parser.add_argument("--wait", action="store_true", help="等待完成, 期间自动重新派发")
+
+    def handle(
+            self, *args, job_id=None, n=10, redistribute=False,
+            max_attempts=MAX_ATTEMPTS, wait=False, **kwargs):
+        jobs = [RangeJob(job_id)] if job_id else RangeJob.recent(n)
+        for job in jobs:
+            try:
+                progress = job.wait(max_attempts=max_attempts) if wait else job.progress()
+            except ValueError as error:
+                if job_id:
+                    raise CommandError(str(error)) from error
+                continue
+            LOGGER.info(
+                    "%s %s: %s, 超时 %d, %d 行, 耗时: %.2f, rows/sec: %.1f",
+                    progress["job_id"], progress["handler"], progress["counts"], progress["stale"],
+                    progress["rows"], progress["duration"], progress["rows_per_sec"])
+            for worker, stats in sorted(progress["workers"].items()):
+                LOGGER.info(
+                        "    %s: %d 个范围, %d 行, %.1f rows/sec",
+                        worker, stats["ranges"], stats["rows"], stats["rows_per_sec"])
+            if redistribute and not wait:
+                job.redistribute(max_attempts)
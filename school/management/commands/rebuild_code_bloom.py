@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandParser
+from django.db.models.functions import Lower
+
+from school.bloom import STUDENT_CODES
+from school.models import Student
+from school.sharding import FanOut, get_shards, is_sharding_enabled
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "流式扫描所有学生的code, 重建布隆过滤器"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("--error-rate", type=float, default=STUDENT_CODES.ERROR_RATE, help="期望的误判率")
+        parser.add_argument("--chunk-size", type=int, default=10000, help="每次从数据库读多少行")
+        parser.add_argument("--stats", action="store_true", help="只输出统计信息, 不重建")
+
+    def handle(self, *args, error_rate=None, chunk_size=10000, stats=False, **kwargs):
+        if not stats:
+            queryset = Student.objects.exclude(code=None).values_list(Lower("code"), flat=True)
+            databases = get_shards() if is_sharding_enabled() else ["default"]
+            fan_out = FanOut(queryset, databases)
+            start = time.time()
+            count = STUDENT_CODES.rebuild(
+                    fan_out.iterator(chunk_size=chunk_size),
+                    capacity=fan_out.count(),
+                    error_rate=error_rate)
+            end = time.time()
+            LOGGER.info("重建完成: %d 个code, 耗时: %.2f, ops: %.1f", count, end - start, count / (end - start))
+        for key, value in STUDENT_CODES.stats().items():
+            LOGGER.info("    %s: %s", key, value)
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from school import leaderboard
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "从数据库流式读取考试总分, 重建所有排行榜"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("-b", "--batch-size", type=int, default=10000, help="每次读多少行, pipeline多少条命令")
+
+    def handle(self, *args, batch_size=10000, **kwargs):
+        start = time.time()
+        count = leaderboard.rebuild(batch_size=batch_size)
+        end = time.time()
+        LOGGER.info("耗时: %.2f, ops: %.1f", end - start, count / (end - start))
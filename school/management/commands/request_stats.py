@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from typing import Dict, Optional
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from school import requeststats
+
+
+LOGGER = logging.getLogger(__name__)
+ORDERS = {
+    "db": "db_total",
+    "time": "duration_total",
+    "queries": "queries_avg",
+    "cache": "cache_calls_avg",
+    "n_plus_one": "n_plus_one",
+}
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def format_percentiles(values: Dict[float, Optional[float]]) -> str:
+    return " ".join(f"p{round(key * 100)}={format_seconds(value)}" for key, value in values.items())
+
+
+class Command(BaseCommand):
+
+    help = "抽样统计的请求里, SQL/redis调用最多, 最慢, 有N+1查询的视图"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("--order", choices=sorted(ORDERS), default="db", help="db和time按总耗时排序")
+        parser.add_argument("--top", type=int, default=10)
+        parser.add_argument("--shapes", type=int, default=3, help="每个视图显示几条重复的SQL")
+        parser.add_argument("--reset", action="store_true", help="清空统计数据")
+
+    def handle(self, *args, order="db", top=10, shapes=3, reset=False, **kwargs):
+        if reset:
+            requeststats.reset()
+            LOGGER.info("已清空请求统计")
+            return
+        requeststats.flush()
+        names = requeststats.get_names()
+        if not names:
+            LOGGER.info("还没有请求统计数据, 检查 REQUEST_STATS_SAMPLE")
+            return
+        items = sorted(
+            (requeststats.get_stats(name) for name in names),
+            key=lambda item: item[ORDERS[order]], reverse=True,
+        )
+        for stats in items[:top]:
+            LOGGER.info(
+                    "%s: 抽样 %d 次, 平均 %s %s, 数据库总耗时 %s",
+                    stats["view"], stats["count"], format_seconds(stats["duration_avg"]),
+                    format_percentiles(stats["time"]), format_seconds(stats["db_total"]))
+            LOGGER.info(
+                    "    每次请求: %.1f 条SQL %s, %.1f 次redis %s",
+                    stats["queries_avg"], format_seconds(stats["db_avg"]),
+                    stats["cache_calls_avg"], format_seconds(stats["cache_avg"]))
+            if stats["n_plus_one"]:
+                LOGGER.warning("    %d 次请求有N+1查询:", stats["n_plus_one"])
+                for shape, count in list(stats["shapes"].items())[:shapes]:
+                    LOGGER.warning("        %d次: %s", count, shape)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from school.models import Exam, Klass, Student
+from school.sharding import get_shards
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "设置每个分片的自增序列, 第i个分片只生成 (pk - 1) % 分片数 == i 的主键"
+
+    def handle(self, *args, **kwargs):
+        shards = get_shards()
+        tables = [
+            Student._meta.db_table,
+            Exam._meta.db_table,
+            Klass.students.through._meta.db_table,
+        ]
+        for index, alias in enumerate(shards):
+            with connections[alias].cursor() as cursor:
+                for table in tables:
+                    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+                    sequence = cursor.fetchone()[0]
+                    cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+                    max_id = cursor.fetchone()[0]
+                    start = max_id + 1 + (index - max_id) % len(shards)
+                    cursor.execute(
+                        f"ALTER SEQUENCE {sequence} INCREMENT BY {len(shards)} RESTART WITH {start}")
+                    LOGGER.info("%s %s: 从 %d 开始, 步长 %d", alias, sequence, start, len(shards))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+看一个新进程启动时时间花在哪里
+
+    python3 manage.py startup_profile  # import django 和 django.setup() 的分阶段计时, app的ready(), 最慢的包和模块
+    python3 manage.py startup_profile --command student_grow  # 再加上加载这个命令
+    python3 manage.py startup_profile --wall check --repeat 10  # 不带importtime执行 manage.py check 10次的耗时
+"""
+
+
+import logging
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from school import startup
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = "在子进程里分析冷启动: 每个模块的import时间和每个app的ready()时间"
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument("--command", help="同时加载这个管理命令")
+        parser.add_argument("--top", type=int, default=20, help="显示最慢的多少个包和模块")
+        parser.add_argument("--wall", nargs="+", help="执行 manage.py 这些参数多少次, 统计总耗时")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, command=None, top=20, wall=None, repeat=5, **kwargs):
+        if wall:
+            values = startup.get_wall_time(wall, repeat)
+            summary = startup.summarize_wall_time(values)
+            LOGGER.info(
+                    "manage.py %s %d 次: min %.0fms, 中位数 %.0fms, max %.0fms",
+                    " ".join(wall), repeat,
+                    summary["min"] * 1000, summary["median"] * 1000, summary["max"] * 1000)
+            return
+        result = startup.profile(command)
+        LOGGER.info(
+                "阶段耗时(-X importtime 下会偏慢): %s, 共 %d 个模块",
+                ", ".join(f"{key}: {value * 1000:.0f}ms" for key, value in result["timings"].items()),
+                result["module_count"])
+        for label, seconds in list(result["ready"].items())[:top]:
+            if seconds >= 0.0005:
+                LOGGER.info("    %s.ready(): %.1fms", label, seconds * 1000)
+        imports = result["imports"]
+        LOGGER.info("自身import耗时最多的包:")
+        for package, self_us in list(startup.group_by_package(imports).items())[:top]:
+            LOGGER.info("    %-30s %7.1fms", package, self_us / 1000)
+        LOGGER.info("累计import耗时最多的模块(包含它import的其他模块, 会有重叠):")
+        for item in sorted(imports, key=lambda item: item.cumulative_us, reverse=True)[:top]:
+            LOGGER.info("    %-50s %7.1fms  深度 %d", item.name, item.cumulative_us / 1000, item.depth)
@@ -5,31 +5,35 @@
 
 import logging
 
-from django.db import connections
-from django_commands.commands import LargeQuerysetMutiProcessHandlerCommand, PROCESS_INITED
+from django.db.models import F
 
+from school.commands import WriteBackCommand
+from school.sharding import FanOut
 from school.models import Student
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-class Command(LargeQuerysetMutiProcessHandlerCommand):
-    queryset = Student.objects.all().none()
+class Command(WriteBackCommand[Student]):
+    queryset = Student.objects.all()
+    WRITE_FIELDS = ["age"]
 
-    def get_tasks(self):
-        self.queryset.update(age=0)
-        return super().get_tasks()
+    def get_ranges(self):
+        for alias in self.get_databases():
+            self.queryset.using(alias).update(age=0)
+        return super().get_ranges()
 
     @classmethod
-    def handle_single_task(cls, duration):
-        LOGGER.info("处理范围: %d => %d", duration[0], duration[1])
-        student: Student
-        for student in cls.queryset.filter(pk__gte=duration[0], pk__lte=duration[1]).order_by("pk"):
-            # LOGGER.info("%d", student.id)
-            student.age += 1
-            student.save()
+    def get_update_expressions(cls):
+        return {"age": F("age") + 1}
+
+    @classmethod
+    def handle_object(cls, obj: Student) -> None:
+        obj.age += 1
 
     def handle(self, *args, **kwargs):
         super().handle(*args, **kwargs)
-        LOGGER.info(Student.objects.exclude(age=1))
+        LOGGER.info(
+                "没有长大的学生数量: %d",
+                FanOut(Student.objects.exclude(age=1), self.get_databases()).count())
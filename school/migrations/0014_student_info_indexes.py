@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:41
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.operations
+import django.db.models.fields.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # 学生表很大, 建索引的时候不锁写入
+    atomic = False
+
+    dependencies = [
+        ('school', '0013_child_father_name_parent_name'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name='student',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['info'], name='student_info_gin', opclasses=['jsonb_path_ops']),
+        ),
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name='student',
+            index=models.Index(django.db.models.fields.json.KeyTransform('grade', 'info'), name='student_info_grade'),
+        ),
+    ]
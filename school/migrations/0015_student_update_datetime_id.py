@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:05
+
+import django.contrib.postgres.operations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # 学生表很大, 建索引的时候不锁写入
+    atomic = False
+
+    dependencies = [
+        ('school', '0014_student_info_indexes'),
+    ]
+
+    operations = [
+        django.contrib.postgres.operations.AddIndexConcurrently(
+            model_name='student',
+            index=models.Index(fields=['update_datetime', 'id'], name='student_update_datetime_id'),
+        ),
+    ]
@@ -5,13 +5,21 @@
 
 import logging
 
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models.fields.json import KeyTransform
 from django.db.models.constraints import UniqueConstraint
 from django.db.models.functions import Lower
 from django.db.models.signals import post_save, post_delete
 
 from eventlog.mixins import LoggerMixin
 
+from school.bloom import add_code, forget_code
+from school.sharding import ShardedQuerySet
+from school.signals import batched
+
+from .managers import CachedManager, StudentQuerySet, invalidate_instance
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -24,6 +32,10 @@ class Tag(LoggerMixin, models.Model):
     text = models.TextField(default="", blank=True)
 
 
+# info里经常按值查询的key, 每个key一个表达式索引, 见 StudentQuerySet.info_key_eq
+INFO_INDEXED_KEYS = ["grade"]
+
+
 class Student(models.Model):
     name = models.TextField()
     code = models.CharField(max_length=15, null=True)
@@ -32,10 +44,24 @@ class Student(models.Model):
     age = models.IntegerField(default=0)
     info = models.JSONField()
 
+    objects = StudentQuerySet.as_manager()
+    cached = CachedManager["Student"]()
+
+    INFO_INDEXED_KEYS = INFO_INDEXED_KEYS
+
     class Meta:
         constraints = [
                 UniqueConstraint(Lower("code"), name="code_unique"),
         ]
+        indexes = [
+                # 按更新时间翻页, 见 school.pagination.KeysetPagination
+                models.Index(fields=["update_datetime", "id"], name="student_update_datetime_id"),
+                GinIndex(fields=["info"], opclasses=["jsonb_path_ops"], name="student_info_gin"),
+                *[
+                    models.Index(KeyTransform(key, "info"), name=f"student_info_{key}")
+                    for key in INFO_INDEXED_KEYS
+                ],
+        ]
 
     @classmethod
     def post_save(cls, instance: "Student", **kwargs):
@@ -46,6 +72,8 @@ class Exam(models.Model):
     student = models.ForeignKey(Student, on_delete=models.CASCADE)
     score = models.IntegerField()
 
+    objects = ShardedQuerySet.as_manager()
+
 
 class TestUnsetField(models.Model):
     # 不设置的话默认是None
@@ -53,12 +81,13 @@ class TestUnsetField(models.Model):
     int_field = models.IntegerField()
 
 
-def log(instance, using, **kwargs):
-    LOGGER.info("剩余数量: %d", Student.objects.filter(
+@batched
+def log(sender, using, calls, **kwargs):
+    LOGGER.info("剩余数量: %d", Student.objects.using(using).filter(
         id__lte=30
     ).count())
     LOGGER.info(using)
-    LOGGER.info("删除的时候也有id: %d", instance.id)
+    LOGGER.info("删除的时候也有id: %s", [call["instance"].id for call in calls])
 
 
 class DateTimeModel(models.Model):
@@ -67,3 +96,7 @@ class DateTimeModel(models.Model):
 
 # post_save.connect(Student.post_save, Student)
 post_delete.connect(log, Student)
+post_save.connect(invalidate_instance, Student)
+post_delete.connect(invalidate_instance, Student)
+post_save.connect(add_code, Student)
+post_delete.connect(forget_code, Student)
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+用redis做读穿透缓存的manager
+
+    Student.cached.get(pk=1)
+    Student.cached.get_many([1, 2, 3])
+    await Student.cached.aget_many([1, 2, 3])  # 异步视图用, 和同步的共用缓存
+
+key: school:<app_label.model>:v<VERSION>:<generation>:<pk>
+    VERSION: 字段变了就加1, 旧的缓存全部作废
+    generation: redis里的计数器, queryset.update()时加1, 所有缓存一起作废
+    bulk_update 和 WriteBack 知道改了哪些主键, 只把这些key换成墓碑, 不加generation
+单个对象的save/delete把自己的key换成一个很短的墓碑 TOMBSTONE, 墓碑存在的时候读到的是未命中, 也不会写回
+没命中的时候查数据库, 再用 FILL_SCRIPT 写回: generation变了就不写, key已经存在(包括墓碑)也不写
+    避免 读数据库 -> 别的事务提交并删除缓存 -> 把旧数据写回缓存 的竞争
+"""
+
+
+import io
+import itertools
+import logging
+import pickle
+from typing import Any, Dict, FrozenSet, Generic, Iterable, List, Optional, Sequence, Set, Tuple, TypeVar
+
+from django.db import NotSupportedError, connections, models, transaction
+from django.db.models.functions import Lower
+from django.utils import timezone
+from rest_framework.exceptions import ErrorDetail
+
+from school.bloom import STUDENT_CODES
+from school.consts import REDIS, get_async_redis, register_script
+from school.sharding import (
+    FanOut, ShardedQuerySet, get_shards, get_using, group_by_shard, is_sharding_enabled, shard_for_pk,
+)
+from school.writeback import copy_value, get_column, get_concrete_field
+
+
+LOGGER = logging.getLogger(__name__)
+M = TypeVar("M", bound=models.Model)
+VERSION = 1
+GET_MANY_BATCH = 1000
+UPSERT_BATCH = 5000
+UPSERT_FIELDS = ["name", "height", "age", "info"]
+# 墓碑保留的秒数, 要比 读数据库到写回缓存 的时间长
+TOMBSTONE_TIMEOUT = 10
+
+READ_SCRIPT = register_script("""
+local generation = redis.call('GET', KEYS[1]) or '0'
+local keys = {}
+for i = 2, #ARGV do
+    keys[i - 1] = ARGV[1] .. generation .. ':' .. ARGV[i]
+end
+local values = redis.call('MGET', unpack(keys))
+local hit = 0
+for i = 1, #keys do
+    if values[i] == '-' then
+        values[i] = false
+    elseif values[i] then
+        hit = hit + 1
+    end
+end
+redis.call('HINCRBY', KEYS[2], 'hit', hit)
+redis.call('HINCRBY', KEYS[2], 'miss', #keys - hit)
+return {generation, values}
+""")
+DELETE_SCRIPT = register_script("""
+local generation = redis.call('GET', KEYS[1]) or '0'
+for i = 3, #ARGV do
+    redis.call('SET', ARGV[1] .. generation .. ':' .. ARGV[i], '-', 'EX', ARGV[2])
+end
+return #ARGV - 2
+""")
+FILL_SCRIPT = register_script("""
+local generation = redis.call('GET', KEYS[1]) or '0'
+if generation ~= ARGV[2] then
+    return 0
+end
+local written = 0
+for i = 4, #ARGV, 2 do
+    if redis.call('SET', ARGV[1] .. generation .. ':' .. ARGV[i], ARGV[i + 1], 'EX', ARGV[3], 'NX') then
+        written = written + 1
+    end
+end
+return written
+""")
+
+
+def get_prefix(model) -> str:
+    return f"school:{model._meta.label_lower}:v{VERSION}:"
+
+
+def bump_generation(model) -> None:
+    """作废这个model的所有缓存"""
+    REDIS.incr(get_prefix(model) + "generation")
+
+
+def delete_cache(model, *pks: Any) -> None:
+    """把这些主键的缓存换成墓碑"""
+    if not pks:
+        return
+    prefix = get_prefix(model)
+    DELETE_SCRIPT(keys=[prefix + "generation"], args=[prefix, TOMBSTONE_TIMEOUT, *pks])
+
+
+def invalidate_instance(sender, instance, using, **kwargs) -> None:
+    """
+    post_save/post_delete 的receiver
+    马上删一次, 事务提交后再删一次, 都换成墓碑, 避免提交前后被别的进程读到旧数据又写回缓存
+    新建的对象不会有缓存, 不用删
+    """
+    if kwargs.get("created"):
+        return
+    pk = instance.pk
+    delete_cache(sender, pk)
+    transaction.on_commit(lambda: delete_cache(sender, pk), using=using)
+
+
+class CachedQuerySet(models.QuerySet):
+    # bulk_update 知道改了哪些主键, 里面的update不用作废所有缓存
+    invalidate_all = True
+
+    def _clone(self):
+        clone = super()._clone()
+        clone.invalidate_all = self.invalidate_all
+        return clone
+
+    def update(self, **kwargs) -> int:
+        rows = super().update(**kwargs)
+        if rows and self.invalidate_all:
+            self.invalidate()
+        return rows
+
+    update.alters_data = True  # type: ignore[attr-defined]
+
+    def bulk_update(self, objs, fields, batch_size=None) -> int:
+        """只删这些对象的缓存"""
+        objs = list(objs)
+        queryset = self.all()
+        queryset.invalidate_all = False
+        rows = super(CachedQuerySet, queryset).bulk_update(objs, fields, batch_size=batch_size)
+        if rows:
+            self.invalidate([obj.pk for obj in objs])
+        return rows
+
+    bulk_update.alters_data = True  # type: ignore[attr-defined]
+
+    def invalidate(self, pks: Optional[Sequence[Any]] = None) -> None:
+        """pks是None的时候作废所有缓存, 否则只删这些主键的, 和save一样提交后再删一次"""
+        if pks is None:
+            bump_generation(self.model)
+            transaction.on_commit(lambda: bump_generation(self.model), using=self.db)
+            return
+        delete_cache(self.model, *pks)
+        transaction.on_commit(lambda: delete_cache(self.model, *pks), using=self.db)
+
+
+# django-stubs 给每个QuerySet生成的 as_manager 返回类型不一样, 多继承的时候会报错
+class StudentQuerySet(ShardedQuerySet, CachedQuerySet):  # type: ignore[override]
+    """
+    info上的查询只提供能用上索引的写法
+        info_contains: GIN(jsonb_path_ops) 索引, 支持 @>
+        info_key_eq: INFO_INDEXED_KEYS 里的key用表达式索引, 其他key退化成 @>
+    """
+
+    def info_contains(self, value: Dict[str, Any]) -> "StudentQuerySet":
+        return self.filter(info__contains=value)
+
+    def info_key_eq(self, key: str, value: Any) -> "StudentQuerySet":
+        if key in getattr(self.model, "INFO_INDEXED_KEYS", ()):
+            return self.filter(**{f"info__{key}": value})
+        return self.info_contains({key: value})
+
+    def update(self, **kwargs) -> int:
+        """改了code的话加入布隆过滤器, 没有post_save"""
+        if "code" not in kwargs:
+            return super().update(**kwargs)
+        self._for_write = True
+        code = kwargs["code"]
+        if code is None or isinstance(code, str):
+            rows = super().update(**kwargs)
+            if rows and code:
+                STUDENT_CODES.add_on_commit([code.lower()], using=self.db)
+            return rows
+        # 表达式(比如bulk_update的Case)不知道新的值, 更新以后按主键读出来
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list("pk", flat=True))
+            rows = super().update(**kwargs)
+            codes = list(self.model._base_manager.using(self.db).filter(
+                    pk__in=pks, code__isnull=False).values_list(Lower("code"), flat=True))
+        STUDENT_CODES.add_on_commit(codes, using=self.db)
+        return rows
+
+    update.alters_data = True  # type: ignore[attr-defined]
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        STUDENT_CODES.add_on_commit((obj.code.lower() for obj in objs if obj.code), using=self.db)
+        return objs
+
+    bulk_create.alters_data = True  # type: ignore[attr-defined]
+
+    def codes_exist(self, codes: Iterable[str]) -> Set[str]:
+        """
+        返回已经存在的code(保留传入时的大小写), 比较时不区分大小写
+        先用布隆过滤器排除肯定不存在的, 只有可能存在的才查数据库
+        """
+        lowered: Dict[str, List[str]] = {}
+        for code in codes:
+            lowered.setdefault(code.lower(), []).append(code)
+        candidates = [
+            code for code, probable in zip(lowered, STUDENT_CODES.contains(lowered))
+            if probable
+        ]
+        found: Set[str] = set()
+        for start in range(0, len(candidates), GET_MANY_BATCH):
+            queryset = self.annotate(code_lower=Lower("code")).filter(
+                code_lower__in=candidates[start:start + GET_MANY_BATCH],
+            ).values_list("code_lower", flat=True)
+            if is_sharding_enabled():
+                found.update(*FanOut(queryset, get_shards()).map(list))
+            else:
+                found.update(queryset)
+        STUDENT_CODES.record(len(lowered), len(candidates), len(found))
+        LOGGER.debug("检查 %d 个code, 查询数据库 %d 个, 存在 %d 个", len(lowered), len(candidates), len(found))
+        return {code for lower in found for code in lowered[lower]}
+
+    def upsert_by_code(
+            self, rows: Iterable[Any],
+            update_fields: Optional[Sequence[str]] = None,
+            batch_size: int = UPSERT_BATCH) -> List[Dict[str, Any]]:
+        """
+        按code(不区分大小写)批量新建或更新, 每批:
+            StudentUpdateSerializer批量校验, 不查数据库
+            COPY到临时表, 每种更新字段的组合一条 INSERT ... ON CONFLICT (lower(code)) DO UPDATE
+        update_fields: 已存在的学生更新哪些字段, 默认全部; 行里没有的字段不更新, 值没变的行不会更新
+            没有name的行只能更新, code不存在的算不合法
+        rows: 每行一个dict, 不是dict的行(比如解析失败的原文)算不合法
+        返回每批的 rows, created, updated, unchanged, rejected, errors(行号, 错误)
+        """
+        # serializers 依赖 models, 只能在这里导入
+        from school.serializers import StudentUpdateSerializer  # pylint: disable=import-outside-toplevel
+        if is_sharding_enabled() and get_using(self) is None:
+            raise NotSupportedError("分片以后code只在单个分片内唯一, 需要用 using() 指定分片")
+        update_fields = UPSERT_FIELDS if update_fields is None else list(update_fields)
+        if set(update_fields) - set(UPSERT_FIELDS):
+            raise ValueError(f"不支持更新的字段: {set(update_fields) - set(UPSERT_FIELDS)}")
+        rows = iter(rows)
+        results: List[Dict[str, Any]] = []
+        offset = 0
+        while batch := list(itertools.islice(rows, batch_size)):
+            serializer = StudentUpdateSerializer(data=batch, many=True)
+            serializer.is_valid(raise_exception=True)
+            values, provided, rejected = self._reject_unnamed(serializer)
+            result = {
+                "rows": len(batch),
+                **self._upsert(values, provided, update_fields),
+                "rejected": len(rejected),
+                "errors": [(offset + index, detail) for index, detail in rejected],
+            }
+            results.append(result)
+            offset += len(batch)
+            LOGGER.debug("upsert %d 行: %s", len(batch), {
+                key: value for key, value in result.items() if key != "errors"})
+        return results
+
+    upsert_by_code.alters_data = True  # type: ignore[attr-defined]
+
+    def _reject_unnamed(self, serializer) -> Tuple[List[Dict[str, Any]], List[FrozenSet[str]], List[Tuple[int, Any]]]:
+        """没有name的行要新建的话不合法, 有这种行的时候查一次哪些code已经存在"""
+        rows = list(zip(serializer.validated_data, serializer.provided, serializer.indexes))
+        unnamed = {value["code"].lower() for value, present, _ in rows if "name" not in present}
+        rejected = list(serializer.rejected)
+        if not unnamed:
+            return serializer.validated_data, serializer.provided, rejected
+        existing = set(self.model._base_manager.using(self.db).annotate(
+                lower_code=Lower("code")).filter(lower_code__in=unnamed).values_list("lower_code", flat=True))
+        required = serializer.child.fields["name"].error_messages["required"]
+        kept = []
+        for value, present, index in rows:
+            if "name" in present or value["code"].lower() in existing:
+                kept.append((value, present))
+            else:
+                rejected.append((index, {"name": [ErrorDetail(required, code="required")]}))
+        rejected.sort(key=lambda item: item[0])
+        return [value for value, _ in kept], [present for _, present in kept], rejected
+
+    def _upsert(
+            self, values: List[Dict[str, Any]], provided: List[FrozenSet[str]],
+            update_fields: List[str]) -> Dict[str, Any]:
+        """
+        按每行提供了哪些要更新的字段分组, 同一批只COPY一次, 每组一条 INSERT ... ON CONFLICT
+        文件导入的时候每行的列一样, 只有一组
+        """
+        if not values:
+            return {"created": 0, "updated": 0, "unchanged": 0}
+        self._for_write = True
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        opts = self.model._meta
+        table = quote(opts.db_table)
+        staging = quote(f"_upsert_{opts.db_table}")
+        fields = [get_concrete_field(self.model, name) for name in ["code", *UPSERT_FIELDS]]
+        columns = ", ".join(quote(get_column(field)) for field in fields)
+        # 更新的字段 => 组号
+        groups: Dict[Tuple[str, ...], int] = {}
+        buffer = io.StringIO()
+        for value, present in zip(values, provided):
+            group = groups.setdefault(tuple(name for name in update_fields if name in present), len(groups))
+            buffer.write("\t".join([
+                str(group),
+                *(copy_value(field, value.get(field.name, field.get_default())) for field in fields),
+            ]))
+            buffer.write("\n")
+        buffer.seek(0)
+        code = quote(get_column(get_concrete_field(self.model, "code")))
+        update_datetime = quote(get_column(get_concrete_field(self.model, "update_datetime")))
+
+        def get_conflict(names: Tuple[str, ...]) -> str:
+            if not names:
+                return "DO NOTHING"
+            targets = [quote(get_column(get_concrete_field(self.model, name))) for name in names]
+            return (
+                "DO UPDATE SET "
+                + ", ".join(f"{column} = EXCLUDED.{column}" for column in [*targets, update_datetime])
+                + f" WHERE ROW({', '.join(f't.{column}' for column in targets)})"
+                + f" IS DISTINCT FROM ROW({', '.join(f'EXCLUDED.{column}' for column in targets)})"
+            )
+
+        inserted: List[bool] = []
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging} (_group integer, "
+                + ", ".join(f"{quote(get_column(field))} {field.db_type(connection)}" for field in fields)
+                + ") ON COMMIT DROP"
+            )
+            cursor.copy_expert(f"COPY {staging} (_group, {columns}) FROM STDIN", buffer)
+            for names, group in groups.items():
+                # 冲突目标要和 code_unique 约束的表达式一致
+                cursor.execute(
+                    f"INSERT INTO {table} AS t ({columns}, {update_datetime})"
+                    f" SELECT {columns}, %s FROM {staging} WHERE _group = %s"
+                    f" ON CONFLICT (LOWER({code})) {get_conflict(names)}"
+                    " RETURNING xmax = 0",
+                    [timezone.now(), group],
+                )
+                inserted.extend(row[0] for row in cursor.fetchall())
+            cursor.execute(f"DROP TABLE {staging}")
+        created = sum(inserted)
+        updated = len(inserted) - created
+        # 绕过了ORM, 没有post_save, 手动更新布隆过滤器和缓存
+        STUDENT_CODES.add_on_commit((value["code"].lower() for value in values), using=self.db)
+        if updated:
+            self.invalidate()
+        return {"created": created, "updated": updated, "unchanged": len(values) - len(inserted)}
+
+
+class CachedManager(models.Manager, Generic[M]):
+    TIMEOUT = 3600
+
+    @property
+    def prefix(self) -> str:
+        return get_prefix(self.model)
+
+    def get_queryset(self) -> models.QuerySet:
+        """和 objects 用同一个QuerySet, 点查询会按分片路由"""
+        return self.model._default_manager.get_queryset()
+
+    def get_db(self, pk: Any) -> str:
+        """缓存里读出来的对象属于哪个数据库, 以后save的时候要写回去"""
+        return shard_for_pk(pk) if is_sharding_enabled() else self.db
+
+    def get_missing(self, pks: List[Any]) -> List[models.QuerySet]:
+        """没命中的主键, 分片以后每个分片一个查询"""
+        queryset = self.get_queryset()
+        if not is_sharding_enabled():
+            return [queryset.filter(pk__in=pks)]
+        return [queryset.using(alias).filter(pk__in=group) for alias, group in group_by_shard(pks).items()]
+
+    def get(self, *args, **kwargs) -> M:
+        """只有按主键查询才走缓存"""
+        if args or len(kwargs) != 1 or not {"pk", self.model._meta.pk.name} & kwargs.keys():
+            return super().get(*args, **kwargs)
+        pk = self.model._meta.pk.to_python(next(iter(kwargs.values())))
+        result = self.get_many([pk])
+        if pk not in result:
+            raise self.model.DoesNotExist(
+                f"{self.model._meta.object_name} matching query does not exist.")
+        return result[pk]
+
+    def get_many(self, pks: Iterable[Any]) -> Dict[Any, M]:
+        """先MGET, 没命中的再一次性查数据库并写回缓存"""
+        pks = list(dict.fromkeys(self.model._meta.pk.to_python(pk) for pk in pks))
+        result: Dict[Any, M] = {}
+        for start in range(0, len(pks), GET_MANY_BATCH):
+            result.update(self._get_many(pks[start:start + GET_MANY_BATCH]))
+        return result
+
+    def _get_many(self, pks: List[Any]) -> Dict[Any, M]:
+        if not pks:
+            return {}
+        generation, values = READ_SCRIPT(
+            keys=[self.prefix + "generation", self.prefix + "stats"],
+            args=[self.prefix, *pks],
+        )
+        generation = generation.decode() if isinstance(generation, bytes) else generation
+        attnames = [field.attname for field in self.model._meta.concrete_fields]
+        result: Dict[Any, M] = {}
+        missing: List[Any] = []
+        for pk, value in zip(pks, values):
+            if value is None:
+                missing.append(pk)
+            else:
+                result[pk] = self.model.from_db(self.get_db(pk), attnames, pickle.loads(value))
+        if missing:
+            LOGGER.debug("缓存未命中: %s", missing)
+            objs = [obj for queryset in self.get_missing(missing) for obj in queryset]
+            if objs:
+                FILL_SCRIPT(keys=[self.prefix + "generation"], args=self._fill_args(generation, objs))
+            result.update((obj.pk, obj) for obj in objs)
+        return {pk: result[pk] for pk in pks if pk in result}
+
+    def _fill_args(self, generation: str, objs: List[M]) -> List[Any]:
+        """FILL_SCRIPT 的参数: 前缀, 读到的generation, 过期时间, 然后是 主键, 值 交替"""
+        attnames = [field.attname for field in self.model._meta.concrete_fields]
+        args: List[Any] = [self.prefix, generation, self.TIMEOUT]
+        for obj in objs:
+            args.append(obj.pk)
+            args.append(pickle.dumps(
+                tuple(getattr(obj, attname) for attname in attnames),
+                protocol=pickle.HIGHEST_PROTOCOL,
+            ))
+        return args
+
+    async def aget(self, *args, **kwargs) -> M:
+        if args or len(kwargs) != 1 or not {"pk", self.model._meta.pk.name} & kwargs.keys():
+            return await super().aget(*args, **kwargs)
+        pk = self.model._meta.pk.to_python(next(iter(kwargs.values())))
+        result = await self.aget_many([pk])
+        if pk not in result:
+            raise self.model.DoesNotExist(
+                f"{self.model._meta.object_name} matching query does not exist.")
+        return result[pk]
+
+    async def aget_many(self, pks: Iterable[Any]) -> Dict[Any, M]:
+        """和get_many一样, 用异步的redis连接, 没命中的用异步ORM查询"""
+        pks = list(dict.fromkeys(self.model._meta.pk.to_python(pk) for pk in pks))
+        result: Dict[Any, M] = {}
+        for start in range(0, len(pks), GET_MANY_BATCH):
+            result.update(await self._aget_many(pks[start:start + GET_MANY_BATCH]))
+        return result
+
+    async def _aget_many(self, pks: List[Any]) -> Dict[Any, M]:
+        if not pks:
+            return {}
+        client = get_async_redis()
+        generation, values = await READ_SCRIPT.acall(
+            client,
+            keys=[self.prefix + "generation", self.prefix + "stats"],
+            args=[self.prefix, *pks],
+        )
+        generation = generation.decode() if isinstance(generation, bytes) else generation
+        attnames = [field.attname for field in self.model._meta.concrete_fields]
+        result: Dict[Any, M] = {}
+        missing: List[Any] = []
+        for pk, value in zip(pks, values):
+            if value is None:
+                missing.append(pk)
+            else:
+                result[pk] = self.model.from_db(self.get_db(pk), attnames, pickle.loads(value))
+        if missing:
+            LOGGER.debug("缓存未命中: %s", missing)
+            objs = [obj for queryset in self.get_missing(missing) async for obj in queryset]
+            if objs:
+                await FILL_SCRIPT.acall(
+                    client, keys=[self.prefix + "generation"], args=self._fill_args(generation, objs))
+            result.update((obj.pk, obj) for obj in objs)
+        return {pk: result[pk] for pk in pks if pk in result}
+
+    def stats(self) -> Dict[str, int]:
+        """所有进程累计的命中/未命中次数"""
+        data = REDIS.hgetall(self.prefix + "stats")
+        return {
+            "hit": int(data.get(b"hit", 0)),
+            "miss": int(data.get(b"miss", 0)),
+        }
+
+    def reset_stats(self) -> None:
+        REDIS.delete(self.prefix + "stats")
+
+    def invalidate(self, pk: Optional[Any] = None) -> None:
+        if pk is None:
+            bump_generation(self.model)
+        else:
+            delete_cache(self.model, pk)
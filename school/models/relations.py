@@ -3,15 +3,28 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+import json
 import logging
+import threading
+from typing import Any, Dict, List, Set, Tuple
 
 from django.db import models
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models import OuterRef, Subquery
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
 
-from .base import Student, School
+from school import leaderboard, roster
+from school.consts import REDIS
+from school.sharding import replicate, replicate_delete
+from school.signals import batched
+
+from .base import Exam, Student, School
 
 
 LOGGER = logging.getLogger(__name__)
+KLASS_STUDENTS_STREAM = "school:klass:students:changes"
+KLASS_STUDENTS_STREAM_MAXLEN = 100000
+# pre_remove 时查出来的真正删除的成员, 在 post_remove 里取出来
+REMOVING = threading.local()
 
 
 class Parent(models.Model):
@@ -21,34 +34,163 @@ class Parent(models.Model):
 class Child(models.Model):
     mother = models.ForeignKey(Parent, on_delete=models.CASCADE, related_name="children")
     father = models.ForeignKey(Parent, on_delete=models.PROTECT, related_name="+")
+    # 冗余字段, 保存前从father取, father改名后由 parent_renamed 批量更新
     father_name = models.TextField(null=True)
 
 
+def get_father_name() -> Subquery:
+    return Subquery(Parent.objects.filter(pk=OuterRef("father_id")).values("name")[:1])
+
+
+def update_father_name(queryset: models.QuerySet) -> int:
+    """一条 UPDATE ... SET father_name = (子查询), 已经一致的行不更新"""
+    return queryset.exclude(father_name=get_father_name()).update(father_name=get_father_name())
+
+
+def fill_father_name(sender, instance: Child, raw: bool = False, **kwargs) -> None:
+    """Child的pre_save, father已经加载了就不用再查"""
+    if raw:
+        return
+    if Child.father.is_cached(instance):
+        instance.father_name = instance.father.name
+    else:
+        instance.father_name = Parent.objects.using(instance._state.db or "default").filter(
+                pk=instance.father_id).values_list("name", flat=True).first()
+
+
+@batched
+def parent_renamed(sender, using, calls, **kwargs):
+    """Parent的post_save, 一个事务里保存的所有Parent用一条UPDATE"""
+    parent_ids = {call["instance"].pk for call in calls if not call["created"]}
+    if not parent_ids:
+        return
+    rows = update_father_name(Child.objects.using(using).filter(father_id__in=parent_ids))
+    LOGGER.debug("%d 个家长保存, 更新了 %d 个孩子的father_name", len(parent_ids), rows)
+
+
 class Klass(models.Model):
     school = models.ForeignKey(School, on_delete=models.CASCADE)
     students = models.ManyToManyField(Student)
 
 
-def students_changed(
-        instance, reverse, action,
-        model, pk_set,
-        *args, **kwargs):
-    LOGGER.debug(
-            "变更了: %s, %s, %s, model: %s, pk_set: %s",
-            reverse, action, instance,
-            model, pk_set,
-    )
+def capture_students(sender, using, instance, **kwargs) -> Dict[str, Any]:
+    """
+    signal发生时马上执行, 只保留主键
+    clear的时候pk_set是None, 要在pre_clear的时候查出来
+    remove的时候pk_set是传进来的所有主键, 不在班级里的也有, 在pre_remove的时候和中间表取交集, 给post_remove用
+    删除学生时中间表是直接删除的, 不会有m2m_changed, 在Student的pre_delete里查出来当作反向remove
+    """
+    action = kwargs.get("action", "pre_delete")
+    reverse = kwargs.get("reverse", True)
+    pk_set = kwargs.get("pk_set")
+    through = Klass.students.through
+    if action in ["pre_clear", "pre_delete"]:
+        if reverse:
+            pk_set = through.objects.using(using).filter(
+                    student_id=instance.pk).values_list("klass_id", flat=True)
+        else:
+            pk_set = through.objects.using(using).filter(
+                    klass_id=instance.pk).values_list("student_id", flat=True)
+    elif action in ["pre_remove", "post_remove"]:
+        removing: Dict[Tuple[str, bool, int], Set[int]] = REMOVING.__dict__.setdefault("pk_sets", {})
+        key = (using, reverse, instance.pk)
+        if action == "pre_remove":
+            owner, target = ("student_id", "klass_id") if reverse else ("klass_id", "student_id")
+            pk_set = removing[key] = set(through.objects.using(using).filter(
+                    **{owner: instance.pk, f"{target}__in": pk_set}).values_list(target, flat=True))
+        else:
+            pk_set = removing.pop(key, pk_set)
+    return {
+        "instance": instance.pk,
+        "action": action,
+        "reverse": reverse,
+        "pk_set": set(pk_set or ()),
+    }
+
+
+def compact_students_changes(calls: List[Dict[str, Any]]) -> Dict[int, Tuple[Set[int], Set[int]]]:
+    """
+    把一个事务里的所有变更合并成每个班级的净变化
+    return: {klass_id: (added_pks, removed_pks)}
+    """
+    diff: Dict[int, Tuple[Set[int], Set[int]]] = {}
+    for call in calls:
+        if call["action"] not in ["post_add", "post_remove", "pre_clear", "pre_delete"]:
+            continue
+        if call["reverse"]:
+            pairs = [(klass_id, call["instance"]) for klass_id in call["pk_set"]]
+        else:
+            pairs = [(call["instance"], student_id) for student_id in call["pk_set"]]
+        for klass_id, student_id in pairs:
+            added, removed = diff.setdefault(klass_id, (set(), set()))
+            if call["action"] == "post_add":
+                if student_id in removed:
+                    removed.discard(student_id)
+                else:
+                    added.add(student_id)
+            elif student_id in added:
+                added.discard(student_id)
+            else:
+                removed.add(student_id)
+    return {
+        klass_id: (added, removed)
+        for klass_id, (added, removed) in diff.items()
+        if added or removed
+    }
+
+
+@batched(prepare=capture_students)
+def students_changed(sender, using, calls, **kwargs):
+    """事务提交后, 每个班级的净变化写一条到redis stream"""
+    diff = compact_students_changes(calls)
+    LOGGER.debug("班级学生变更: %d 次signal合并成 %d 个班级", len(calls), len(diff))
+    if not diff:
+        return
+    roster.apply(using, diff)
+    leaderboard.sync_students(using, {
+        student_id
+        for added, removed in diff.values()
+        for student_id in added | removed
+    })
+    pipeline = REDIS.pipeline(transaction=False)
+    for klass_id, (added, removed) in diff.items():
+        pipeline.xadd(
+                KLASS_STUDENTS_STREAM,
+                {
+                    "klass": klass_id,
+                    "added": json.dumps(sorted(added)),
+                    "removed": json.dumps(sorted(removed)),
+                },
+                maxlen=KLASS_STUDENTS_STREAM_MAXLEN,
+                approximate=True,
+        )
+    pipeline.execute()
 
 
 class Lesson(models.Model):
     title = models.TextField()
 
-    @classmethod
-    def post_save(cls, *args, **kwargs):
-        LOGGER.info(kwargs)
+    @staticmethod
+    @batched
+    def post_save(sender, using, calls, **kwargs):
+        LOGGER.info(calls)
 
 
 # 监听Klass是没用的
 # m2m_changed.connect(students_changed, Klass)
 m2m_changed.connect(students_changed, Klass.students.through)
+pre_delete.connect(students_changed, Student)
 post_save.connect(Lesson.post_save, Lesson)
+pre_save.connect(fill_father_name, Child)
+post_save.connect(parent_renamed, Parent)
+# 分片以后School, Klass每个库都存一份
+post_save.connect(replicate, School)
+post_save.connect(replicate, Klass)
+post_delete.connect(replicate_delete, School)
+post_delete.connect(replicate_delete, Klass)
+post_save.connect(leaderboard.exams_changed, Exam)
+post_delete.connect(leaderboard.exams_changed, Exam)
+post_delete.connect(leaderboard.klass_deleted, Klass)
+post_delete.connect(leaderboard.school_deleted, School)
+post_delete.connect(roster.klass_deleted, Klass)
+post_delete.connect(roster.school_deleted, School)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+按 (update_datetime, id) 的keyset分页, 不用OFFSET, 翻到多少页都只扫描一页的索引
+
+    ?page_size=100&cursor=<上一页返回的next>
+
+分两步:
+    get_keys: 只查这一页的 (id, update_datetime), 走 student_update_datetime_id 索引
+    load_page: 按主键加载这一页的完整数据
+中间可以先用keys做条件请求的判断, 没有变化的话不用加载和序列化
+"""
+
+
+import base64
+import binascii
+import datetime
+import logging
+from typing import Any, List, Optional, Sequence, Tuple
+
+from django.db.models import F, QuerySet
+from django.db.models.fields.tuple_lookups import Tuple as Row, TupleGreaterThan
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+LOGGER = logging.getLogger(__name__)
+Key = Tuple[int, datetime.datetime]
+
+
+def encode_cursor(key: Key) -> str:
+    pk, update_datetime = key
+    return base64.urlsafe_b64encode(f"{update_datetime.isoformat()}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Key:
+    try:
+        update_datetime, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return int(pk), datetime.datetime.fromisoformat(update_datetime)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as error:
+        raise NotFound("无效的cursor") from error
+
+
+class KeysetPagination(BasePagination):
+    page_size = 100
+    max_page_size = 1000
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+
+    def __init__(self):
+        self.request: Optional[Request] = None
+        self.next_key: Optional[Key] = None
+
+    def get_page_size(self, request: Request) -> int:
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def get_keys(self, queryset: QuerySet, request: Request) -> List[Key]:
+        """这一页的 (id, update_datetime), 多查一行用来判断有没有下一页"""
+        self.request = request
+        size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        queryset = queryset.order_by("update_datetime", "id")
+        if cursor:
+            pk, update_datetime = decode_cursor(cursor)
+            queryset = queryset.filter(
+                TupleGreaterThan(Row(F("update_datetime"), F("id")), (update_datetime, pk)))
+        keys = list(queryset.values_list("id", "update_datetime")[:size + 1])
+        self.next_key = keys[size - 1] if len(keys) > size else None
+        return keys[:size]
+
+    def load_page(self, queryset: QuerySet, keys: Sequence[Key]) -> List[Any]:
+        objs = queryset.in_bulk([pk for pk, _ in keys])
+        return [objs[pk] for pk, _ in keys if pk in objs]
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.load_page(queryset, self.get_keys(queryset, request))
+
+    def get_next_link(self) -> Optional[str]:
+        if self.next_key is None or self.request is None:
+            return None
+        return replace_query_param(
+                self.request.build_absolute_uri(), self.cursor_query_param, encode_cursor(self.next_key))
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
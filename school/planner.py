@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+把queryset按主键拆成多个范围, 给多进程任务用
+
+    for start, end in plan_ranges(Student.objects.all(), chunk_rows=10000):
+        Student.objects.filter(pk__gte=start, pk__lte=end)
+
+strategy:
+    rows: 只扫一遍主键索引, 用ROW_NUMBER取每个范围的第一个主键, 每个范围的行数是准确的
+    width: 只查MIN/MAX和EXPLAIN的估算行数, 按主键均匀切分, 不扫表, 主键有空洞的话每个范围行数不均匀
+范围是边读边返回的, 不用等全部算完
+"""
+
+
+import json
+import logging
+import math
+from typing import Any, Dict, Iterator, Literal, Optional, Tuple
+
+from django.db import connections
+from django.db.models import Max, Min, QuerySet
+
+
+LOGGER = logging.getLogger(__name__)
+Strategy = Literal["rows", "width"]
+
+
+def explain(queryset: QuerySet) -> Dict[str, Any]:
+    """EXPLAIN的估算结果, 不会真的执行, 包含 Plan Rows 和 Plan Width"""
+    return json.loads(queryset.explain(format="json"))[0]["Plan"]
+
+
+def get_chunk_rows(queryset: QuerySet, chunk_rows: Optional[int], chunk_bytes: Optional[int]) -> int:
+    if chunk_rows:
+        return chunk_rows
+    if not chunk_bytes:
+        raise ValueError("chunk_rows 和 chunk_bytes 至少要设置一个")
+    width = explain(queryset)["Plan Width"] or 1
+    LOGGER.info("估算每行 %d 字节", width)
+    return max(1, chunk_bytes // width)
+
+
+def plan_ranges(
+        queryset: QuerySet,
+        chunk_rows: Optional[int] = None,
+        chunk_bytes: Optional[int] = None,
+        strategy: Strategy = "rows") -> Iterator[Tuple[int, int]]:
+    """返回 (起始主键, 结束主键), 两边都包含"""
+    queryset = queryset.order_by()
+    rows = get_chunk_rows(queryset, chunk_rows, chunk_bytes)
+    bounds = queryset.aggregate(start=Min("pk"), end=Max("pk"))
+    if bounds["start"] is None:
+        return
+    if strategy == "width":
+        yield from plan_width(queryset, rows, bounds["start"], bounds["end"])
+    else:
+        yield from plan_rows(queryset, rows, bounds["end"])
+
+
+def plan_width(queryset: QuerySet, rows: int, start: int, end: int) -> Iterator[Tuple[int, int]]:
+    count = max(1, explain(queryset)["Plan Rows"])
+    step = max(1, math.ceil((end - start + 1) * rows / count))
+    LOGGER.info("估算 %d 行, 主键 %d => %d, 每个范围 %d 个主键", count, start, end, step)
+    for value in range(start, end + 1, step):
+        yield value, min(value + step - 1, end)
+
+
+def plan_rows(queryset: QuerySet, rows: int, end: int) -> Iterator[Tuple[int, int]]:
+    pk_sql, params = queryset.values_list("pk").query.sql_with_params()
+    sql = (
+        "SELECT pk FROM ("
+        f"SELECT pk, ROW_NUMBER() OVER (ORDER BY pk) AS n FROM ({pk_sql}) AS t(pk)"
+        ") AS s WHERE MOD(n - 1, %s) = 0"
+    )
+    previous = None
+    with connections[queryset.db].chunked_cursor() as cursor:
+        cursor.execute(sql, (*params, rows))
+        for (value,) in cursor:
+            if previous is not None:
+                yield previous, value - 1
+            previous = value
+    if previous is not None:
+        yield previous, end
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+统计每个请求的SQL和redis/缓存调用, 发现N+1查询
+
+RequestStatsMiddleware: 按 REQUEST_STATS_SAMPLE 的概率抽样, 抽中的请求在contextvar里放一个 RequestStats
+    SQL: connection_created 的时候给每个数据库连接加上 execute_wrapper, 所以异步视图里 sync_to_async 的查询和分片的库也能统计到
+    redis: CACHES 的 REDIS_CLIENT_CLASS 是 InstrumentedRedis, django的cache和 school.consts.REDIS 都会统计
+        pipeline 算一次调用; 异步视图的 get_async_redis 用 AsyncInstrumentedRedis
+    没有抽中的请求和celery任务只多一次 contextvar 的读取
+    同一个请求里相同结构的SQL(IN里面参数个数不同也算一样) 执行了 REQUEST_STATS_REPEAT 次以上算N+1, 写一条WARNING
+    REQUEST_STATS_HEADER 打开的话返回 Server-Timing 头, 浏览器开发者工具里可以直接看到
+    流式响应的内容在视图返回以后才生成, 迭代完(或者客户端断开)的时候再统计, 没有 Server-Timing 头
+
+每个进程先在内存里按视图累计, 每隔 FLUSH_INTERVAL 秒用一个pipeline写入redis, 和 school.taskstats 一样
+    异步的请求在线程里写redis, 不阻塞事件循环
+key:
+    school:request:stats:names  集合, 所有出现过的视图, "方法 路由"
+    school:request:stats:<view>  hash
+        count, queries, db_sum, cache_calls, cache_sum, duration_sum, n_plus_one
+        time:<桶>  请求耗时的直方图, 桶和 taskstats 一样
+    school:request:shapes:<view>  hash, 重复执行的SQL => 出现N+1的请求数
+"""
+
+
+import contextvars
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, cast
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from redis import Redis
+from redis import asyncio as aioredis
+from redis.client import Pipeline
+
+from school.consts import REDIS
+from school.taskstats import get_bucket, get_percentiles
+
+
+LOGGER = logging.getLogger(__name__)
+PREFIX = "school:request:"
+NAMES_KEY = PREFIX + "stats:names"
+FLUSH_INTERVAL = 1.0
+# 存到redis里的SQL最长多少
+SHAPE_LENGTH = 500
+PLACEHOLDERS = re.compile(r"\((?:%s, )+%s\)")
+
+LOCK = threading.Lock()
+BUFFER: Dict[str, Dict[str, float]] = {}
+SHAPES: Dict[Tuple[str, str], int] = {}
+LAST_FLUSH = [time.time()]
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.cache_calls = 0
+        self.cache_time = 0.0
+        # 原始的SQL => 次数, 请求结束的时候才合并成结构, 每次查询不用跑正则
+        self.sqls: Dict[str, int] = {}
+
+    def get_repeated(self, repeat: int) -> Dict[str, int]:
+        shapes: Dict[str, int] = {}
+        for sql, count in self.sqls.items():
+            shape = get_shape(sql)
+            shapes[shape] = shapes.get(shape, 0) + count
+        return {shape: count for shape, count in shapes.items() if count >= repeat}
+
+
+CURRENT: "contextvars.ContextVar[Optional[RequestStats]]" = contextvars.ContextVar(
+    "school_request_stats", default=None)
+
+
+def get_shape(sql: str) -> str:
+    """IN (%s, %s, %s) 参数个数不同也算同一个结构"""
+    return PLACEHOLDERS.sub("(%s, ...)", sql)[:SHAPE_LENGTH]
+
+
+def query_wrapper(execute: Callable, sql: str, params: Any, many: bool, context: Dict[str, Any]) -> Any:
+    stats = CURRENT.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_time += time.perf_counter() - start
+        stats.queries += 1
+        stats.sqls[sql] = stats.sqls.get(sql, 0) + 1
+
+
+def install_wrapper(sender, connection, **kwargs) -> None:
+    """connection_created 的时候调用, 重连以后 execute_wrappers 还在, 不要重复加"""
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+def add_cache_call(stats: RequestStats, start: float) -> None:
+    stats.cache_time += time.perf_counter() - start
+    stats.cache_calls += 1
+
+
+class InstrumentedPipeline(Pipeline):
+
+    def execute(self, raise_on_error: bool = True) -> List[Any]:
+        stats = CURRENT.get()
+        if stats is None:
+            return super().execute(raise_on_error)
+        start = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            add_cache_call(stats, start)
+
+
+class InstrumentedRedis(Redis):
+    """CACHES 里的 REDIS_CLIENT_CLASS"""
+
+    def execute_command(self, *args, **options):
+        stats = CURRENT.get()
+        if stats is None:
+            return super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            add_cache_call(stats, start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> Pipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class AsyncInstrumentedPipeline(aioredis.client.Pipeline):
+
+    async def execute(self, raise_on_error: bool = True) -> List[Any]:
+        stats = CURRENT.get()
+        if stats is None:
+            return await super().execute(raise_on_error)
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            add_cache_call(stats, start)
+
+
+class AsyncInstrumentedRedis(aioredis.Redis):
+
+    async def execute_command(self, *args, **options):
+        stats = CURRENT.get()
+        if stats is None:
+            return await super().execute_command(*args, **options)
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            add_cache_call(stats, start)
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None) -> aioredis.client.Pipeline:
+        return AsyncInstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def get_stats_key(view: str) -> str:
+    return f"{PREFIX}stats:{view}"
+
+
+def get_shapes_key(view: str) -> str:
+    return f"{PREFIX}shapes:{view}"
+
+
+def get_view(request: HttpRequest) -> str:
+    match = request.resolver_match
+    route = match.route if match is not None else "<unmatched>"
+    return f"{request.method} {route}"
+
+
+def incr(view: str, field: str, value: float = 1) -> None:
+    stats = BUFFER.setdefault(view, {})
+    stats[field] = stats.get(field, 0) + value
+
+
+def add(view: str, stats: RequestStats, duration: float) -> bool:
+    """累计到内存里, 返回是否该写redis了"""
+    repeated = stats.get_repeated(settings.REQUEST_STATS_REPEAT)
+    for shape, count in repeated.items():
+        LOGGER.warning("%s 可能有N+1查询, 同样的SQL执行了%d次: %s", view, count, shape)
+    with LOCK:
+        incr(view, "count")
+        incr(view, "queries", stats.queries)
+        incr(view, "db_sum", stats.db_time)
+        incr(view, "cache_calls", stats.cache_calls)
+        incr(view, "cache_sum", stats.cache_time)
+        incr(view, "duration_sum", duration)
+        incr(view, f"time:{get_bucket(duration)}")
+        if repeated:
+            incr(view, "n_plus_one")
+        for shape in repeated:
+            SHAPES[(view, shape)] = SHAPES.get((view, shape), 0) + 1
+        if time.time() - LAST_FLUSH[0] < FLUSH_INTERVAL:
+            return False
+        # 只让一个请求去写
+        LAST_FLUSH[0] = time.time()
+        return True
+
+
+def record(view: str, stats: RequestStats, duration: float) -> None:
+    if add(view, stats, duration):
+        flush()
+
+
+async def arecord(view: str, stats: RequestStats, duration: float) -> None:
+    if add(view, stats, duration):
+        await sync_to_async(flush, thread_sensitive=False)()
+
+
+def flush() -> None:
+    with LOCK:
+        buffer = dict(BUFFER)
+        shapes = dict(SHAPES)
+        BUFFER.clear()
+        SHAPES.clear()
+        LAST_FLUSH[0] = time.time()
+    if not buffer:
+        return
+    # 不算在当前请求的缓存调用里
+    token = CURRENT.set(None)
+    try:
+        pipeline = REDIS.pipeline(transaction=False)
+        pipeline.sadd(NAMES_KEY, *buffer)
+        for view, stats in buffer.items():
+            for field, value in stats.items():
+                if field.endswith("_sum"):
+                    pipeline.hincrbyfloat(get_stats_key(view), field, value)
+                else:
+                    pipeline.hincrby(get_stats_key(view), field, int(value))
+        for (view, shape), count in shapes.items():
+            pipeline.hincrby(get_shapes_key(view), shape, count)
+        pipeline.execute()
+    except Exception:  # pylint: disable=broad-exception-caught
+        # 统计失败不能影响请求
+        LOGGER.exception("写入请求统计失败")
+    finally:
+        CURRENT.reset(token)
+
+
+def get_server_timing(stats: RequestStats, duration: float) -> str:
+    return ", ".join([
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"',
+        f'cache;dur={stats.cache_time * 1000:.1f};desc="{stats.cache_calls} calls"',
+        f"total;dur={duration * 1000:.1f}",
+    ])
+
+
+def iterate(content: Iterable[bytes], view: str, stats: RequestStats) -> Iterator[bytes]:
+    """生成每一块的时候把stats放回contextvar, 迭代结束的时候统计"""
+    try:
+        iterator = iter(content)
+        while True:
+            token = CURRENT.set(stats)
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                CURRENT.reset(token)
+            yield chunk
+    finally:
+        record(view, stats, time.perf_counter() - stats.start)
+
+
+async def aiterate(content: AsyncIterable[bytes], view: str, stats: RequestStats) -> AsyncIterator[bytes]:
+    try:
+        iterator = aiter(content)
+        while True:
+            token = CURRENT.set(stats)
+            try:
+                chunk = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                CURRENT.reset(token)
+            yield chunk
+    finally:
+        await arecord(view, stats, time.perf_counter() - stats.start)
+
+
+class RequestStatsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+        self.sample: float = settings.REQUEST_STATS_SAMPLE
+        self.header: bool = settings.REQUEST_STATS_HEADER
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sample or random.random() >= self.sample:
+            return self.get_response(request)
+        stats = RequestStats()
+        token = CURRENT.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            CURRENT.reset(token)
+        if isinstance(response, StreamingHttpResponse):
+            self.wrap_streaming(request, response, stats)
+        else:
+            record(*self.finish(request, response, stats))
+        return response
+
+    async def __acall__(self, request: HttpRequest):
+        if not self.sample or random.random() >= self.sample:
+            return await self.get_response(request)
+        stats = RequestStats()
+        token = CURRENT.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            CURRENT.reset(token)
+        if isinstance(response, StreamingHttpResponse):
+            self.wrap_streaming(request, response, stats)
+        else:
+            await arecord(*self.finish(request, response, stats))
+        return response
+
+    def finish(self, request: HttpRequest, response: HttpResponse, stats: RequestStats) -> Tuple[str, RequestStats, float]:
+        duration = time.perf_counter() - stats.start
+        if self.header:
+            response["Server-Timing"] = get_server_timing(stats, duration)
+        return get_view(request), stats, duration
+
+    def wrap_streaming(self, request: HttpRequest, response: StreamingHttpResponse, stats: RequestStats) -> None:
+        view = get_view(request)
+        if response.is_async:
+            response.streaming_content = aiterate(cast(AsyncIterable[bytes], response.streaming_content), view, stats)
+        else:
+            response.streaming_content = iterate(cast(Iterable[bytes], response.streaming_content), view, stats)
+
+
+def get_names() -> List[str]:
+    return sorted(name.decode() for name in REDIS.smembers(NAMES_KEY))
+
+
+def get_stats(view: str, percentiles: Tuple[float, ...] = (0.5, 0.95, 0.99)) -> Dict[str, Any]:
+    data = {key.decode(): float(value) for key, value in REDIS.hgetall(get_stats_key(view)).items()}
+    histogram: Dict[int, int] = {}
+    for field, value in data.items():
+        kind, _, bucket = field.partition(":")
+        if bucket and kind == "time":
+            histogram[int(bucket)] = int(value)
+    count = int(data.get("count", 0)) or 1
+    shapes = {
+        key.decode(): int(value)
+        for key, value in REDIS.hgetall(get_shapes_key(view)).items()
+    }
+    return {
+        "view": view,
+        "count": int(data.get("count", 0)),
+        "queries_avg": data.get("queries", 0) / count,
+        "db_avg": data.get("db_sum", 0) / count,
+        "cache_calls_avg": data.get("cache_calls", 0) / count,
+        "cache_avg": data.get("cache_sum", 0) / count,
+        "duration_avg": data.get("duration_sum", 0) / count,
+        "db_total": data.get("db_sum", 0),
+        "duration_total": data.get("duration_sum", 0),
+        "n_plus_one": int(data.get("n_plus_one", 0)),
+        "time": dict(zip(percentiles, get_percentiles(histogram, list(percentiles)))),
+        "shapes": dict(sorted(shapes.items(), key=lambda item: item[1], reverse=True)),
+    }
+
+
+def reset() -> None:
+    with LOCK:
+        BUFFER.clear()
+        SHAPES.clear()
+    names = get_names()
+    REDIS.delete(
+        NAMES_KEY,
+        *(get_stats_key(view) for view in names),
+        *(get_shapes_key(view) for view in names),
+    )
+
+
+def connect() -> None:
+    """SchoolConfig.ready 里调用"""
+    connection_created.connect(install_wrapper, dispatch_uid="school.requeststats")
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+班级花名册和人数缓存
+
+    get_roster(klass_id)  # array('q'), 排好序的学生主键
+    contains(klass_id, student_id)  # lua里二分查找, 不用把整个花名册读回来
+    get_klass_counts([klass_id, ...])  # STRLEN / 8
+    get_school_count(school_id)  # 学校的学生数量, 同一个学生在多个班级只算一次
+
+key:
+    school:klass:<id>:roster  小端int64数组, 每个学生8字节
+    school:school:student_counts  hash, 学校 => 学生数量
+    ...:version  每次变更加1, 读穿透的时候WATCH这个key, 读数据库期间有变更就重试
+变更由 relations.students_changed 在事务提交后调用 apply, 只更新已经缓存的花名册/人数
+没有缓存的在下次读取的时候从数据库加载
+"""
+
+
+import bisect
+import logging
+import sys
+from array import array
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from django.db import transaction
+
+from school.consts import REDIS, register_script
+from school.models.base import Student
+from school.sharding import FanOut, get_shards, is_sharding_enabled
+
+
+LOGGER = logging.getLogger(__name__)
+SCHOOL_COUNTS_KEY = "school:school:student_counts"
+
+CONTAINS_SCRIPT = register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local target = tonumber(ARGV[1])
+local low, high = 0, redis.call('STRLEN', KEYS[1]) / 8 - 1
+while low <= high do
+    local middle = math.floor((low + high) / 2)
+    local value = struct.unpack('<i8', redis.call('GETRANGE', KEYS[1], middle * 8, middle * 8 + 7))
+    if value == target then
+        return 1
+    elseif value < target then
+        low = middle + 1
+    else
+        high = middle - 1
+    end
+end
+return 0
+""")
+INCR_SCRIPT = register_script("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+
+def get_roster_key(klass_id: int) -> str:
+    return f"school:klass:{klass_id}:roster"
+
+
+def get_school_version_key(school_id: int) -> str:
+    return f"school:school:{school_id}:student_counts:version"
+
+
+def pack(student_ids: Iterable[int]) -> bytes:
+    data = array("q", sorted(student_ids))
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpack(blob: bytes) -> array:
+    data = array("q")
+    data.frombytes(blob)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data
+
+
+def get_databases() -> List[str]:
+    return get_shards() if is_sharding_enabled() else ["default"]
+
+
+def load_roster(klass_id: int) -> List[int]:
+    queryset = Student.klass_set.through.objects.filter(
+            klass_id=klass_id).values_list("student_id", flat=True)
+    return [pk for pks in FanOut(queryset, get_databases()).map(list) for pk in pks]
+
+
+def load_school_count(school_id: int) -> int:
+    queryset = Student.klass_set.through.objects.filter(
+            klass__school_id=school_id).values("student_id").distinct()
+    return FanOut(queryset, get_databases()).count()
+
+
+def get_roster(klass_id: int) -> array:
+    key = get_roster_key(klass_id)
+
+    def load(pipeline: Any) -> bytes:
+        blob = pipeline.get(key)
+        if blob is not None:
+            return blob
+        LOGGER.debug("花名册没有缓存: %d", klass_id)
+        blob = pack(load_roster(klass_id))
+        pipeline.multi()
+        pipeline.set(key, blob)
+        return blob
+
+    return unpack(REDIS.transaction(load, key + ":version", value_from_callable=True))
+
+
+def contains(klass_id: int, student_id: int) -> bool:
+    result = CONTAINS_SCRIPT(keys=[get_roster_key(klass_id)], args=[student_id])
+    if result == -1:
+        roster = get_roster(klass_id)
+        index = bisect.bisect_left(roster, student_id)
+        return index < len(roster) and roster[index] == student_id
+    return bool(result)
+
+
+def get_klass_counts(klass_ids: Iterable[int]) -> Dict[int, int]:
+    klass_ids = list(klass_ids)
+    pipeline = REDIS.pipeline(transaction=False)
+    for klass_id in klass_ids:
+        pipeline.exists(get_roster_key(klass_id))
+        pipeline.strlen(get_roster_key(klass_id))
+    values = pipeline.execute()
+    result: Dict[int, int] = {}
+    for index, klass_id in enumerate(klass_ids):
+        exists, length = values[index * 2:index * 2 + 2]
+        result[klass_id] = length // 8 if exists else len(get_roster(klass_id))
+    return result
+
+
+def get_school_count(school_id: int) -> int:
+    def load(pipeline: Any) -> int:
+        count = pipeline.hget(SCHOOL_COUNTS_KEY, school_id)
+        if count is not None:
+            return int(count)
+        count = load_school_count(school_id)
+        pipeline.multi()
+        pipeline.hset(SCHOOL_COUNTS_KEY, school_id, count)
+        return count
+
+    return REDIS.transaction(load, get_school_version_key(school_id), value_from_callable=True)
+
+
+def get_school_deltas(
+        using: str, diff: Dict[int, Tuple[Set[int], Set[int]]]) -> Dict[int, int]:
+    """
+    提交后的数据库状态 减去 这次的净变化 就是之前的状态
+    学生在这个学校之前没有班级现在有 +1, 之前有现在没有 -1
+    """
+    klass_model = Student.klass_set.rel.related_model
+    schools = dict(klass_model._default_manager.using(using).filter(
+            pk__in=diff.keys()).values_list("pk", "school_id"))
+    student_ids = {pk for added, removed in diff.values() for pk in added | removed}
+    now: Dict[Tuple[int, int], Set[int]] = {}
+    for student_id, klass_id, school_id in Student.klass_set.through.objects.using(using).filter(
+            student_id__in=student_ids,
+            klass__school_id__in=set(schools.values())).values_list(
+            "student_id", "klass_id", "klass__school_id"):
+        now.setdefault((school_id, student_id), set()).add(klass_id)
+    before = {key: set(value) for key, value in now.items()}
+    for klass_id, (added, removed) in diff.items():
+        if klass_id not in schools:
+            # 班级已经删除了, 由 klass_deleted 处理
+            continue
+        for student_id in added:
+            before.setdefault((schools[klass_id], student_id), set()).discard(klass_id)
+        for student_id in removed:
+            before.setdefault((schools[klass_id], student_id), set()).add(klass_id)
+    deltas: Dict[int, int] = {}
+    for school_id, student_id in before.keys() | now.keys():
+        delta = bool(now.get((school_id, student_id))) - bool(before.get((school_id, student_id)))
+        if delta:
+            deltas[school_id] = deltas.get(school_id, 0) + delta
+    return deltas
+
+
+def apply(using: str, diff: Dict[int, Tuple[Set[int], Set[int]]]) -> None:
+    """把一个事务的净变化更新到已经缓存的花名册和学校人数"""
+    for klass_id, (added, removed) in diff.items():
+        key = get_roster_key(klass_id)
+
+        def update(pipeline: Any, key=key, added=added, removed=removed) -> None:
+            blob = pipeline.get(key)
+            pipeline.multi()
+            pipeline.incr(key + ":version")
+            if blob is not None:
+                student_ids = set(unpack(blob))
+                pipeline.set(key, pack((student_ids | added) - removed))
+
+        REDIS.transaction(update, key)
+    deltas = get_school_deltas(using, diff)
+    pipeline = REDIS.pipeline()
+    for school_id, delta in deltas.items():
+        pipeline.incr(get_school_version_key(school_id))
+        INCR_SCRIPT(keys=[SCHOOL_COUNTS_KEY], args=[school_id, delta], client=pipeline)
+    pipeline.execute()
+    LOGGER.debug("更新花名册: %d 个班级, 学校人数变化: %s", len(diff), deltas)
+
+
+def drop_klass(klass_id: int, school_id: int) -> None:
+    pipeline = REDIS.pipeline()
+    pipeline.delete(get_roster_key(klass_id))
+    pipeline.incr(get_roster_key(klass_id) + ":version")
+    pipeline.hdel(SCHOOL_COUNTS_KEY, school_id)
+    pipeline.incr(get_school_version_key(school_id))
+    pipeline.execute()
+
+
+def drop_school(school_id: int) -> None:
+    pipeline = REDIS.pipeline()
+    pipeline.hdel(SCHOOL_COUNTS_KEY, school_id)
+    pipeline.incr(get_school_version_key(school_id))
+    pipeline.execute()
+
+
+def klass_deleted(sender, instance, using, **kwargs) -> None:
+    """
+    中间表是直接删除的, 没有m2m_changed, 学校人数只能重新算
+    提交后再删, 避免提交前被别的进程从数据库读到旧数据
+    """
+    klass_id, school_id = instance.pk, instance.school_id
+    transaction.on_commit(lambda: drop_klass(klass_id, school_id), using=using)
+
+
+def school_deleted(sender, instance, using, **kwargs) -> None:
+    school_id = instance.pk
+    transaction.on_commit(lambda: drop_school(school_id), using=using)
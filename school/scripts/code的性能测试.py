@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比导入时逐个检查code和用布隆过滤器批量检查的速度
+python3 manage.py runscript code的性能测试 --script-args prepare  # 先给所有学生生成code并重建布隆过滤器
+python3 manage.py runscript code的性能测试 --script-args "" 10000
+"""
+
+
+import logging
+import random
+import time
+from typing import List
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models.functions import Lower
+
+from school.bloom import STUDENT_CODES
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def prepare() -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f"UPDATE {Student._meta.db_table} SET code = 'S' || id")
+    Student.cached.invalidate()
+    call_command("rebuild_code_bloom")
+
+
+def get_codes(size: int) -> List[str]:
+    """一半存在一半不存在"""
+    existing = [
+        code for code in
+        Student.objects.exclude(code=None).order_by("?").values_list("code", flat=True)[:size // 2]
+        if code
+    ]
+    return existing + [f"X{random.randint(0, 10 ** 9)}" for _ in range(size - len(existing))]
+
+
+def run(mode: str = "", size: str = "10000"):
+    if mode == "prepare":
+        prepare()
+    codes = get_codes(int(size))
+    start = time.time()
+    row_by_row = {
+        code for code in codes
+        if Student.objects.annotate(code_lower=Lower("code")).filter(code_lower=code.lower()).exists()
+    }
+    end = time.time()
+    LOGGER.info("逐个查询: %d 次查询, 耗时: %f", len(codes), end - start)
+    STUDENT_CODES.reset_stats()
+    start = time.time()
+    result = Student.objects.codes_exist(codes)
+    end = time.time()
+    assert result == row_by_row
+    LOGGER.info("布隆过滤器: 耗时: %f", end - start)
+    for key, value in STUDENT_CODES.stats().items():
+        LOGGER.info("    %s: %s", key, value)
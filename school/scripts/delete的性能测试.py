@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比post_delete逐个执行和事务内合并执行的删除速度
+python3 manage.py runscript delete的性能测试 --script-args 10000
+"""
+
+
+import logging
+import time
+
+from school.models import Student
+from school.signals import deferred_signals
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def run(size: str = "10000"):
+    for enabled in [False, True]:
+        students = Student.objects.bulk_create([
+            Student(name=f"删除测试{i}", info={}) for i in range(int(size))
+        ])
+        start = time.time()
+        with deferred_signals(enabled):
+            Student.objects.filter(pk__in=[student.pk for student in students]).delete()
+        end = time.time()
+        LOGGER.info("合并signal: %s, 删除 %d 个学生:", enabled, len(students))
+        LOGGER.info("    耗时: %f", end - start)
+        LOGGER.info("    rows/sec: %f", len(students) / (end - start))
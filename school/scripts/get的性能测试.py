@@ -3,20 +3,46 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+"""
+python3 manage.py runscript get的性能测试
+python3 manage.py runscript get的性能测试 --script-args cached 10000
+"""
+
+
 import logging
 import time
+from typing import Callable
+
 from school.models import Student
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-def run():
+def benchmark(title: str, size: int, func: Callable[[], object]) -> None:
     start = time.time()
-    size = 1000
     for _ in range(size):
-        student = Student.objects.get(id=2)
+        func()
     end = time.time()
-    LOGGER.info("数据库查询速度:")
+    LOGGER.info("%s:", title)
     LOGGER.info("    延迟: %f", (end - start) / size)
     LOGGER.info("    QPS: %f", size / (end - start))
+
+
+def run(mode: str = "db", size: str = "1000"):
+    """
+    mode:
+        db: 只测数据库
+        cached: 对比数据库和redis缓存
+    """
+    student = Student.objects.first()
+    assert student is not None, "请先执行 create_lots_of_students"
+    benchmark("数据库查询速度", int(size), lambda: Student.objects.get(id=student.id))
+    if mode != "cached":
+        return
+    Student.cached.reset_stats()
+    benchmark("缓存查询速度", int(size), lambda: Student.cached.get(id=student.id))
+    pks = list(Student.objects.values_list("id", flat=True)[:100])
+    benchmark("数据库批量查询速度(100个)", int(size) // 10, lambda: Student.objects.in_bulk(pks))
+    benchmark("缓存批量查询速度(100个)", int(size) // 10, lambda: Student.cached.get_many(pks))
+    LOGGER.info("缓存命中情况: %s", Student.cached.stats())
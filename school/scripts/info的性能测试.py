@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比Student.info有索引和没有索引的查询速度
+python3 manage.py runscript info的性能测试 --script-args prepare  # 先给所有学生生成info
+python3 manage.py runscript info的性能测试
+"""
+
+
+import logging
+import time
+from typing import Callable
+
+from django.db import connection, transaction
+
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def benchmark(title: str, size: int, func: Callable[[], object], use_index: bool) -> None:
+    with transaction.atomic():
+        if not use_index:
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_indexscan = off")
+                cursor.execute("SET LOCAL enable_bitmapscan = off")
+        start = time.time()
+        for _ in range(size):
+            func()
+        end = time.time()
+    LOGGER.info("%s, 索引: %s:", title, use_index)
+    LOGGER.info("    延迟: %f", (end - start) / size)
+
+
+def prepare() -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {Student._meta.db_table} "
+            "SET info = jsonb_build_object("
+            "'grade', floor(random() * 12)::int + 1, 'room', floor(random() * 10000)::int)"
+        )
+        cursor.execute(f"ANALYZE {Student._meta.db_table}")
+    Student.cached.invalidate()
+
+
+def run(mode: str = "", size: str = "20"):
+    if mode == "prepare":
+        prepare()
+    LOGGER.info("学生数量: %d", Student.objects.count())
+    for use_index in [False, True]:
+        benchmark(
+                "info_contains room", int(size),
+                lambda: Student.objects.info_contains({"room": 42}).count(), use_index)
+        benchmark(
+                "info_key_eq grade", int(size),
+                lambda: Student.objects.info_key_eq("grade", 3).count(), use_index)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比花名册/人数从数据库查询和从redis读取的速度
+python3 manage.py runscript roster的性能测试
+"""
+
+
+import logging
+import time
+from typing import Callable
+
+from school import roster
+from school.models import Klass
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def benchmark(title: str, size: int, func: Callable[[], object]) -> None:
+    start = time.time()
+    for _ in range(size):
+        func()
+    end = time.time()
+    LOGGER.info("%s:", title)
+    LOGGER.info("    延迟: %f", (end - start) / size)
+
+
+def run(size: str = "100"):
+    klass = Klass.objects.order_by("pk").first()
+    assert klass is not None, "请先创建班级"
+    student_id = klass.students.values_list("pk", flat=True).last()
+    assert student_id is not None, "请先给班级添加学生"
+    LOGGER.info("班级 %d: %d 个学生", klass.pk, klass.students.count())
+    benchmark("数据库花名册", int(size), lambda: list(klass.students.values_list("pk", flat=True)))
+    benchmark("缓存花名册", int(size), lambda: roster.get_roster(klass.pk))
+    benchmark("数据库判断成员", int(size), lambda: klass.students.filter(pk=student_id).exists())
+    benchmark("缓存判断成员", int(size), lambda: roster.contains(klass.pk, student_id))
+    benchmark("数据库班级人数", int(size), lambda: klass.students.count())
+    benchmark("缓存班级人数", int(size), lambda: roster.get_klass_counts([klass.pk]))
+    benchmark("数据库学校人数", int(size) // 10, lambda: roster.load_school_count(klass.school_id))
+    benchmark("缓存学校人数", int(size), lambda: roster.get_school_count(klass.school_id))
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比DRF序列化和CompiledSerializer的速度
+python3 manage.py runscript serializer的性能测试
+python3 manage.py runscript serializer的性能测试 --script-args 10000 100000
+"""
+
+
+import logging
+import time
+from typing import Callable
+
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from school.models import Student
+from school.models.base import DateTimeModel
+from school.serializers import CompiledSerializer, DateTimeModelSerializer, StudentSerializer
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def benchmark(title: str, size: int, func: Callable[[], list]) -> None:
+    start = time.time()
+    result = func()
+    end = time.time()
+    assert len(result) == size, f"数据不够: {len(result)}"
+    LOGGER.info("%s: %d 行, 耗时: %f, ops: %.1f", title, size, end - start, size / (end - start))
+
+
+def compare(serializer_class, queryset: QuerySet, size: int) -> None:
+    queryset = queryset.order_by("pk")[:size]
+    compiled = CompiledSerializer(serializer_class)
+    assert compiled.serialize(queryset[:100]) == serializer_class(queryset[:100], many=True).data
+    benchmark(f"{serializer_class.__name__} DRF", size, lambda: serializer_class(queryset, many=True).data)
+    benchmark(f"{serializer_class.__name__} compiled", size, lambda: compiled.serialize(queryset))
+
+
+def run(*sizes: str):
+    missing = max(int(size) for size in sizes or ["10000", "100000"]) - DateTimeModel.objects.count()
+    if missing > 0:
+        DateTimeModel.objects.bulk_create([DateTimeModel(now=timezone.now()) for _ in range(missing)])
+    for size in sizes or ["10000", "100000"]:
+        compare(StudentSerializer, Student.objects.all(), int(size))
+        compare(DateTimeModelSerializer, DateTimeModel.objects.all(), int(size))
@@ -12,7 +12,7 @@ import time
 from contextvars import ContextVar
 from decimal import Decimal
 from multiprocessing import Pool
-from typing import Tuple, Union, Iterable
+from typing import Iterable, Optional, Tuple, Union
 
 from django_commands.commands import LargeQuerysetMutiProcessHandlerCommand
 from redis import Redis
@@ -24,9 +24,9 @@ from django.utils import timezone
 from django_redis import get_redis_connection
 
 import django_commands
-from django_commands.utils import iter_large_queryset
 
 from school.models import Student
+from school.planner import Strategy, plan_ranges
 
 
 PROCESS_INITED = ContextVar("inited", default=False)
@@ -36,18 +36,25 @@ LOGGER = logging.getLogger(__name__)
 class Task:
     queryset = Student.objects.all()
     DURATION = datetime.timedelta(minutes=1)
+    CHUNK_ROWS = 10
+    CHUNK_BYTES: Optional[int] = None
+    STRATEGY: Strategy = "rows"
 
     def get_tasks(self) -> Iterable[Tuple[int, int]]:
-        """use iter_large_queryset util to iterate a large queryset"""
+        """一次查询算出所有范围, 边算边交给进程池"""
         end_datetime = timezone.now() + self.DURATION
-        for queryset in iter_large_queryset(self.queryset, 10):
-            if timezone.now() > end_datetime:
-                return
-            if not queryset:
-                return
-            assert queryset.first()
-            assert queryset.last()
-            yield (queryset.first().pk, queryset.last().pk)
+        try:
+            for task in plan_ranges(
+                    self.queryset,
+                    chunk_rows=None if self.CHUNK_BYTES else self.CHUNK_ROWS,
+                    chunk_bytes=self.CHUNK_BYTES,
+                    strategy=self.STRATEGY):
+                if timezone.now() > end_datetime:
+                    return
+                yield task
+        finally:
+            # 进程池是在另外一个线程里读取任务的
+            connections.close_all()
 
     def handle_single_task(self, args):
         time.sleep(random.random())
@@ -57,11 +64,31 @@ class Task:
         start = timezone.now()
         tasks = self.get_tasks()
         LOGGER.debug("handle task: %s", tasks)
+        connections.close_all()
         with Pool(jobs) as p:
             for result in p.imap_unordered(
                 self.handle_single_task, tasks):
                 LOGGER.info("handle single task done: %s", result)
-
-
-def run():
+        LOGGER.info("耗时: %s", timezone.now() - start)
+
+
+def plan(chunk_rows: str = "10", chunk_bytes: str = "", strategy: Strategy = "rows") -> None:
+    """只测试拆分范围的速度"""
+    start = time.time()
+    count = sum(1 for _ in plan_ranges(
+        Student.objects.all(),
+        chunk_rows=int(chunk_rows),
+        chunk_bytes=int(chunk_bytes) if chunk_bytes else None,
+        strategy=strategy))
+    LOGGER.info("拆分成 %d 个范围, 耗时: %f", count, time.time() - start)
+
+
+def run(*args):
+    """
+    python3 manage.py runscript student_grows
+    python3 manage.py runscript student_grows --script-args plan 10000 "" width
+    """
+    if args and args[0] == "plan":
+        plan(*args[1:])
+        return
     Task().handle()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比逐行get_or_create和 upsert_by_code 的速度, 都在事务里执行完再回滚, 不改数据
+需要先给学生生成code: python3 manage.py runscript code的性能测试 --script-args prepare
+python3 manage.py runscript upsert的性能测试 --script-args 10000
+"""
+
+
+import logging
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.db import transaction
+from django.db.models.functions import Lower
+
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_rows(size: int) -> List[Dict[str, Any]]:
+    """一半是已有的学生改名字, 一半是新学生"""
+    existing = list(
+        Student.objects.exclude(code=None).order_by("?").values_list("code", flat=True)[:size // 2]
+    )
+    codes = existing + [f"X{random.randint(0, 10 ** 9)}" for _ in range(size - len(existing))]
+    return [{"code": code, "name": f"name{index}", "info": {}} for index, code in enumerate(codes)]
+
+
+def row_by_row(rows: List[Dict[str, Any]]) -> None:
+    """和get_or_create一样每行一次查询一次写入, 用Lower(code)才能走唯一索引"""
+    for row in rows:
+        student = Student.objects.annotate(code_lower=Lower("code")).filter(
+                code_lower=row["code"].lower()).first()
+        if student is None:
+            Student.objects.create(**row)
+        else:
+            student.name = row["name"]
+            student.save()
+
+
+def run(size: str = "10000"):
+    rows = get_rows(int(size))
+    funcs: List[Tuple[str, Callable[[List[Dict[str, Any]]], Any]]] = [
+        ("逐行get_or_create", row_by_row),
+        ("upsert_by_code", Student.objects.upsert_by_code),
+    ]
+    for name, func in funcs:
+        with transaction.atomic():
+            start = time.time()
+            result = func(rows)
+            end = time.time()
+            transaction.set_rollback(True)
+        LOGGER.info("%s: %d 行, 耗时: %f, ops: %.1f", name, len(rows), end - start, len(rows) / (end - start))
+        if result:
+            LOGGER.info("    %s", [{key: value for key, value in item.items() if key != "errors"} for item in result])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+对比同步写日志和队列日志(schoolproject/log_handlers.py)
+日志写到临时目录, console输出到 /dev/null, handler和格式和 settings.LOGGING 一样
+    每秒能调用多少次 LOGGER.info, 单线程和4个线程
+    每次调用的p50/p99, 包括和不包括等后台线程写完
+    返回404的请求(django.request会写一条WARNING)的p50/p99
+python3 manage.py runscript 日志的性能测试 --script-args 20000
+"""
+
+
+import logging
+import logging.config
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.test import Client
+
+from schoolproject import log_handlers
+
+
+LOGGER = logging.getLogger(__name__)
+THREADS = 4
+
+
+def get_config(directory: str, devnull) -> Dict[str, Any]:
+    config = {key: value for key, value in settings.LOGGING.items() if key != "queue"}
+    config["handlers"] = {name: dict(handler) for name, handler in config["handlers"].items()}
+    for handler in config["handlers"].values():
+        if "filename" in handler:
+            handler["filename"] = Path(directory) / Path(handler["filename"]).name
+        if "stream" in handler:
+            handler["stream"] = devnull
+    return config
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def log_calls(logger: logging.Logger, count: int, latencies: List[float]) -> None:
+    for index in range(count):
+        start = time.perf_counter()
+        logger.info("写第%d条日志, 学生: %s", index, {"id": index, "name": "name"})
+        latencies.append(time.perf_counter() - start)
+
+
+def bench(mode: str, count: int) -> List[str]:
+    """结果写到临时目录的日志里就看不到了, 返回结果, 恢复日志配置以后再打印"""
+    result = []
+    logger = logging.getLogger("school.scripts.log_bench")
+    latencies: List[float] = []
+    start = time.perf_counter()
+    log_calls(logger, count, latencies)
+    called = time.perf_counter() - start
+    log_handlers.flush_all()
+    written = time.perf_counter() - start
+    result.append(
+            f"{mode} 单线程 {count} 条: {count / called:.0f} 次/秒, 写完 {count / written:.0f} 条/秒, "
+            f"p50: {percentile(latencies, 0.5) * 1e6:.1f}us, p99: {percentile(latencies, 0.99) * 1e6:.1f}us, "
+            f"max: {max(latencies) * 1000:.1f}ms")
+
+    latencies = []
+    threads = [
+        threading.Thread(target=log_calls, args=(logger, count // THREADS, latencies))
+        for _ in range(THREADS)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    called = time.perf_counter() - start
+    log_handlers.flush_all()
+    result.append(
+            f"{mode} {THREADS} 个线程 {len(latencies)} 条: {len(latencies) / called:.0f} 次/秒, "
+            f"p50: {percentile(latencies, 0.5) * 1e6:.1f}us, p99: {percentile(latencies, 0.99) * 1e6:.1f}us")
+
+    client = Client()
+    latencies = []
+    for _ in range(500):
+        start = time.perf_counter()
+        client.get("/api/students/0/")
+        latencies.append(time.perf_counter() - start)
+    log_handlers.flush_all()
+    result.append(
+            f"{mode} 404请求 {len(latencies)} 次: "
+            f"p50: {percentile(latencies, 0.5) * 1000:.2f}ms, p99: {percentile(latencies, 0.99) * 1000:.2f}ms")
+    return result
+
+
+def run(count: str = "20000"):
+    result = []
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w", encoding="utf-8") as devnull:
+        config = get_config(directory, devnull)
+        for mode in ["sync", "queue"]:
+            if mode == "queue":
+                log_handlers.configure({**config, "queue": {"policy": "block"}})
+            else:
+                logging.config.dictConfig(config)
+            result.extend(bench(mode, int(count)))
+        # 关闭队列的后台线程, 再关闭devnull
+        logging.config.dictConfig(settings.LOGGING)
+    for line in result:
+        LOGGER.info(line)
@@ -3,11 +3,40 @@
 # Xiang Wang <ramwin@qq.com>
 
 
-from rest_framework import serializers
+import collections
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Tuple, Type
+
+from django.db.models import QuerySet
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 from school.models import Student
 from school.models.base import DateTimeModel
 
 
+class SparseFieldsMixin:
+    """
+    fields: 只保留这些字段, 用于 ?fields=id,name
+    """
+    # Serializer 提供
+    fields: Dict[str, Any]
+
+    def __init__(self, *args, fields: Optional[Iterable[str]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            fields = set(fields)
+            for name in list(self.fields):
+                if name not in fields:
+                    self.fields.pop(name)
+
+    def get_only_fields(self) -> List[str]:
+        """字段对应的model字段, 给queryset.only()用"""
+        return [
+            field.source.split(".")[0] for field in self.fields.values()
+            if field.source != "*" and not isinstance(field, serializers.SerializerMethodField)
+        ]
+
+
 class AliasSerializer(serializers.Serializer):
 
     gender = serializers.BooleanField(source="性别")
@@ -16,17 +45,69 @@ class AliasSerializer(serializers.Serializer):
         fields = ["gender"]
 
 
+class UpsertListSerializer(serializers.ListSerializer):
+    """
+    批量校验, 不合法的行跳过并记到 rejected 里, 不影响同一批的其他行
+    code不区分大小写, 同一批里code重复的以最后一行为准 (ON CONFLICT DO UPDATE 同一行不能改两次)
+    不在这里查数据库判断是否已存在, 由 INSERT ... ON CONFLICT 一次处理整批
+    provided: 和返回值一一对应, 每行实际提供了哪些字段, 更新的时候只改这些字段
+    indexes: 和返回值一一对应, 每行在data里的行号
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rejected: List[Tuple[int, Any]] = []
+        self.provided: List[FrozenSet[str]] = []
+        self.indexes: List[int] = []
+
+    def to_internal_value(self, data):
+        self.rejected = []
+        result: Dict[str, Tuple[Dict[str, Any], FrozenSet[str], int]] = {}
+        for index, item in enumerate(data):
+            try:
+                value = self.child.run_validation(item)
+            except serializers.ValidationError as error:
+                self.rejected.append((index, error.detail))
+                continue
+            result.pop(value["code"].lower(), None)
+            result[value["code"].lower()] = (value, frozenset(item) & frozenset(value), index)
+        self.provided = [provided for _, provided, _ in result.values()]
+        self.indexes = [index for _, _, index in result.values()]
+        return [value for value, _, _ in result.values()]
+
+
 class StudentUpdateSerializer(serializers.ModelSerializer):
+    """
+    Student.objects.upsert_by_code 用, 行里没有的字段新建时用默认值, 更新时保留原来的值
+    name 只有新建的时候必须有, 校验的时候不知道code是否存在, 由 upsert_by_code 检查
+    """
 
     class Meta:
-        fields = ["code"]
+        model = Student
+        fields = ["code", "name", "height", "age", "info"]
+        extra_kwargs = {
+            "code": {"required": True, "allow_null": False, "allow_blank": False},
+            "name": {"required": False},
+            "info": {"default": dict},
+        }
+        list_serializer_class = UpsertListSerializer
 
 
-class StudentSerializer(serializers.ModelSerializer):
+class StudentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Student
-        fields = ["info"]
+        fields = ["id", "name", "code", "update_datetime", "height", "age", "info"]
+
+
+class StudentExamSerializer(StudentSerializer):
+    """导出用, 需要 export.get_queryset(with_exams=True) 的聚合字段"""
+    exam_count = serializers.IntegerField(read_only=True)
+    exam_total = serializers.IntegerField(read_only=True)
+    exam_max = serializers.IntegerField(read_only=True)
+
+    class Meta(StudentSerializer.Meta):
+        fields = [*StudentSerializer.Meta.fields, "exam_count", "exam_total", "exam_max"]
 
 
 class DateTimeModelSerializer(serializers.ModelSerializer):
@@ -35,6 +116,114 @@ class DateTimeModelSerializer(serializers.ModelSerializer):
     class Meta:
         model = DateTimeModel
         fields = ["now"]
+        # CompiledSerializer 调用get_now时, obj上只有这些属性
+        method_sources = {"now": ["now"]}
 
     def get_now(self, obj):
         return obj.now.timestamp()
+
+
+# to_representation 对数据库返回的值没有变化的字段, 编译后直接使用
+IDENTITY_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.FloatField,
+    serializers.IntegerField,
+    serializers.JSONField,
+)
+
+
+def compile_datetime(field: serializers.DateTimeField) -> Callable:
+    """
+    DateTimeField.to_representation 每次都要取当前时区, 编译的时候取一次
+    只处理aware的datetime和ISO_8601格式, 其他情况用原来的方法
+    """
+    output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+    field_timezone = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+    if output_format is None or output_format.lower() != ISO_8601 or field_timezone is None:
+        return field.to_representation
+
+    def to_representation(value):
+        if isinstance(value, str) or not timezone.is_aware(value):
+            return field.to_representation(value)
+        value = value.astimezone(field_timezone).isoformat()
+        if value.endswith("+00:00"):
+            value = value[:-6] + "Z"
+        return value
+
+    return to_representation
+
+
+class CompiledSerializer:
+    """
+    根据serializer的字段和source生成取值计划, 直接处理 values_list 的元组, 不创建model对象
+    时区在创建的时候确定, 每个请求创建一个
+
+        compiled = CompiledSerializer(StudentSerializer, fields=["id", "name"])
+        compiled.serialize(Student.objects.all())
+
+    source里的 a.b 会变成 a__b
+    SerializerMethodField 需要在 Meta.method_sources 里声明用到的字段,
+        调用时传入一个只有这些属性的namedtuple
+    结果和 serializer(queryset, many=True).data 一致
+    """
+
+    def __init__(self, serializer_class: Type[serializers.Serializer], **kwargs):
+        self.serializer = serializer_class(**kwargs)
+        method_sources: Dict[str, List[str]] = getattr(
+            getattr(serializer_class, "Meta", None), "method_sources", {})
+        self.lookups: List[str] = []
+        # (输出的key, 元组里的位置, 转换函数)
+        self.plan: List[Tuple[str, Any, Optional[Callable]]] = []
+        for name, field in self.serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                if name not in method_sources:
+                    raise ValueError(f"{serializer_class.__name__}.{name}: 没有声明 Meta.method_sources")
+                row_class = collections.namedtuple("Row", method_sources[name])  # type: ignore[misc]
+                indexes = [self.add_lookup(source) for source in method_sources[name]]
+                method = getattr(self.serializer, field.method_name)
+                self.plan.append((name, indexes, self.bind_method(method, row_class)))
+                continue
+            if field.source == "*":
+                raise ValueError(f"{serializer_class.__name__}.{name}: 不支持 source='*'")
+            if isinstance(field, IDENTITY_FIELDS):
+                converter = None
+            elif isinstance(field, serializers.DateTimeField):
+                converter = compile_datetime(field)
+            else:
+                converter = field.to_representation
+            self.plan.append((name, self.add_lookup(field.source.replace(".", "__")), converter))
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _, _ in self.plan]
+
+    def add_lookup(self, lookup: str) -> int:
+        if lookup not in self.lookups:
+            self.lookups.append(lookup)
+        return self.lookups.index(lookup)
+
+    @staticmethod
+    def bind_method(method: Callable, row_class: Type) -> Callable:
+        return lambda values: method(row_class(*values))
+
+    def to_representation(self, row: Sequence[Any]) -> Dict[str, Any]:
+        result = {}
+        for name, index, converter in self.plan:
+            if isinstance(index, list):
+                result[name] = converter([row[i] for i in index])  # type: ignore[misc]
+                continue
+            value = row[index]
+            if value is not None and converter is not None:
+                value = converter(value)
+            result[name] = value
+        return result
+
+    def iterator(self, queryset: QuerySet, chunk_size: int = 2000) -> Iterator[Dict[str, Any]]:
+        for row in queryset.values_list(*self.lookups).iterator(chunk_size=chunk_size):
+            yield self.to_representation(row)
+
+    def serialize(self, queryset: QuerySet) -> List[Dict[str, Any]]:
+        return [self.to_representation(row) for row in queryset.values_list(*self.lookups)]
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+按学生主键把Student, Exam, Klass.students的中间表分到 settings.SHARDS 里
+
+    分片规则: shard = SHARDS[(pk - 1) % len(SHARDS)]
+    每个分片的自增序列步长都是len(SHARDS), 用 manage.py shard_sequences 设置
+    School, Klass 很小, 每个分片都存一份完整的, 这样外键约束在每个分片都成立
+
+    FanOut(Student.objects.filter(age=1)).count()  # 并发查询所有分片再合并
+    FanOut(Student.objects.all()).get(pk=2)  # 只查一个分片
+    Student.objects.filter(pk=2), Exam.objects.filter(student_id=2)  # ShardedQuerySet按分片字段的等值条件只查一个分片
+
+在 .env 里设置 SHARDING=true 才会启用 ShardRouter
+"""
+
+
+import copy
+import heapq
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from django.conf import settings
+from django.db import connections, models, router
+from django.db.models.base import ModelState
+
+if TYPE_CHECKING:
+    # relations 导入了这个模块
+    from school.models.relations import Klass
+
+
+LOGGER = logging.getLogger(__name__)
+T = TypeVar("T")
+# FanOut.iterator 的生产线程每隔多久检查一次调用方是不是已经不读了
+PUT_TIMEOUT = 0.1
+# model -> 用来分片的字段
+SHARDED_MODELS: Dict[str, str] = {
+    "school.student": "pk",
+    "school.exam": "student_id",
+    "school.klass_students": "student_id",
+}
+BROADCAST_MODELS = {"school.school", "school.klass"}
+
+
+def get_shards() -> List[str]:
+    return list(getattr(settings, "SHARDS", ["default"]))
+
+
+def shard_for_pk(pk: int) -> str:
+    shards = get_shards()
+    return shards[(int(pk) - 1) % len(shards)]
+
+
+def is_sharding_enabled() -> bool:
+    return any(isinstance(item, ShardRouter) for item in router.routers)
+
+
+class ShardRouter:
+
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def get_shard(self, model, instance: Optional[models.Model]) -> Optional[str]:
+        if instance is None:
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if isinstance(instance, model):
+            value = getattr(instance, SHARDED_MODELS[model._meta.label_lower])
+        elif instance._meta.label_lower == "school.student":
+            value = instance.pk
+        else:
+            return None
+        if value is None:
+            return None
+        return shard_for_pk(value)
+
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        label = model._meta.label_lower
+        if label in BROADCAST_MODELS:
+            # student.klass_set 要在学生所在的分片上join
+            instance = hints.get("instance")
+            return instance._state.db if instance is not None and instance._state.db else "default"
+        if label not in SHARDED_MODELS:
+            return None
+        return self.get_shard(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints) -> Optional[str]:
+        label = model._meta.label_lower
+        if label in BROADCAST_MODELS:
+            return "default"
+        if label not in SHARDED_MODELS:
+            return None
+        shard = self.get_shard(model, hints.get("instance"))
+        if shard is None and label == "school.student":
+            # 新学生没有主键, 轮流写入, 主键由分片自己的序列生成
+            shards = get_shards()
+            shard = shards[next(self.counter) % len(shards)]
+        return shard
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        if {obj1._meta.label_lower, obj2._meta.label_lower} & BROADCAST_MODELS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints) -> Optional[bool]:
+        if db == "default" or db not in get_shards():
+            return None
+        if app_label != "school":
+            return False
+        label = f"{app_label}.{model_name}"
+        return label in SHARDED_MODELS or label in BROADCAST_MODELS
+
+
+def get_lookup_shard(model, kwargs: Dict[str, Any]) -> Optional[str]:
+    """filter的条件里有分片字段的等值条件的话, 返回那个分片"""
+    field = SHARDED_MODELS.get(model._meta.label_lower)
+    if field is None:
+        return None
+    if field == "pk":
+        names = {"pk", model._meta.pk.name, model._meta.pk.attname}
+    else:
+        relation = field.removesuffix("_id")
+        names = {field, relation, f"{relation}__pk", f"{relation}__id"}
+    for name in list(names):
+        names.add(f"{name}__exact")
+    for name, value in kwargs.items():
+        if name not in names:
+            continue
+        if isinstance(value, models.Model):
+            value = value.pk
+        try:
+            return shard_for_pk(int(value))
+        except (TypeError, ValueError):
+            return None
+    return None
+
+
+def group_by_shard(pks: Iterable[Any]) -> Dict[str, List[Any]]:
+    groups: Dict[str, List[Any]] = {}
+    for pk in pks:
+        groups.setdefault(shard_for_pk(pk), []).append(pk)
+    return groups
+
+
+def get_using(queryset: models.QuerySet) -> Optional[str]:
+    """using() 指定的数据库, 没有指定返回None; queryset.db 会按router选一个"""
+    return queryset._db  # type: ignore[attr-defined]
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    QuerySet.create 选数据库的时候拿不到instance, 这里按instance选分片
+    filter(pk=2), filter(student_id=2) 这种点查询直接用对应的分片, 没有指定 using() 的时候才生效
+    get() 的条件里没有分片字段的话依次查询每个分片
+    """
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=router.db_for_write(self.model, instance=obj))
+        return obj
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        clone = super()._filter_or_exclude(negate, args, kwargs)
+        if not negate and clone._db is None and is_sharding_enabled():
+            clone._db = get_lookup_shard(self.model, kwargs)
+        return clone
+
+    def get(self, *args, **kwargs):
+        clone = self.filter(*args, **kwargs) if args or kwargs else self
+        if clone._db is not None or not is_sharding_enabled():
+            return super(ShardedQuerySet, clone).get()
+        found = []
+        for alias in get_shards():
+            try:
+                found.append(super(ShardedQuerySet, clone.using(alias)).get())
+            except self.model.DoesNotExist:
+                continue
+        if not found:
+            raise self.model.DoesNotExist(f"{self.model._meta.object_name} matching query does not exist.")
+        if len(found) > 1:
+            raise self.model.MultipleObjectsReturned(
+                f"get() returned more than one {self.model._meta.object_name} -- it returned {len(found)}!")
+        return found[0]
+
+
+def replicate(sender, instance, using, **kwargs) -> None:
+    """School, Klass 写入default以后复制到其他分片"""
+    if using != "default" or not is_sharding_enabled():
+        return
+    for alias in get_shards():
+        if alias == using:
+            continue
+        clone = copy.copy(instance)
+        clone._state = ModelState()
+        clone.save(using=alias)
+
+
+def replicate_delete(sender, instance, using, **kwargs) -> None:
+    if using != "default" or not is_sharding_enabled():
+        return
+    for alias in get_shards():
+        if alias != using:
+            sender._default_manager.using(alias).filter(pk=instance.pk).delete()
+
+
+def enroll(klass: "Klass", students: Iterable[models.Model]) -> None:
+    """
+    分片以后 klass.students.add 只会写到klass所在的数据库
+    按学生所在的分片, 用绑定到那个分片的klass调用 students.add, 这样每个分片都会发出 m2m_changed
+    """
+    groups: Dict[str, List[Any]] = {}
+    for student in students:
+        groups.setdefault(student._state.db or shard_for_pk(student.pk), []).append(student.pk)
+    for alias, pks in groups.items():
+        # Klass每个分片都有一份, 中间表按 instance._state.db 选数据库
+        clone = copy.copy(klass)
+        clone._state = ModelState()
+        clone._state.db = alias
+        clone._state.adding = False
+        clone.students.add(*pks)
+
+
+class FanOut:
+    """
+    在所有分片上执行同一个queryset, 并发查询再合并
+    调用方在事务里的时候, 别的线程看不到未提交的数据, 会退化成当前线程依次查询
+    """
+
+    def __init__(self, queryset: models.QuerySet, databases: Optional[List[str]] = None):
+        self.queryset = queryset
+        self.databases = databases or get_shards()
+
+    def is_concurrent(self) -> bool:
+        return len(self.databases) > 1 and not any(
+            connections[alias].in_atomic_block for alias in self.databases
+        )
+
+    def map(self, func: Callable[[models.QuerySet], T]) -> List[T]:
+        if not self.is_concurrent():
+            return [func(self.queryset.using(alias)) for alias in self.databases]
+
+        def run(alias: str) -> T:
+            try:
+                return func(self.queryset.using(alias))
+            finally:
+                connections[alias].close()
+
+        with ThreadPoolExecutor(len(self.databases)) as executor:
+            return list(executor.map(run, self.databases))
+
+    def count(self) -> int:
+        return sum(self.map(lambda queryset: queryset.count()))
+
+    def exists(self) -> bool:
+        return any(self.map(lambda queryset: queryset.exists()))
+
+    def get(self, pk: int) -> models.Model:
+        return self.queryset.using(shard_for_pk(pk)).get(pk=pk)
+
+    def list(self) -> List[models.Model]:
+        """每个分片内已经排好序, 按order_by做归并; 有切片的话合并后再切"""
+        queryset = self.queryset
+        low, high = queryset.query.low_mark, queryset.query.high_mark
+        if low or high is not None:
+            queryset = queryset.all()
+            queryset.query.clear_limits()
+            if high is not None:
+                queryset.query.set_limits(0, high)
+        results = FanOut(queryset, self.databases).map(list)
+        ordering = [
+            item for item in queryset.query.order_by
+            if isinstance(item, str)
+        ]
+        if ordering and len(ordering) == len(queryset.query.order_by) and len(
+                {item.startswith("-") for item in ordering}) == 1:
+            reverse = ordering[0].startswith("-")
+            names = [item.lstrip("-") for item in ordering]
+            merged = list(heapq.merge(*results, key=attrgetter(*names), reverse=reverse))
+        else:
+            merged = list(itertools.chain.from_iterable(results))
+        return merged[low:high]
+
+    def iterator(self, chunk_size: int = 2000) -> Iterator[Any]:
+        """
+        各个分片同时读, 读到的数据通过有界队列交给调用方, 不保证顺序; values_list的queryset返回元组
+        调用方提前结束(break, islice, 异常)的时候通知生产线程退出, 关闭各个分片的连接
+        """
+        if not self.is_concurrent():
+            for alias in self.databases:
+                yield from self.queryset.using(alias).iterator(chunk_size=chunk_size)
+            return
+        buffer: queue.Queue = queue.Queue(maxsize=chunk_size * len(self.databases))
+        done = object()
+        errors: List[Exception] = []
+        stop = threading.Event()
+
+        def put(item: Any) -> bool:
+            """队列满了就等, 调用方不读了返回False"""
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=PUT_TIMEOUT)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce(alias: str) -> None:
+            try:
+                for obj in self.queryset.using(alias).iterator(chunk_size=chunk_size):
+                    if not put(obj):
+                        return
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                LOGGER.exception("分片 %s 查询失败", alias)
+                errors.append(error)
+            finally:
+                connections[alias].close()
+                put(done)
+
+        threads = [
+            threading.Thread(target=produce, args=(alias,), name=f"school-fanout-{alias}", daemon=True)
+            for alias in self.databases
+        ]
+        for thread in threads:
+            thread.start()
+        finished = 0
+        try:
+            while finished < len(threads):
+                obj = buffer.get()
+                if obj is done:
+                    finished += 1
+                    continue
+                yield obj
+        finally:
+            stop.set()
+        if errors:
+            raise errors[0]
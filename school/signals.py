@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+合并到事务提交时再执行的signal receiver
+
+    @batched
+    def log(sender, using, calls, **kwargs):
+        # calls: 这个事务里每次signal的参数 [{"instance": ..., "created": ...}, ...]
+        ...
+
+    post_delete.connect(log, Student)
+
+一次级联删除10万个学生, log只会在on_commit时执行一次
+不在事务里的时候, on_commit会马上执行, 相当于每次一个
+事务回滚的话, 收集到的数据会被丢弃
+嵌套的 atomic() 回滚的话, 里面的调用也会被丢弃:
+    每个不同的savepoint栈注册一个空的on_commit回调(Marker), django回滚savepoint时会把它删掉
+    Batch 在 run_on_commit 里总是排在自己的Marker后面, 执行的时候只保留Marker已经执行过的调用
+    (提交时django先清空 run_on_commit 再执行, 执行的时候不能再去里面找Marker)
+"""
+
+
+import contextlib
+import functools
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from django.db import connections, transaction
+
+
+LOGGER = logging.getLogger(__name__)
+ENABLED = True
+_LOCAL = threading.local()
+
+
+class Marker:
+    """savepoint回滚的时候django会把它从on_commit里删掉, 没删掉的话提交时执行"""
+
+    def __init__(self):
+        self.called = False
+
+    def __call__(self) -> None:
+        self.called = True
+
+
+class Batch:
+
+    def __init__(self, receiver: Callable, sender: Any, using: str):
+        self.receiver = receiver
+        self.sender = sender
+        self.using = using
+        self.calls: List[Tuple[Marker, Dict[str, Any]]] = []
+        self.markers: Dict[Tuple, Marker] = {}
+
+    def add(self, kwargs: Dict[str, Any]) -> None:
+        savepoint_ids = tuple(connections[self.using].savepoint_ids)
+        marker = self.markers.get(savepoint_ids)
+        if marker is None:
+            marker = self.markers[savepoint_ids] = Marker()
+            transaction.on_commit(marker, using=self.using)
+            self.move_to_end()
+        self.calls.append((marker, kwargs))
+
+    def move_to_end(self) -> None:
+        """挪到新的Marker后面, 保留注册时的savepoint, 所在的savepoint回滚的时候还是会被删掉"""
+        run_on_commit = connections[self.using].run_on_commit
+        for index, item in enumerate(run_on_commit):
+            if item[1] is self:
+                run_on_commit.append(run_on_commit.pop(index))
+                return
+
+    def __call__(self) -> None:
+        pending: Dict[Tuple, "Batch"] = getattr(_LOCAL, "pending", {})
+        key = (self.receiver, self.sender, self.using)
+        if pending.get(key) is self:
+            del pending[key]
+        calls = [kwargs for marker, kwargs in self.calls if marker.called]
+        LOGGER.debug("批量执行 %s: %d 次, 回滚了 %d 次", self.receiver.__name__, len(calls), len(self.calls) - len(calls))
+        if calls:
+            self.receiver(sender=self.sender, using=self.using, calls=calls)
+
+    def is_pending(self) -> bool:
+        """回滚以后on_commit里就没有自己了"""
+        return any(item[1] is self for item in connections[self.using].run_on_commit)
+
+
+def batched(receiver: Optional[Callable] = None, *, prepare: Optional[Callable] = None) -> Callable:
+    """
+    把receiver改成按事务批量执行
+    receiver的参数: sender, using, calls
+    prepare: 可选, signal发生时马上执行, 返回要保存的参数.
+        用来记录提交时已经查不到的数据, 比如pre_clear时的成员
+    """
+    if receiver is None:
+        return functools.partial(batched, prepare=prepare)
+
+    @functools.wraps(receiver)
+    def wrapper(sender, using="default", **kwargs) -> None:
+        kwargs.pop("signal", None)
+        if prepare is not None:
+            kwargs = prepare(sender=sender, using=using, **kwargs)
+        if not ENABLED:
+            receiver(sender=sender, using=using, calls=[kwargs])
+            return
+        if not connections[using].in_atomic_block:
+            # 不在事务里, on_commit会马上执行
+            receiver(sender=sender, using=using, calls=[kwargs])
+            return
+        pending: Dict[Tuple, Batch] = _LOCAL.__dict__.setdefault("pending", {})
+        key = (receiver, sender, using)
+        batch = pending.get(key)
+        if batch is None or not batch.is_pending():
+            batch = pending[key] = Batch(receiver, sender, using)
+            transaction.on_commit(batch, using=using)
+        batch.add(kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def deferred_signals(enabled: bool) -> Iterator[None]:
+    """临时打开/关闭批量执行, 用来对比性能"""
+    global ENABLED  # pylint: disable=global-statement
+    origin, ENABLED = ENABLED, enabled
+    try:
+        yield
+    finally:
+        ENABLED = origin
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+分析进程冷启动的耗时: 每个模块的import时间, 每个app的ready()时间
+
+    python3 manage.py startup_profile  # 见 school/management/commands/startup_profile.py
+    python3 -X importtime -m school.startup student_grow  # 子进程实际执行的, 最后一行输出json
+
+在一个新的子进程里测量, 当前进程里的模块已经import过了, 测不出来
+-X importtime 本身会让import变慢, 各个模块之间比较有意义, 总时间看 get_wall_time
+"""
+
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+class ImportTime(NamedTuple):
+    name: str
+    depth: int
+    # 单位微秒, cumulative 包含它import的其他模块
+    self_us: int
+    cumulative_us: int
+
+
+def parse_importtime(stderr: str) -> List[ImportTime]:
+    """
+    解析 -X importtime 的输出
+        import time: self [us] | cumulative | imported package
+        import time:       248 |        248 |   django_redis
+    """
+    result: List[ImportTime] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        result.append(ImportTime(
+            name=name.strip(),
+            depth=(len(name) - len(name.lstrip()) - 1) // 2,
+            self_us=int(parts[0]),
+            cumulative_us=int(parts[1]),
+        ))
+    return result
+
+
+def group_by_package(imports: List[ImportTime]) -> Dict[str, int]:
+    """每个顶层包自身的import时间总和, 单位微秒"""
+    packages: Dict[str, int] = defaultdict(int)
+    for item in imports:
+        packages[item.name.split(".")[0]] += item.self_us
+    return dict(sorted(packages.items(), key=lambda item: item[1], reverse=True))
+
+
+def profile_child(command: Optional[str] = None) -> Dict[str, Any]:
+    """
+    在子进程里执行, 分阶段计时, 单位秒
+        settings: import settings 模块(会import schoolproject 和里面的celery)
+        setup: django.setup(), import所有app和models, 执行ready()
+        ready: 每个app的ready()
+        command: 加载管理命令的类
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "schoolproject.settings")
+    start = time.perf_counter()
+    # pylint: disable=import-outside-toplevel
+    import django
+    from django.apps import AppConfig
+    from django.conf import settings
+    ready: Dict[str, float] = {}
+    create = AppConfig.create.__func__  # type: ignore[attr-defined]
+
+    def timed_create(cls, entry):
+        config = create(cls, entry)
+        original = config.ready
+
+        def timed_ready():
+            ready_start = time.perf_counter()
+            original()
+            ready[config.label] = time.perf_counter() - ready_start
+        config.ready = timed_ready
+        return config
+
+    AppConfig.create = classmethod(timed_create)  # type: ignore[assignment]
+    timings = {"django": time.perf_counter() - start}
+    phase = time.perf_counter()
+    settings.INSTALLED_APPS  # pylint: disable=pointless-statement
+    timings["settings"] = time.perf_counter() - phase
+    phase = time.perf_counter()
+    django.setup()
+    timings["setup"] = time.perf_counter() - phase
+    if command:
+        from django.core.management import get_commands, load_command_class
+        phase = time.perf_counter()
+        load_command_class(get_commands()[command], command)
+        timings["command"] = time.perf_counter() - phase
+    timings["total"] = time.perf_counter() - start
+    return {
+        "timings": timings,
+        "ready": dict(sorted(ready.items(), key=lambda item: item[1], reverse=True)),
+        "module_count": len(sys.modules),
+    }
+
+
+def profile(command: Optional[str] = None) -> Dict[str, Any]:
+    """启动一个 -X importtime 的子进程, 返回子进程的计时和每个模块的import时间"""
+    args = [sys.executable, "-X", "importtime", "-m", "school.startup"]
+    if command:
+        args.append(command)
+    process = subprocess.run(args, cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result["imports"] = parse_importtime(process.stderr)
+    return result
+
+
+def get_wall_time(args: List[str], repeat: int = 5) -> List[float]:
+    """
+    不带 importtime 执行 manage.py args 多少次, 返回每次的耗时
+    比较优化前后的冷启动应该用这个
+    """
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "manage.py", *args], cwd=BASE_DIR,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        result.append(time.perf_counter() - start)
+    return result
+
+
+def summarize_wall_time(values: List[float]) -> Dict[str, float]:
+    return {"min": min(values), "median": statistics.median(values), "max": max(values)}
+
+
+if __name__ == "__main__":
+    print(json.dumps(profile_child(sys.argv[1] if len(sys.argv) > 1 else None)))
@@ -8,6 +8,8 @@ import logging
 import time
 
 from celery import shared_task
+
+from school.jobs import RangeJob
 from .models import Student
 
 
@@ -26,3 +28,12 @@ def add(x: int) -> int:
     # 这里student.的时候，会有类型提示
     student.save()
     return x
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def run_range(job_id: str, field: str) -> int:
+    """
+    执行 RangeJob 的一个范围
+    acks_late: worker死掉的话消息会重新投递, 领取范围的时候会跳过已经完成的
+    """
+    return RangeJob(job_id).run(field)
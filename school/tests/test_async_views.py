@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import asyncio
+import logging
+
+from django.test import AsyncClient, TestCase
+
+from school.consts import ASYNC_REDIS, get_async_redis
+from school.models import Exam, Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.client = AsyncClient()
+        self.students = [Student.objects.create(name=str(i), info={}) for i in range(5)]
+        for score in [60, 80]:
+            Exam.objects.create(student=self.students[0], score=score)
+        Student.cached.invalidate()
+
+    async def test_student(self):
+        student = self.students[0]
+        response = await self.client.get(f"/api/async/students/{student.pk}/?fields=id,name")
+        self.assertEqual(response.json(), {"id": student.pk, "name": "0"})
+        Student.cached.reset_stats()
+        # 第二次从redis读
+        response = await self.client.get(f"/api/async/students/{student.pk}/")
+        self.assertEqual(response.json()["name"], "0")
+        self.assertEqual(Student.cached.stats(), {"hit": 1, "miss": 0})
+        self.assertEqual((await self.client.get("/api/async/students/0/")).status_code, 404)
+        self.assertEqual((await self.client.get("/api/async/students/1/?fields=abc")).status_code, 400)
+
+    async def test_list(self):
+        response = await self.client.get("/api/async/students/?size=3&fields=name")
+        data = response.json()
+        self.assertEqual([item["name"] for item in data["results"]], ["0", "1", "2"])
+        response = await self.client.get(f"/api/async/students/?size=3&fields=name&after={data['next']}")
+        data = response.json()
+        self.assertEqual([item["name"] for item in data["results"]], ["3", "4"])
+        self.assertIsNone(data["next"])
+
+    async def test_exams(self):
+        student = self.students[0]
+        data = (await self.client.get(f"/api/async/students/{student.pk}/exams/")).json()
+        self.assertEqual((data["count"], data["total"]), (2, 140))
+        exam = data["exams"][0]
+        response = await self.client.get(f"/api/async/exams/{exam['id']}/")
+        self.assertEqual(response.json(), {"id": exam["id"], "student": student.pk, "score": 60})
+
+    def test_redis_per_loop(self):
+        """每个事件循环一个连接池, 事件循环结束的时候关闭"""
+        clients = []
+
+        async def ping():
+            client = get_async_redis()
+            self.assertIs(get_async_redis(), client)
+            await client.ping()
+            clients.append(client)
+            return asyncio.get_running_loop()
+
+        for _ in range(2):
+            loop = asyncio.run(ping())
+            self.assertNotIn(loop, ASYNC_REDIS)
+        self.assertIsNot(clients[0], clients[1])
+        for client in clients:
+            self.assertEqual(client.connection_pool._in_use_connections, set())
+            self.assertFalse(any(connection.is_connected for connection in client.connection_pool._available_connections))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import tempfile
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from school import bench
+from school.consts import REDIS
+from school.models import Klass, Student
+from school.models.base import School
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        Student.objects.bulk_create([
+            Student(name=f"学生{index}", code=f"Code{index}", age=10, info={"grade": index % 3, "room": index})
+            for index in range(20)
+        ])
+        Klass.objects.create(school=School.objects.create(name="学校"))
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_bench(self):
+        output = Path(self.directory.name) / "result.json"
+        count = Student.objects.count()
+        call_command("bench", repeat=3, warmup=1, output=output)
+        data = bench.load(output)
+        self.assertEqual(set(data["results"]), set(bench.SCENARIOS))
+        for stats in data["results"].values():
+            self.assertEqual(stats["repeat"], 3)
+            self.assertLessEqual(stats["p50"], stats["p99"])
+        # 写数据的场景都回滚了
+        self.assertEqual(Student.objects.count(), count)
+
+    def test_compare(self):
+        current = Path(self.directory.name) / "current.json"
+        baseline = Path(self.directory.name) / "baseline.json"
+        call_command("bench", "pk_get", "cache_get", repeat=3, warmup=1, output=current)
+        call_command("bench", input=current, compare=current)
+        data = bench.load(current)
+        data["results"]["pk_get"]["p50"] /= 10
+        bench.save(data, baseline)
+        with self.assertRaisesRegex(CommandError, "pk_get"):
+            call_command("bench", input=current, compare=baseline)
+        statuses = {
+            item["name"]: item["status"]
+            for item in bench.compare(bench.load(current)["results"], data["results"])
+        }
+        self.assertEqual(statuses, {"pk_get": "regression", "cache_get": "same"})
+
+    def test_unknown(self):
+        with self.assertRaises(CommandError):
+            call_command("bench", "nothing")
+
+    def test_repeat(self):
+        with self.assertRaisesRegex(CommandError, "--repeat"):
+            call_command("bench", "pk_get", repeat=0)
+        with self.assertRaisesRegex(CommandError, "--warmup"):
+            call_command("bench", "pk_get", warmup=-1)
+
+    def test_redis(self):
+        """数据库回滚了, 线上的缓存也不能被删掉"""
+        pks = list(Student.objects.values_list("pk", flat=True))
+        Student.cached.get_many(pks)
+        prefix = Student.cached.prefix
+        generation = (REDIS.get(prefix + "generation") or b"0").decode()
+        cached = REDIS.mget([f"{prefix}{generation}:{pk}" for pk in pks])
+        self.assertNotIn(None, cached)
+        call_command("bench", "bulk_update", repeat=2, warmup=0, output=Path(self.directory.name) / "result.json")
+        self.assertEqual((REDIS.get(prefix + "generation") or b"0").decode(), generation)
+        self.assertEqual(REDIS.mget([f"{prefix}{generation}:{pk}" for pk in pks]), cached)
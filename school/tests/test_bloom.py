@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from unittest import mock
+
+from django.core.management import call_command
+from django.db.models.functions import Lower
+from django.test import TestCase
+
+from school.bloom import STUDENT_CODES, BloomFilter
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        # 换成测试用的key, 不要清空真正在用的布隆过滤器
+        patcher = mock.patch.multiple(STUDENT_CODES, **vars(BloomFilter(f"test:{STUDENT_CODES.name}")))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(STUDENT_CODES.clear)
+        STUDENT_CODES.clear()
+        Student.objects.bulk_create([
+            Student(name=str(i), code=f"A{i:03d}", info={}) for i in range(100)
+        ])
+
+    def test_without_filter(self):
+        # 没有重建过, 全部查数据库
+        self.assertEqual(Student.objects.codes_exist(["a001", "B001"]), {"a001"})
+        self.assertEqual(STUDENT_CODES.stats()["queries_saved"], 0)
+
+    def test_codes_exist(self):
+        call_command("rebuild_code_bloom")
+        codes = [f"a{i:03d}" for i in range(0, 200, 2)]
+        self.assertEqual(Student.objects.codes_exist(codes), set(codes[:50]))
+        stats = STUDENT_CODES.stats()
+        LOGGER.info("统计: %s", stats)
+        self.assertEqual(stats["count"], 100)
+        self.assertEqual(stats["confirmed"], 50)
+        self.assertGreater(stats["queries_saved"], 40)
+        Student.objects.create(name="新同学", code="New01", info={})
+        self.assertEqual(Student.objects.codes_exist(["NEW01", "new02"]), {"NEW01"})
+
+    def test_pending(self):
+        def codes():
+            # 重建过程中保存的学生也要加进去
+            Student.objects.create(name="新同学", code="New01", info={})
+            yield from Student.objects.values_list(Lower("code"), flat=True)
+
+        STUDENT_CODES.rebuild(codes(), capacity=100)
+        self.assertEqual(STUDENT_CODES.contains(["new01", "a001"]), [True, True])
+
+    def test_update(self):
+        """update, bulk_create, bulk_update 没有post_save, 也要加入"""
+        call_command("rebuild_code_bloom")
+        Student.objects.filter(code="A001").update(code="U001")
+        Student.objects.bulk_create([Student(name="b", code="B001", info={})])
+        student = Student.objects.get(code="A002")
+        student.code = "C002"
+        Student.objects.bulk_update([student], ["code"])
+        codes = ["u001", "b001", "c002"]
+        self.assertEqual(STUDENT_CODES.contains(codes), [True, True, True])
+        self.assertEqual(Student.objects.codes_exist(codes), set(codes))
+
+    def test_commit_after_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Student.objects.create(name="新同学", code="New01", info={})
+            # 重建读不到还没提交的行
+            STUDENT_CODES.rebuild(["a001"], capacity=100)
+            self.assertEqual(STUDENT_CODES.contains(["new01"]), [False])
+        self.assertEqual(STUDENT_CODES.contains(["new01"]), [True])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from unittest import mock
+
+from django.test import TestCase
+
+from school.models import Student
+from school.models.managers import FILL_SCRIPT
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        # 测试数据库的pk会重复, 先把以前的缓存作废
+        Student.cached.invalidate()
+        Student.cached.reset_stats()
+
+    def test_get(self):
+        student = Student.objects.create(name="小明", info={})
+        self.assertEqual(Student.cached.get(pk=student.pk).name, "小明")
+        self.assertEqual(Student.cached.get(id=str(student.pk)).name, "小明")
+        self.assertEqual(Student.cached.stats(), {"hit": 1, "miss": 1})
+        with self.assertRaises(Student.DoesNotExist):
+            Student.cached.get(pk=student.pk + 1000)
+
+    def test_invalidate(self):
+        student = Student.objects.create(name="小明", info={})
+        other = Student.objects.create(name="小红", info={})
+        self.assertEqual(len(Student.cached.get_many([student.pk, other.pk])), 2)
+        student.name = "小刚"
+        student.save()
+        self.assertEqual(Student.cached.get(pk=student.pk).name, "小刚")
+        Student.objects.filter(pk=other.pk).update(name="小花")
+        self.assertEqual(Student.cached.get(pk=other.pk).name, "小花")
+        other_pk = other.pk
+        other.delete()
+        self.assertEqual(list(Student.cached.get_many([student.pk, other_pk])), [student.pk])
+        LOGGER.info("缓存命中情况: %s", Student.cached.stats())
+
+    def test_race(self):
+        """查完数据库到写回缓存之间, 别的进程修改并删除了缓存, 旧数据不能写回"""
+        student = Student.objects.create(name="小明", info={})
+        fill_args = Student.cached._fill_args
+
+        def save_then_fill(generation, objs):
+            Student.objects.filter(pk=student.pk).update(name="小刚")
+            Student.objects.get(pk=student.pk).save()
+            return fill_args(generation, objs)
+
+        with mock.patch.object(Student.cached, "_fill_args", side_effect=save_then_fill):
+            self.assertEqual(Student.cached.get(pk=student.pk).name, "小明")
+        self.assertEqual(Student.cached.get(pk=student.pk).name, "小刚")
+        # 墓碑也不会被写回覆盖
+        Student.cached.invalidate(student.pk)
+        written = FILL_SCRIPT(
+            keys=[Student.cached.prefix + "generation"],
+            args=Student.cached._fill_args("0", [student]))
+        self.assertEqual(written, 0)
+        self.assertEqual(Student.cached.get(pk=student.pk).name, "小刚")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import csv
+import gzip
+import io
+import json
+import logging
+
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from school import export
+from school.models import Exam, Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.students = [Student.objects.create(name=str(i), info={"grade": i}) for i in range(5)]
+        for score in [60, 80]:
+            Exam.objects.create(student=self.students[0], score=score)
+
+    def test_ndjson(self):
+        counter = export.Counter()
+        chunks = export.export(
+                export.get_queryset(with_exams=True), fields=["id", "exam_total", "exam_max"],
+                with_exams=True, chunk_size=2, counter=counter)
+        rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+        self.assertEqual(counter.rows, 5)
+        self.assertEqual(rows[0], {"id": self.students[0].pk, "exam_total": 140, "exam_max": 80})
+        self.assertEqual(rows[1]["exam_total"], None)
+        with self.assertRaises(ValueError):
+            export.export(export.get_queryset(), fields=["exam_total"])
+
+    def test_csv_gzip(self):
+        chunks = export.export(
+                export.get_queryset(), file_format="csv", fields=["name", "info"], compress=True)
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(chunks)).decode())))
+        self.assertEqual(rows[0], ["name", "info"])
+        self.assertEqual(rows[1], ["0", '{"grade": 0}'])
+        self.assertEqual(len(rows), 6)
+
+    def test_view(self):
+        client = APIClient()
+        response = client.get("/api/students/export/?type=csv&fields=id,exam_count&with_exams=1&gzip=1")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        rows = list(csv.reader(io.StringIO(gzip.decompress(b"".join(response.streaming_content)).decode())))
+        self.assertEqual(rows[1], [str(self.students[0].pk), "2"])
+        self.assertEqual(client.get("/api/students/export/?fields=abc").status_code, 400)
+        self.assertEqual(client.get("/api/students/export/?type=xml").status_code, 400)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from school.family import load_families
+from school.models.relations import Child, Parent
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        # parent_renamed是按事务合并的, setUp里的要先执行掉
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mother = Parent.objects.create(name="妈妈")
+            self.father = Parent.objects.create(name="爸爸")
+            self.other = Parent.objects.create(name="后爸")
+        self.children = [
+            Child.objects.create(mother=self.mother, father=self.father),
+            Child.objects.create(mother=self.mother, father=self.father),
+            Child.objects.create(mother=self.mother, father=self.other),
+        ]
+
+    def test_load(self):
+        with self.assertNumQueries(2):
+            families = load_families([self.mother, self.father.pk])
+            self.assertEqual(len(families[self.mother.pk].children), 3)
+            self.assertEqual(len(families[self.father.pk].children), 2)
+            names = [
+                (child.mother.name, child.father.name)
+                for child in families[self.mother.pk].children
+            ]
+            partners = {parent.name for parent in families[self.mother.pk].partners}
+        self.assertEqual(names, [("妈妈", "爸爸"), ("妈妈", "爸爸"), ("妈妈", "后爸")])
+        self.assertEqual(partners, {"爸爸", "后爸"})
+        self.assertEqual(load_families([]), {})
+
+    def test_father_name(self):
+        self.assertEqual(self.children[0].father_name, "爸爸")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.father.name = "老爸"
+            self.father.save()
+        self.assertEqual(
+                list(Child.objects.order_by("pk").values_list("father_name", flat=True)),
+                ["老爸", "老爸", "后爸"])
+        Child.objects.update(father_name=None)
+        call_command("backfill_father_name", batch_size=2)
+        self.assertEqual(
+                list(Child.objects.order_by("pk").values_list("father_name", flat=True)),
+                ["老爸", "老爸", "后爸"])
+        # 已经一致的不会再更新: 保存家长一条, on_commit里的UPDATE一条, 没有改到孩子
+        with self.assertNumQueries(2), self.assertLogs("school.models.relations", "DEBUG") as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.father.save()
+        self.assertIn("更新了 0 个孩子", logs.output[-1])
+
+
+class TestCommit(TransactionTestCase):
+    """真正提交以后更新孩子的father_name, 不用 captureOnCommitCallbacks"""
+
+    def test(self):
+        father = Parent.objects.create(name="爸爸")
+        child = Child.objects.create(mother=Parent.objects.create(name="妈妈"), father=father)
+        with transaction.atomic():
+            father.name = "老爸"
+            father.save()
+            child.refresh_from_db()
+            self.assertEqual(child.father_name, "爸爸")
+        child.refresh_from_db()
+        self.assertEqual(child.father_name, "老爸")
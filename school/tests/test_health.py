@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from school import health
+from school.consts import REDIS
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@override_settings(HEALTH_CHECKS=["Cache backend: default", "DatabaseBackend", "RedisHealthCheck"])
+class Test(TestCase):
+
+    def setUp(self):
+        REDIS.delete(health.get_key(), health.get_lock_key())
+        health.CACHE.result = None
+        # 测试里不启动后台线程, 直接调用 refresh
+        patcher = mock.patch.object(health.CACHE, "start")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_live(self):
+        response = self.client.get("/health/live/")
+        self.assertEqual((response.status_code, response.content), (200, b"ok"))
+
+    def test_ready(self):
+        self.assertEqual(self.client.get("/health/").status_code, 503)
+        result = health.CACHE.refresh()
+        LOGGER.info("检查结果: %s", result)
+        self.assertTrue(result["healthy"])
+        self.assertEqual(set(result["checks"]), {"Cache backend: default", "DatabaseBackend", "RedisHealthCheck"})
+        response = self.client.get("/health/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["healthy"])
+
+    def test_no_checks(self):
+        """过滤以后一个插件都没有的话什么都不执行, 不能退化成执行所有插件"""
+        with self.assertLogs("school.health", "WARNING"):
+            result = health.run_checks(["不存在"])
+        self.assertEqual(result["checks"], {})
+        self.assertEqual(health.run_checks([])["checks"], {})
+
+    def test_shared(self):
+        """另一个进程拿着锁, 不重复检查, 直接读redis里的结果"""
+        health.CACHE.refresh()
+        other = health.HealthCache()
+        with mock.patch.object(health, "run_checks") as run_checks:
+            self.assertEqual(other.refresh(), health.CACHE.result)
+        run_checks.assert_not_called()
+
+    def test_unhealthy(self):
+        result = health.CACHE.refresh()
+        result["checks"]["DatabaseBackend"]["ok"] = False
+        health.CACHE.result = {**result, "healthy": False}
+        self.assertEqual(self.client.get("/health/").status_code, 503)
+        # 后台线程卡住了, 结果太旧也不健康
+        health.CACHE.result = {**result, "time": time.time() - 3600}
+        self.assertEqual(self.client.get("/health/").status_code, 503)
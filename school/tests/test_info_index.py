@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.db import connection
+from django.test import TestCase
+
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        Student.objects.bulk_create([
+            Student(name=str(i), info={"grade": i % 3 + 1, "room": i})
+            for i in range(10)
+        ])
+        # 数据太少, 不关掉顺序扫描的话不会走索引
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute("RESET enable_seqscan")
+
+    def test_key_eq(self):
+        queryset = Student.objects.info_key_eq("grade", 3)
+        self.assertEqual(queryset.count(), 3)
+        plan = queryset.explain()
+        LOGGER.info("执行计划: %s", plan)
+        self.assertIn("student_info_grade", plan)
+
+    def test_contains(self):
+        queryset = Student.objects.info_contains({"room": 4})
+        self.assertEqual(queryset.get().name, "4")
+        self.assertIn("student_info_gin", queryset.explain())
+        # 没有单独索引的key用 @> 走GIN索引
+        queryset = Student.objects.info_key_eq("room", 4)
+        self.assertEqual(queryset.get().name, "4")
+        self.assertIn("student_info_gin", queryset.explain())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import functools
+import logging
+import time
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from schoolproject.celery import app
+from school.jobs import RangeJob, dump_task
+from school.management.commands.student_grow import Command as StudentGrow
+from school.models import Student
+# eager模式下按名字派发需要先注册任务
+from school.tasks import run_range  # pylint: disable=unused-import  # noqa: F401
+
+
+LOGGER = logging.getLogger(__name__)
+HANDLER = "school.management.commands.student_grow.Command"
+
+
+def failing_range(task, **kwargs) -> int:
+    raise ValueError(task)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        app.conf.task_always_eager = True
+        app.conf.task_eager_propagates = False
+        Student.objects.bulk_create([Student(name=str(i), info={}) for i in range(10)])
+        pks = list(Student.objects.order_by("pk").values_list("pk", flat=True))
+        self.tasks = [("default", pks[0], pks[4]), ("default", pks[5], pks[9])]
+
+    def tearDown(self):
+        app.conf.task_always_eager = False
+
+    def test_dispatch(self):
+        job = RangeJob.create(HANDLER, self.tasks, {"write_mode": "sql"})
+        job.dispatch()
+        progress = job.progress()
+        LOGGER.info("进度: %s", progress)
+        self.assertTrue(progress["complete"])
+        self.assertEqual(progress["rows"], 10)
+        self.assertEqual(sum(stats["ranges"] for stats in progress["workers"].values()), 2)
+        self.assertEqual(Student.objects.filter(age=1).count(), 10)
+        # 已经完成的范围重复投递不会再执行
+        job.dispatch([dump_task(self.tasks[0])])
+        self.assertEqual(Student.objects.filter(age=1).count(), 10)
+        self.assertIn(job.job_id, [item.job_id for item in RangeJob.recent()])
+
+    def test_redistribute(self):
+        job = RangeJob.create(HANDLER, self.tasks, {"write_mode": "bulk"}, lease=60)
+        field = dump_task(self.tasks[0])
+        # 模拟一个worker领取以后死掉了
+        self.assertTrue(job.claim(field, "dead", 60, now=time.time() - 120))
+        self.assertEqual(job.progress()["stale"], 1)
+        self.assertEqual(job.redistribute(), [field])
+        self.assertEqual(job.get_states()[field]["status"], "done")
+        self.assertEqual(job.get_states()[field]["attempts"], 2)
+        # 原来的worker完成时已经不持有这个范围了
+        self.assertFalse(job.finish(field, "dead", 5))
+        self.assertEqual(Student.objects.filter(age=1).count(), 5)
+        self.assertFalse(job.progress()["complete"])
+
+    def test_failed(self):
+        job = RangeJob.create(f"{__name__}.failing_range", self.tasks[:1])
+        job.dispatch()
+        field = dump_task(self.tasks[0])
+        self.assertEqual(job.get_states()[field]["status"], "failed")
+        progress = job.wait(interval=0, max_attempts=2)
+        self.assertEqual(progress["counts"]["failed"], 1)
+        self.assertEqual(job.get_states()[field]["attempts"], 2)
+
+    def test_command_failed(self):
+        """--celery 有范围失败的话命令要报错, 列出失败的范围"""
+        # get_ranges 会关闭数据库连接, 测试里直接用准备好的范围
+        with mock.patch.object(StudentGrow, "get_ranges", return_value=self.tasks), \
+                mock.patch.object(StudentGrow, "handle_single_task", side_effect=ValueError("坏了")), \
+                mock.patch.object(RangeJob, "wait", functools.partialmethod(RangeJob.wait, interval=0)):
+            with self.assertRaisesRegex(CommandError, r"2 个范围失败: default:\d+:\d+ ValueError"):
+                call_command("student_grow", celery=True)
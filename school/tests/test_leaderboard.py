@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from school import leaderboard
+from school.consts import REDIS
+from school.leaderboard import Leaderboard
+from school.models import Exam, Klass, Student
+from school.models.base import School
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        # 测试数据库的pk会重复, 先删掉以前的榜
+        keys = list(REDIS.scan_iter(leaderboard.PREFIX + "*"))
+        if keys:
+            REDIS.delete(*keys)
+        self.school = School.objects.create(name="学校")
+        self.students = [Student.objects.create(name=str(i), info={}) for i in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass = Klass.objects.create(school=self.school)
+            self.klass.students.add(*self.students[:3])
+            for score, student in zip([60, 90, 80, 70], self.students):
+                Exam.objects.create(student=student, score=score)
+
+    def test_incremental(self):
+        board = Leaderboard.of_klass(self.klass.pk)
+        student0, student1, student2, student3 = [student.pk for student in self.students]
+        self.assertEqual(board.top(2), [(student1, 90), (student2, 80)])
+        self.assertEqual(Leaderboard.of_global().rank(student3), 3)
+        self.assertIsNone(board.rank(student3))
+        with self.captureOnCommitCallbacks(execute=True):
+            exam = Exam.objects.create(student_id=student0, score=50)
+            exam.score = 40
+            exam.save()
+        self.assertEqual(board.top(1), [(student0, 100)])
+        self.assertEqual(Leaderboard.of_school(self.school.pk).rank(student0), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            exam.delete()
+            self.klass.students.remove(student2)
+            self.klass.students.add(student3)
+        self.assertEqual(board.top(), [(student1, 90), (student3, 70), (student0, 60)])
+        self.assertEqual(leaderboard.check(), set())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.students[1].delete()
+        self.assertEqual(board.count(), 2)
+        self.assertIsNone(Leaderboard.of_global().score(student1))
+
+    def test_rebuild(self):
+        student0 = self.students[0].pk
+        Exam.objects.filter(student_id=student0).update(score=99)
+        self.assertEqual(leaderboard.check(), {student0})
+        Leaderboard.of_klass(self.klass.pk + 1000).delete()
+        REDIS.zadd(Leaderboard.of_klass(self.klass.pk + 1000).key, {student0: 1})
+        self.assertEqual(leaderboard.rebuild(batch_size=2), 4)
+        self.assertEqual(leaderboard.check(), set())
+        self.assertEqual(Leaderboard.of_klass(self.klass.pk).top(1), [(student0, 99)])
+        self.assertEqual(Leaderboard.of_klass(self.klass.pk + 1000).count(), 0)
+
+
+class TestCommit(TransactionTestCase):
+    """真正提交以后才更新榜, 不用 captureOnCommitCallbacks"""
+
+    def test(self):
+        keys = list(REDIS.scan_iter(leaderboard.PREFIX + "*"))
+        if keys:
+            REDIS.delete(*keys)
+        school = School.objects.create(name="学校")
+        student1, student2 = [Student.objects.create(name=str(i), info={}) for i in range(2)]
+        with transaction.atomic():
+            klass = Klass.objects.create(school=school)
+            klass.students.add(student1)
+            exam = Exam.objects.create(student=student1, score=60)
+            Exam.objects.create(student=student2, score=80)
+        board = Leaderboard.of_klass(klass.pk)
+        self.assertEqual(board.top(), [(student1.pk, 60)])
+        self.assertEqual(Leaderboard.of_global().top(), [(student2.pk, 80), (student1.pk, 60)])
+        with transaction.atomic():
+            exam.delete()
+            klass.students.add(student2)
+        self.assertEqual(board.top(), [(student2.pk, 80)])
+        self.assertIsNone(Leaderboard.of_global().score(student1.pk))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import io
+import logging
+import os
+import tempfile
+import time
+
+from django.test import TestCase
+
+from schoolproject.log_handlers import QueueHandler, SafeRotatingFileHandler, SafeTimedRotatingFileHandler, install
+from schoolproject.log_sampling import SamplingFilter
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_logger(name: str, handler: logging.Handler) -> logging.Logger:
+    logger = logging.getLogger(f"school.tests.log_handlers.{name}")
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+class Test(TestCase):
+
+    def test_queue(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setLevel(logging.INFO)
+        logger = get_logger("queue", target)
+        handlers = install([logger.name], batch_size=10)
+        self.assertEqual(logger.handlers, handlers)
+        for index in range(25):
+            logger.info("第%d条", index)
+        logger.debug("debug不写")
+        handlers[0].flush()
+        self.assertEqual(stream.getvalue().splitlines(), [f"第{index}条" for index in range(25)])
+        handlers[0].close()
+
+    def test_queue_sampling(self):
+        """抽样在进队列之前, 抽掉的日志不占队列"""
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        logger = get_logger("sampling", target)
+        sampling = SamplingFilter({logger.name: {"rate": 3, "sample": 0}}, interval=3600)
+        self.addCleanup(sampling.sites.clear)
+        target.addFilter(sampling)
+        handlers = install([logger.name], maxsize=5, policy="drop")
+        self.assertIn(sampling, handlers[0].filters)
+        # 后台线程写不了, 没有抽样的话队列很快就满了
+        target.acquire()
+        try:
+            for index in range(20):
+                logger.info("第%d条", index)
+        finally:
+            target.release()
+        handlers[0].flush()
+        self.assertEqual(stream.getvalue().splitlines(), ["第0条", "第1条", "第2条"])
+        handlers[0].close()
+
+    def test_drop(self):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        handler = QueueHandler([target], maxsize=2, policy="drop")
+        logger = get_logger("drop", handler)
+        # 后台线程拿不到锁, 写不了, 队列很快就满了
+        target.acquire()
+        try:
+            for index in range(20):
+                logger.info("第%d条", index)
+        finally:
+            target.release()
+        handler.flush()
+        lines = stream.getvalue().splitlines()
+        self.assertIn("第0条", lines)
+        self.assertLess(len(lines), 20)
+        self.assertTrue(lines[-1].startswith("日志队列满了"), lines)
+        handler.close()
+
+    def test_rotate(self):
+        """两个进程都要轮转同一个文件, 第二个只重新打开, 不能删掉第一个轮转出来的文件"""
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "test.log")
+            first = SafeTimedRotatingFileHandler(filename, when="S")
+            second = SafeTimedRotatingFileHandler(filename, when="S")
+            first_logger = get_logger("first", first)
+            second_logger = get_logger("second", second)
+            first_logger.info("first 1")
+            second_logger.info("second 1")
+            rollover_at = int(time.time())
+            first.rolloverAt = second.rolloverAt = rollover_at
+            first_logger.info("first 2")
+            second_logger.info("second 2")
+            first.close()
+            second.close()
+            rotated_files = [
+                name for name in os.listdir(directory)
+                if name.startswith("test.log.") and name != "test.log.lock"
+            ]
+            self.assertEqual(len(rotated_files), 1)
+            with open(os.path.join(directory, rotated_files[0]), encoding="utf-8") as f:
+                self.assertEqual(f.read().splitlines(), ["first 1", "second 1"])
+            with open(filename, encoding="utf-8") as f:
+                self.assertEqual(f.read().splitlines(), ["first 2", "second 2"])
+
+    def test_makedirs(self):
+        """创建handler的时候不创建目录, 第一次写日志的时候才创建"""
+        with tempfile.TemporaryDirectory() as directory:
+            for index, handler_class in enumerate([SafeRotatingFileHandler, SafeTimedRotatingFileHandler]):
+                filename = os.path.join(directory, str(index), "command", "info.log")
+                handler = handler_class(filename, delay=True)
+                self.assertFalse(os.path.exists(os.path.dirname(filename)))
+                get_logger(f"makedirs{index}", handler).info("第一条")
+                handler.close()
+                with open(filename, encoding="utf-8") as f:
+                    self.assertEqual(f.read().splitlines(), ["第一条"])
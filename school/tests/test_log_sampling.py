@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import io
+import json
+import logging
+from typing import Dict, List, Tuple
+
+from django.test import TestCase
+
+from schoolproject.log_sampling import JsonFormatter, SamplingFilter
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def get_logger(self, sampling_filter: SamplingFilter, count: int = 1) -> Tuple[logging.Logger, List[io.StringIO]]:
+        logger = logging.getLogger("school.tests.log_sampling")
+        streams = [io.StringIO() for _ in range(count)]
+        logger.handlers = []
+        for stream in streams:
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(JsonFormatter())
+            handler.addFilter(sampling_filter)
+            logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        return logger, streams
+
+    def count(self, stream: io.StringIO) -> Dict[str, int]:
+        """每个event实际调用的次数"""
+        result: Dict[str, int] = {}
+        for line in stream.getvalue().splitlines():
+            data = json.loads(line)
+            count = data.get("suppressed", 0) + (0 if data.get("summary") else 1)
+            result[data["event"]] = result.get(data["event"], 0) + count
+        return result
+
+    def test_rate(self):
+        sampling_filter = SamplingFilter({"school.tests": {"rate": 3}})
+        logger, [stream] = self.get_logger(sampling_filter)
+        for index in range(10):
+            logger.info("第%d次", index)
+            logger.warning("警告%d", index)
+        self.assertEqual(len(stream.getvalue().splitlines()), 3 + 10)
+        sampling_filter.flush()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(lines[-1]["suppressed"], 7)
+        self.assertTrue(lines[-1]["summary"])
+        self.assertEqual(lines[-1]["event"], "第%d次")
+        self.assertEqual(self.count(stream), {"第%d次": 10, "警告%d": 10})
+
+    def test_sample(self):
+        """按概率抽样, 所有handler结果一样, 总数准确"""
+        sampling_filter = SamplingFilter({"school.tests.log_sampling:test_sample": {"rate": 5, "sample": 0.1}})
+        logger, streams = self.get_logger(sampling_filter, count=2)
+        for index in range(1000):
+            logger.info("第%d次", index, extra={"index": index})
+        sampling_filter.flush()
+        self.assertEqual(streams[0].getvalue(), streams[1].getvalue())
+        lines = streams[0].getvalue().splitlines()
+        self.assertLess(len(lines), 300)
+        self.assertEqual(json.loads(lines[0])["index"], 0)
+        self.assertEqual(self.count(streams[0]), {"第%d次": 1000})
+
+    def test_no_rule(self):
+        sampling_filter = SamplingFilter({"school.other": {"rate": 1}})
+        logger, [stream] = self.get_logger(sampling_filter)
+        for index in range(10):
+            logger.info("第%d次", index)
+        self.assertEqual(len(stream.getvalue().splitlines()), 10)
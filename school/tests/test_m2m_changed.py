@@ -3,26 +3,83 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+import json
 import logging
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 
-from school.models.relations import Klass, Student
+from school.consts import REDIS
+from school.models.base import School
+from school.models.relations import Klass, Student, KLASS_STUDENTS_STREAM
 
 
 LOGGER = logging.getLogger(__name__)
 
 
-class Test(TestCase):
+class StreamMixin:
+
+    def setUp(self):
+        last = REDIS.xrevrange(KLASS_STUDENTS_STREAM, count=1)
+        self.last_id = last[0][0].decode() if last else "0"
+
+    def get_changes(self):
+        """返回这个测试里写入stream的 {klass_id: (added, removed)}"""
+        result = {}
+        for _, data in REDIS.xrange(KLASS_STUDENTS_STREAM, min=f"({self.last_id}"):
+            result[int(data[b"klass"])] = (
+                    set(json.loads(data[b"added"])),
+                    set(json.loads(data[b"removed"])),
+            )
+        return result
+
+
+class Test(StreamMixin, TestCase):
+
+    def test(self):
+        school = School.objects.create()
+        student1 = Student.objects.create(info={})
+        student2 = Student.objects.create(info={})
+        with self.captureOnCommitCallbacks(execute=True):
+            klass = Klass.objects.create(school=school)
+            LOGGER.info("单独add")
+            klass.students.add(student1)
+            LOGGER.info("set +1 -1")
+            klass.students.set([student2])
+            LOGGER.info("remove")
+            klass.students.remove(student2)
+            LOGGER.info("反向 add")
+            student1.klass_set.add(klass)
+        self.assertEqual(self.get_changes(), {klass.id: ({student1.id}, set())})
+
+    def test_clear(self):
+        school = School.objects.create()
+        student1 = Student.objects.create(info={})
+        student2 = Student.objects.create(info={})
+        klass1 = Klass.objects.create(school=school)
+        klass2 = Klass.objects.create(school=school)
+        with self.captureOnCommitCallbacks(execute=True):
+            klass1.students.add(student1, student2)
+        self.setUp()
+        with self.captureOnCommitCallbacks(execute=True):
+            klass1.students.clear()
+            klass1.students.add(student2)
+            student1.klass_set.add(klass2)
+        self.assertEqual(self.get_changes(), {
+            klass1.id: (set(), {student1.id}),
+            klass2.id: ({student1.id}, set()),
+        })
+
+
+class TestCommit(StreamMixin, TransactionTestCase):
+    """真正提交以后才写stream, 不用 captureOnCommitCallbacks"""
 
     def test(self):
-        student1 = Student.objects.create()
-        student2 = Student.objects.create()
-        klass = Klass.objects.create()
-        LOGGER.info("单独add")
-        klass.students.add(student1)
-        LOGGER.info("set +1 -1")
-        klass.students.set([student2])
-        LOGGER.info("remove")
-        klass.students.remove(student2)
-        LOGGER.info("反向 add")
-        student1.klass_set.add(klass)
+        school = School.objects.create()
+        student1 = Student.objects.create(info={})
+        student2 = Student.objects.create(info={})
+        with transaction.atomic():
+            klass = Klass.objects.create(school=school)
+            klass.students.add(student1, student2)
+            klass.students.remove(student2)
+            self.assertEqual(self.get_changes(), {})
+        self.assertEqual(self.get_changes(), {klass.id: ({student1.id}, set())})
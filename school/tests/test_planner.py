@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from unittest import mock
+
+from django.test import TestCase
+
+from school.commands import WriteBackCommand
+from school.management.commands.student_grow import Command as StudentGrow
+from school.models import Student
+from school.planner import plan_ranges
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        Student.objects.bulk_create([Student(name=str(i), info={}) for i in range(25)])
+        # 制造一些主键空洞
+        Student.objects.filter(pk__in=Student.objects.order_by("pk").values("pk")[5:10]).delete()
+
+    def test_rows(self):
+        ranges = list(plan_ranges(Student.objects.all(), chunk_rows=6))
+        LOGGER.info("范围: %s", ranges)
+        counts = [Student.objects.filter(pk__gte=start, pk__lte=end).count() for start, end in ranges]
+        self.assertEqual(counts, [6, 6, 6, 2])
+        self.assertEqual(ranges[-1][1], Student.objects.order_by("pk").last().pk)
+
+    def test_width(self):
+        queryset = Student.objects.filter(age=0)
+        ranges = list(plan_ranges(queryset, chunk_rows=6, strategy="width"))
+        self.assertEqual(
+                sum(queryset.filter(pk__gte=start, pk__lte=end).count() for start, end in ranges),
+                20)
+
+    def test_empty(self):
+        self.assertEqual(list(plan_ranges(Student.objects.none(), chunk_rows=6)), [])
+
+    def test_max_task(self):
+        """多个分片加起来也不超过 MAX_TASK, 够了以后不再给后面的分片拆分范围"""
+        command = StudentGrow()
+        command.databases = ["default", "db_02"]
+        with mock.patch.object(StudentGrow, "MAX_TASK", 3), mock.patch.object(StudentGrow, "get_queryset"), \
+                mock.patch("school.commands.plan_ranges", return_value=[(1, 1), (2, 2), (3, 3)]) as plan, \
+                mock.patch("school.commands.connections"):
+            # student_grow 的 get_ranges 会先把age清零, 这里只测父类的
+            self.assertEqual(WriteBackCommand.get_ranges(command), [
+                ("default", 1, 1), ("default", 2, 2), ("default", 3, 3),
+            ])
+        self.assertEqual(plan.call_count, 1)
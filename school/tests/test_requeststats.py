@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import threading
+from unittest import mock
+
+from django.core.management import call_command
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.urls import resolve
+
+from school import requeststats
+from school.consts import REDIS
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@override_settings(REQUEST_STATS_SAMPLE=1, REQUEST_STATS_HEADER=True, REQUEST_STATS_REPEAT=5)
+class Test(TestCase):
+
+    def setUp(self):
+        requeststats.reset()
+        self.students = [Student.objects.create(name=str(i), info={}) for i in range(6)]
+
+    def test_shape(self):
+        self.assertEqual(
+            requeststats.get_shape('SELECT "id" FROM "t" WHERE "id" IN (%s, %s, %s)'),
+            requeststats.get_shape('SELECT "id" FROM "t" WHERE "id" IN (%s, %s)'),
+        )
+
+    def test_n_plus_one(self):
+        def view(request: HttpRequest) -> HttpResponse:
+            for student in self.students:
+                Student.objects.get(pk=student.pk)
+            REDIS.get("school:test")
+            pipeline = REDIS.pipeline(transaction=False)
+            pipeline.get("school:test")
+            pipeline.get("school:test")
+            pipeline.execute()
+            return HttpResponse("ok")
+
+        request = RequestFactory().get(f"/api/async/students/{self.students[0].pk}/")
+        request.resolver_match = resolve(request.path)
+        with self.assertLogs("school.requeststats", "WARNING"):
+            response = requeststats.RequestStatsMiddleware(view)(request)
+        self.assertIn('db;dur=', response["Server-Timing"])
+        self.assertIn('"6 queries"', response["Server-Timing"])
+        self.assertIn('"2 calls"', response["Server-Timing"])
+        requeststats.flush()
+        stats = requeststats.get_stats("GET api/async/students/<int:pk>/")
+        LOGGER.info("统计: %s", stats)
+        self.assertEqual((stats["count"], stats["queries_avg"], stats["n_plus_one"]), (1, 6, 1))
+        self.assertEqual(list(stats["shapes"].values()), [1])
+        # 统计本身写redis不算在请求里
+        self.assertEqual(stats["cache_calls_avg"], 2)
+        call_command("request_stats", order="n_plus_one")
+
+    def test_client(self):
+        response = self.client.get("/api/students/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Server-Timing", response)
+        requeststats.flush()
+        self.assertEqual(len(requeststats.get_names()), 1)
+
+    async def test_async(self):
+        Student.cached.invalidate()
+        student = self.students[0]
+        response = await AsyncClient().get(f"/api/async/students/{student.pk}/")
+        self.assertEqual(response.status_code, 200)
+        # 缓存没命中, 查一次数据库, 读写redis
+        self.assertIn('"1 queries"', response["Server-Timing"])
+        self.assertNotIn('"0 calls"', response["Server-Timing"])
+
+    def test_streaming(self):
+        """流式响应的SQL在视图返回以后执行, 迭代完才统计"""
+        def content():
+            for student in self.students:
+                yield Student.objects.get(pk=student.pk).name
+
+        request = RequestFactory().get("/api/students/")
+        request.resolver_match = resolve(request.path)
+        response = requeststats.RequestStatsMiddleware(
+            lambda request: StreamingHttpResponse(content()))(request)
+        self.assertNotIn("Server-Timing", response)
+        requeststats.flush()
+        self.assertEqual(requeststats.get_names(), [])
+        with self.assertLogs("school.requeststats", "WARNING"):
+            self.assertEqual(b"".join(response.streaming_content), b"012345")
+        requeststats.flush()
+        stats = requeststats.get_stats(requeststats.get_names()[0])
+        self.assertEqual((stats["count"], stats["queries_avg"], stats["n_plus_one"]), (1, 6, 1))
+
+    async def test_async_flush(self):
+        """异步请求不在事件循环的线程里写redis"""
+        async def view(request: HttpRequest) -> HttpResponse:
+            return HttpResponse("ok")
+
+        threads = []
+        request = RequestFactory().get("/api/students/")
+        request.resolver_match = resolve(request.path)
+        requeststats.LAST_FLUSH[0] = 0
+        with mock.patch.object(requeststats, "flush", side_effect=lambda: threads.append(threading.current_thread())):
+            await requeststats.RequestStatsMiddleware(view)(request)
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    @override_settings(REQUEST_STATS_SAMPLE=0)
+    def test_disabled(self):
+        response = self.client.get("/api/students/")
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(REQUEST_STATS_SAMPLE=0.5)
+    def test_sample(self):
+        with mock.patch.object(requeststats.random, "random", side_effect=[0.4, 0.6]):
+            self.assertIn("Server-Timing", self.client.get("/api/students/"))
+            self.assertNotIn("Server-Timing", self.client.get("/api/students/"))
+        requeststats.flush()
+        self.assertEqual(requeststats.get_stats(requeststats.get_names()[0])["count"], 1)
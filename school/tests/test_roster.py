@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from school import roster
+from school.consts import REDIS
+from school.models import Klass, Student
+from school.models.base import School
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        # 测试数据库的pk会重复, 先删掉以前的缓存
+        keys = [*REDIS.scan_iter("school:klass:*:roster*"), roster.SCHOOL_COUNTS_KEY]
+        REDIS.delete(*keys)
+        self.school = School.objects.create(name="学校")
+        self.klass1 = Klass.objects.create(school=self.school)
+        self.klass2 = Klass.objects.create(school=self.school)
+        self.students = [Student.objects.create(name=str(i), info={}) for i in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass1.students.add(*self.students[:3])
+            self.klass2.students.add(*self.students[2:])
+
+    def assert_cached(self):
+        """缓存和数据库一致"""
+        for klass in [self.klass1, self.klass2]:
+            self.assertEqual(
+                    list(roster.get_roster(klass.pk)),
+                    sorted(klass.students.values_list("pk", flat=True)))
+        self.assertEqual(
+                roster.get_school_count(self.school.pk),
+                roster.load_school_count(self.school.pk))
+
+    def test_roster(self):
+        student0, _, student2, student3 = [student.pk for student in self.students]
+        # 第一次从数据库加载
+        self.assertEqual(list(roster.get_roster(self.klass1.pk)), sorted([student0, self.students[1].pk, student2]))
+        self.assertTrue(roster.contains(self.klass1.pk, student0))
+        self.assertFalse(roster.contains(self.klass1.pk, student3))
+        self.assertTrue(roster.contains(self.klass2.pk, student3))
+        self.assertEqual(roster.get_klass_counts([self.klass1.pk, self.klass2.pk]), {
+            self.klass1.pk: 3, self.klass2.pk: 2,
+        })
+        self.assertEqual(roster.get_school_count(self.school.pk), 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass1.students.remove(student0)
+            self.klass1.students.add(student3)
+            self.klass2.students.clear()
+        self.assertFalse(roster.contains(self.klass1.pk, student0))
+        self.assertTrue(roster.contains(self.klass1.pk, student3))
+        self.assertEqual(roster.get_klass_counts([self.klass2.pk]), {self.klass2.pk: 0})
+        self.assertEqual(roster.get_school_count(self.school.pk), 3)
+        self.assert_cached()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.students[1].delete()
+        self.assertEqual(roster.get_school_count(self.school.pk), 2)
+        self.assert_cached()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass1.delete()
+        self.assertEqual(roster.get_school_count(self.school.pk), 0)
+
+    def test_remove_non_member(self):
+        """remove不在班级里的学生, 人数不变"""
+        outsider = Student.objects.create(name="outsider", info={})
+        self.assertEqual(roster.get_school_count(self.school.pk), 4)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass1.students.remove(outsider)
+            outsider.klass_set.remove(self.klass2)
+        self.assertEqual(roster.get_school_count(self.school.pk), 4)
+        self.assertEqual(roster.get_klass_counts([self.klass1.pk]), {self.klass1.pk: 3})
+        self.assert_cached()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.klass1.students.remove(self.students[0], outsider)
+        self.assertEqual(roster.get_school_count(self.school.pk), 3)
+        self.assert_cached()
+
+
+class TestCommit(TransactionTestCase):
+    """真正提交以后更新缓存, 不用 captureOnCommitCallbacks"""
+
+    def test(self):
+        REDIS.delete(*REDIS.scan_iter("school:klass:*:roster*"), roster.SCHOOL_COUNTS_KEY)
+        school = School.objects.create(name="学校")
+        klass = Klass.objects.create(school=school)
+        student1, student2 = [Student.objects.create(name=str(i), info={}) for i in range(2)]
+        klass.students.add(student1)
+        # 先加载到缓存里
+        self.assertEqual(list(roster.get_roster(klass.pk)), [student1.pk])
+        self.assertEqual(roster.get_school_count(school.pk), 1)
+        with transaction.atomic():
+            klass.students.remove(student1)
+            klass.students.add(student2)
+        self.assertEqual(list(roster.get_roster(klass.pk)), [student2.pk])
+        self.assertEqual(roster.get_school_count(school.pk), 1)
+        with transaction.atomic():
+            student1.klass_set.add(klass)
+        self.assertEqual(list(roster.get_roster(klass.pk)), sorted([student1.pk, student2.pk]))
+        self.assertEqual(roster.get_school_count(school.pk), 2)
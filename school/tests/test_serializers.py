@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.db.models import Q
+from django.test import TestCase
+
+from school.models import Student
+from school.models.base import DateTimeModel
+from school.serializers import (
+    AliasSerializer, CompiledSerializer, DateTimeModelSerializer, StudentSerializer,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        Student.objects.create(name="小明", code="A1", height=170, info={"grade": 1})
+        Student.objects.create(name="小红", info={})
+        DateTimeModel.objects.create()
+
+    def test_same_as_drf(self):
+        for serializer_class, queryset in [
+                (StudentSerializer, Student.objects.order_by("pk")),
+                (DateTimeModelSerializer, DateTimeModel.objects.all()),
+        ]:
+            self.assertEqual(
+                    CompiledSerializer(serializer_class).serialize(queryset),
+                    serializer_class(queryset, many=True).data)
+
+    def test_fields(self):
+        compiled = CompiledSerializer(StudentSerializer, fields=["name", "height"])
+        self.assertEqual(compiled.lookups, ["name", "height"])
+        self.assertEqual(
+                list(compiled.iterator(Student.objects.order_by("pk"))),
+                [{"name": "小明", "height": 170}, {"name": "小红", "height": None}])
+
+    def test_alias(self):
+        queryset = Student.objects.annotate(性别=Q(height__gt=0)).order_by("pk")
+        self.assertEqual(
+                CompiledSerializer(AliasSerializer).serialize(queryset),
+                [{"gender": True}, {"gender": None}])
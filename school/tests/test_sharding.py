@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import json
+import logging
+import threading
+from unittest import mock
+
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+
+from school import export
+from school.models import Exam, Klass, Student
+from school.models.base import School
+from school.sharding import FanOut, enroll
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+@override_settings(
+    SHARDS=["default", "db_02"],
+    DATABASE_ROUTERS=["school.sharding.ShardRouter"],
+)
+class Test(TestCase):
+    databases = {"default", "db_02"}
+
+    def setUp(self):
+        for pk in range(1, 6):
+            Student(pk=pk, name=f"学生{pk}", info={}).save()
+        Student.cached.invalidate()
+
+    def test_route(self):
+        self.assertEqual(Student.objects.using("default").count(), 3)
+        self.assertEqual(Student.objects.using("db_02").count(), 2)
+        student = FanOut(Student.objects.all()).get(pk=2)
+        self.assertEqual(student._state.db, "db_02")
+        self.assertEqual(Exam.objects.create(student=student, score=90)._state.db, "db_02")
+        self.assertEqual(student.exam_set.create(score=80)._state.db, "db_02")
+        self.assertEqual(student.exam_set.count(), 2)
+
+    def test_fan_out(self):
+        self.assertEqual(FanOut(Student.objects.all()).count(), 5)
+        self.assertEqual(FanOut(Student.objects.filter(pk__gt=3)).count(), 2)
+        self.assertEqual(
+                [student.pk for student in FanOut(Student.objects.order_by("-pk")[1:4]).list()],
+                [4, 3, 2])
+        self.assertEqual(
+                sorted(student.pk for student in FanOut(Student.objects.all()).iterator()),
+                [1, 2, 3, 4, 5])
+
+    def test_klass(self):
+        school = School.objects.create(name="学校")
+        klass = Klass.objects.create(school=school)
+        self.assertTrue(Klass.objects.using("db_02").filter(pk=klass.pk).exists())
+        students = FanOut(Student.objects.filter(pk__lte=2)).list()
+        with mock.patch("school.roster.apply") as apply, \
+                self.captureOnCommitCallbacks(using="db_02", execute=True):
+            enroll(klass, students)
+        # db_02 上的学生也发出了 m2m_changed, 提交后更新花名册
+        apply.assert_called_once_with("db_02", {klass.pk: ({2}, set())})
+        for student in students:
+            self.assertEqual(list(student.klass_set.all()), [klass])
+        school.delete()
+        self.assertFalse(Klass.objects.using("db_02").exists())
+
+    def test_point_lookup(self):
+        """pk=2 在db_02上, 每种点查询都要找到"""
+        self.assertTrue(Student.objects.filter(pk=2).exists())
+        self.assertEqual(Student.objects.get(pk=2)._state.db, "db_02")
+        self.assertEqual(Student.objects.get(id="2").name, "学生2")
+        student = Student.cached.get(pk=2)
+        self.assertEqual((student.name, student._state.db), ("学生2", "db_02"))
+        # 第二次从缓存读, 数据库还是对的
+        self.assertEqual(Student.cached.get(pk=2)._state.db, "db_02")
+        self.assertEqual(set(Student.cached.get_many([1, 2, 3])), {1, 2, 3})
+        Student.objects.filter(pk=2).update(age=9)
+        self.assertEqual(Student.objects.using("db_02").get(pk=2).age, 9)
+        exam = Exam.objects.create(student=student, score=90)
+        self.assertEqual(Exam.objects.get(pk=exam.pk).score, 90)
+        self.assertEqual(Exam.objects.filter(student_id=2).count(), 1)
+
+    def test_views(self):
+        exam = Exam.objects.create(student=Student.objects.get(pk=2), score=90)
+        response = self.client.get("/api/students/2/")
+        self.assertEqual(response.json()["name"], "学生2")
+        chunks = export.export(export.get_queryset(with_exams=True), fields=["id", "exam_total"], with_exams=True)
+        rows = [json.loads(line) for line in b"".join(chunks).decode().splitlines()]
+        self.assertEqual(sorted(row["id"] for row in rows), [1, 2, 3, 4, 5])
+        self.assertIn({"id": 2, "exam_total": 90}, rows)
+        self.assertEqual(exam._state.db, "db_02")
+
+    async def test_async_views(self):
+        exam = await Exam.objects.acreate(student=await Student.objects.aget(pk=2), score=90)
+        client = AsyncClient()
+        self.assertEqual((await client.get("/api/async/students/2/")).json()["name"], "学生2")
+        self.assertEqual(await Student.cached.aget(pk=2), await Student.objects.aget(pk=2))
+        data = (await client.get("/api/async/students/2/exams/")).json()
+        self.assertEqual((data["count"], data["total"]), (1, 90))
+        self.assertEqual((await client.get(f"/api/async/exams/{exam.pk}/")).json()["score"], 90)
+
+
+@override_settings(
+    SHARDS=["default", "db_02"],
+    DATABASE_ROUTERS=["school.sharding.ShardRouter"],
+)
+class TestIterator(TransactionTestCase):
+    """不在事务里 FanOut.iterator 才会开线程"""
+    databases = {"default", "db_02"}
+
+    def test_close(self):
+        """只取第一个就不读了, 生产线程要退出"""
+        for pk in range(1, 21):
+            Student(pk=pk, name=f"学生{pk}", info={}).save()
+        iterator = FanOut(Student.objects.all()).iterator(chunk_size=1)
+        next(iterator)
+        threads = [thread for thread in threading.enumerate() if thread.name.startswith("school-fanout-")]
+        self.assertEqual(len(threads), 2)
+        iterator.close()
+        for thread in threads:
+            thread.join(timeout=5)
+            self.assertFalse(thread.is_alive())
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+from typing import List
+
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase
+
+from school.models.relations import Lesson
+from school.signals import batched
+
+
+LOGGER = logging.getLogger(__name__)
+BATCHES: List[List[str]] = []
+
+
+@batched
+def record(sender, using, calls, **kwargs):
+    BATCHES.append([call["instance"].title for call in calls])
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        BATCHES.clear()
+        post_save.connect(record, Lesson)
+        self.addCleanup(post_save.disconnect, record, Lesson)
+
+    def test(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Lesson.objects.create(title="语文")
+            Lesson.objects.create(title="数学")
+        self.assertEqual(BATCHES, [["语文", "数学"]])
+
+    def test_rollback(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                Lesson.objects.create(title="语文")
+                raise ValueError("回滚")
+            Lesson.objects.create(title="数学")
+        self.assertEqual(BATCHES, [["数学"]])
+
+    def test_nested_rollback(self):
+        """外层事务提交, 里面回滚的savepoint里的调用要丢弃"""
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Lesson.objects.create(title="A")
+                with self.assertRaises(ValueError), transaction.atomic():
+                    Lesson.objects.create(title="B-rolledback")
+                    raise ValueError("回滚")
+                with transaction.atomic():
+                    Lesson.objects.create(title="C")
+        self.assertEqual(BATCHES, [["A", "C"]])
+        self.assertEqual(sorted(Lesson.objects.values_list("title", flat=True)), ["A", "C"])
+
+
+class TestCommit(TransactionTestCase):
+    """真正的提交: django先清空 run_on_commit 再执行回调, captureOnCommitCallbacks 看不到这个区别"""
+
+    def setUp(self):
+        BATCHES.clear()
+        post_save.connect(record, Lesson)
+        self.addCleanup(post_save.disconnect, record, Lesson)
+
+    def test(self):
+        with transaction.atomic():
+            Lesson.objects.create(title="语文")
+        self.assertEqual(BATCHES, [["语文"]])
+
+    def test_many(self):
+        with transaction.atomic():
+            for title in ["语文", "数学", "英语"]:
+                Lesson.objects.create(title=title)
+        self.assertEqual(BATCHES, [["语文", "数学", "英语"]])
+
+    def test_nested_rollback(self):
+        with transaction.atomic():
+            Lesson.objects.create(title="A")
+            with self.assertRaises(ValueError), transaction.atomic():
+                Lesson.objects.create(title="B-rolledback")
+                raise ValueError("回滚")
+            with transaction.atomic():
+                Lesson.objects.create(title="C")
+        self.assertEqual(BATCHES, [["A", "C"]])
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError), transaction.atomic():
+            Lesson.objects.create(title="A")
+            raise ValueError("回滚")
+        self.assertEqual(BATCHES, [])
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import subprocess
+import sys
+
+from django.test import TestCase
+
+from school import startup
+from school.consts import REDIS, register_script
+
+
+LOGGER = logging.getLogger(__name__)
+STDERR = """import time: self [us] | cumulative | imported package
+import time:       248 |        248 |   django_redis.util
+import time:      1021 |       1269 | django_redis
+import time:        30 |         30 | school
+"""
+
+
+class Test(TestCase):
+
+    def test_parse(self):
+        imports = startup.parse_importtime(STDERR)
+        self.assertEqual(imports[0], startup.ImportTime("django_redis.util", 1, 248, 248))
+        self.assertEqual(imports[1].depth, 0)
+        self.assertEqual(startup.group_by_package(imports), {"django_redis": 1269, "school": 30})
+
+    def test_lazy_redis(self):
+        code = (
+            "import os, sys; os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'schoolproject.settings');"
+            "import django; django.setup(); import school.models, school.jobs, school.roster;"
+            "print('django_redis.client.default' in sys.modules)"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code], cwd=startup.BASE_DIR,
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip().splitlines()[-1], "False")
+
+    def test_script(self):
+        script = register_script("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+        REDIS.delete("school:test:startup")
+        self.assertEqual(script(keys=["school:test:startup"], args=[2]), 2)
+        pipeline = REDIS.pipeline()
+        script(keys=["school:test:startup"], args=[3], client=pipeline)
+        self.assertEqual(pipeline.execute(), [5])
+        REDIS.delete("school:test:startup")
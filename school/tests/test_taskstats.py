@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+import time
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from school import taskstats
+from school.tasks import add
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        taskstats.reset()
+
+    def test_bucket(self):
+        for seconds in [0.00005, 0.001, 0.123, 5]:
+            bucket = taskstats.get_bucket(seconds)
+            self.assertLessEqual(seconds, taskstats.get_bucket_bound(bucket))
+            self.assertLess(taskstats.get_bucket_bound(bucket), max(seconds, taskstats.BUCKET_BASE) * 1.2)
+
+    def test_stats(self):
+        for index in range(100):
+            taskstats.record("school.tasks.add", wait=0.01, run=(index + 1) / 1000, result_writes=2, none_result=index < 10)
+        taskstats.record("school.tasks.add", wait=None, run=1, result_writes=0, none_result=False)
+        with taskstats.LOCK:
+            taskstats.incr("school.tasks.add", "failure")
+        taskstats.flush()
+        stats = taskstats.get_stats("school.tasks.add")
+        LOGGER.info("统计: %s", stats)
+        self.assertEqual(taskstats.get_names(), ["school.tasks.add"])
+        self.assertEqual((stats["count"], stats["failure"]), (101, 1))
+        self.assertEqual((stats["result_writes"], stats["none_results"]), (200, 10))
+        self.assertAlmostEqual(stats["wait_avg"], 0.01)
+        self.assertTrue(0.05 <= stats["run"][0.5] <= 0.05 * 1.2)
+        self.assertTrue(0.1 <= stats["run"][0.99] <= 0.1 * 1.2)
+        call_command("celery_stats")
+
+    def test_prune(self):
+        """超过时间限制还没有task_postrun的任务, flush的时候删掉"""
+        taskstats.task_started("running", add)
+        self.assertEqual(taskstats.STARTED["running"][2] - taskstats.STARTED["running"][0], 30 * 60)
+        taskstats.STARTED["killed"] = (time.time() - 3600, None, time.time() - 1)
+        with self.assertLogs("school.taskstats", "WARNING"):
+            taskstats.flush()
+        self.assertEqual(set(taskstats.STARTED), {"running"})
+        taskstats.task_finished("running", add, retval=3, state="SUCCESS")
+        self.assertEqual(taskstats.STARTED, {})
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import gzip
+import logging
+import tempfile
+from pathlib import Path
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.student = Student.objects.create(name="old", code="A001", age=3, info={})
+
+    def test_upsert(self):
+        rows = [
+            {"code": "a001", "name": "new"},
+            {"code": "B001", "name": "b"},
+            {"code": "b001", "name": "b2", "info": {"grade": 1}},
+            {"name": "no code"},
+            {"code": "C001", "name": "c"},
+        ]
+        # 校验不查数据库, 每批固定 CREATE TEMP, COPY, DROP 加上savepoint, 和行数无关
+        # 每种更新字段的组合一条INSERT: 第一批 name 和 name+info, 第二批 name
+        with self.assertNumQueries(13):
+            results = Student.objects.upsert_by_code(rows, batch_size=3)
+        self.assertEqual([result["rows"] for result in results], [3, 2])
+        self.assertEqual(sum(result["created"] for result in results), 2)
+        self.assertEqual(sum(result["updated"] for result in results), 1)
+        self.assertEqual(results[1]["errors"][0][0], 3)
+        self.student.refresh_from_db()
+        self.assertEqual(self.student.name, "new")
+        # 行里没有的字段保留原来的值
+        self.assertEqual(self.student.age, 3)
+        self.assertEqual(Student.objects.get(code__iexact="b001").info, {"grade": 1})
+        self.assertEqual(Student.cached.get(pk=self.student.pk).name, "new")
+        self.assertEqual(Student.objects.codes_exist(["C001"]), {"C001"})
+
+    def test_update_fields(self):
+        results = Student.objects.upsert_by_code(
+                [{"code": "A001", "name": "new", "age": 5}], update_fields=["age"])
+        self.assertEqual(results[0]["updated"], 1)
+        self.student.refresh_from_db()
+        self.assertEqual((self.student.name, self.student.age), ("old", 5))
+        # 值没有变化的不更新
+        results = Student.objects.upsert_by_code(
+                [{"code": "A001", "name": "new", "age": 5}], update_fields=["age"])
+        self.assertEqual(results[0]["unchanged"], 1)
+
+    def test_without_name(self):
+        """只改age的行不用带name, 要新建的行没有name不合法"""
+        # 比有name的批次多一条查询已经存在的code
+        with self.assertNumQueries(7):
+            results = Student.objects.upsert_by_code([{"code": "a001", "age": 4}, {"code": "F001", "age": 1}])
+        self.assertEqual((results[0]["updated"], results[0]["created"], results[0]["rejected"]), (1, 0, 1))
+        self.assertEqual(results[0]["errors"][0][0], 1)
+        self.assertIn("name", results[0]["errors"][0][1])
+        self.student.refresh_from_db()
+        self.assertEqual((self.student.name, self.student.age), ("old", 4))
+        self.assertFalse(Student.objects.filter(code="F001").exists())
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "students.csv.gz"
+            path.write_bytes(gzip.compress(
+                'code,name,height,info\nA001,x,,{}\nD001,d,170,"{""grade"": 2}"\nE001,,,\n'.encode()))
+            call_command("import_students", str(path), batch_size=2)
+        self.assertEqual(Student.objects.get(code="A001").name, "x")
+        student = Student.objects.get(code="D001")
+        self.assertEqual((student.height, student.info), (170, {"grade": 2}))
+        self.assertFalse(Student.objects.filter(code="E001").exists())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from school.models import Student
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.students = [Student.objects.create(name=str(i), info={"grade": i}) for i in range(5)]
+
+    def test_pagination(self):
+        pks = []
+        url = "/api/students/?page_size=2"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, response.content)
+            pks.extend(item["id"] for item in response.json()["results"])
+            url = response.json()["next"]
+        self.assertEqual(pks, [student.pk for student in self.students])
+        # 翻页过程中更新的学生会出现在后面
+        response = self.client.get("/api/students/?page_size=2")
+        student = self.students[0]
+        student.save()
+        response = self.client.get(response.json()["next"] + "&page_size=10")
+        self.assertEqual(
+                [item["id"] for item in response.json()["results"]],
+                [item.pk for item in self.students[2:]] + [student.pk])
+        self.assertEqual(self.client.get("/api/students/?cursor=abc").status_code, 404)
+
+    def test_fields(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/students/?fields=id,name")
+        self.assertEqual(response.json()["results"][0], {"id": self.students[0].pk, "name": "0"})
+        self.assertEqual(self.client.get("/api/students/?fields=id,password").status_code, 400)
+        response = self.client.get(f"/api/students/{self.students[0].pk}/?fields=info")
+        self.assertEqual(response.json(), {"info": {"grade": 0}})
+
+    def test_conditional(self):
+        response = self.client.get("/api/students/?page_size=2")
+        etag = response["ETag"]
+        # 没有变化的时候只查keys
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/students/?page_size=2", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(
+                "/api/students/?page_size=2", HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+        self.assertNotEqual(self.client.get("/api/students/?page_size=2&fields=id")["ETag"], etag)
+        self.students[1].save()
+        response = self.client.get("/api/students/?page_size=2", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        url = f"/api/students/{self.students[0].pk}/"
+        response = self.client.get(url)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+import logging
+
+from django.test import TestCase
+
+from school.consts import REDIS
+from school.models import Student
+from school.writeback import WRITE_MODES, WriteBack
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Test(TestCase):
+
+    def test(self):
+        for mode in WRITE_MODES:
+            Student.objects.all().delete()
+            Student.objects.bulk_create([
+                Student(name=f"学生{i}", info={"note": "a\tb\\c\n"}) for i in range(10)
+            ])
+            before = {student.id: student.update_datetime for student in Student.objects.all()}
+            for pk in before:
+                Student.cached.get(pk=pk)
+            generation = REDIS.get(Student.cached.prefix + "generation")
+            writeback = WriteBack(Student, ["age", "info"], mode=mode)
+            for student in Student.objects.all():
+                student.age += 1
+                student.info["mode"] = mode
+                writeback.add(student)
+            self.assertEqual(writeback.flush(), 10)
+            self.assertEqual(len(writeback), 0)
+            for student in Student.objects.all():
+                LOGGER.info("模式: %s, 学生: %s", mode, student.info)
+                self.assertEqual(student.age, 1)
+                self.assertEqual(student.info, {"note": "a\tb\\c\n", "mode": mode})
+                self.assertGreater(student.update_datetime, before[student.id])
+                # 只删了写回的对象的缓存, 没有作废整个model的缓存
+                self.assertEqual(Student.cached.get(pk=student.pk).age, 1)
+            self.assertEqual(REDIS.get(Student.cached.prefix + "generation"), generation)
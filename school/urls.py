@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+from django.urls import path
+from rest_framework.routers import DefaultRouter
+
+from school import async_views, views
+
+
+router = DefaultRouter()
+router.register("students", views.StudentViewSet)
+
+urlpatterns = [
+    path("async/students/", async_views.student_list),
+    path("async/students/<int:pk>/", async_views.student_detail),
+    path("async/students/<int:pk>/exams/", async_views.student_exams),
+    path("async/exams/<int:pk>/", async_views.exam_detail),
+    *router.urls,
+]
@@ -1,3 +1,124 @@
-from django.shortcuts import render
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
 
-# Create your views here.
+
+import hashlib
+import logging
+from typing import Iterable, List, Optional
+
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework import viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+from school import export
+from school.models import Student
+from school.pagination import Key, KeysetPagination
+from school.serializers import CompiledSerializer, StudentSerializer
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def set_validators(response, etag: str, timestamp: Optional[int]):
+    """200和304都要带上ETag和Last-Modified"""
+    response["ETag"] = etag
+    if timestamp is not None:
+        response["Last-Modified"] = http_date(timestamp)
+    return response
+
+
+def get_etag(*parts: object, keys: Iterable[Key] = ()) -> str:
+    digest = hashlib.md5(usedforsecurity=False)
+    digest.update(repr(parts).encode())
+    for pk, update_datetime in keys:
+        digest.update(f"{pk}:{update_datetime.timestamp()};".encode())
+    return f'"{digest.hexdigest()}"'
+
+
+class StudentViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    ?fields=id,name  只返回部分字段, 只查询这些列
+    列表按 (update_datetime, id) 翻页, 支持 ETag/If-None-Match 和 Last-Modified/If-Modified-Since
+    没有变化的时候返回304, 不加载完整数据也不序列化
+    列表用 CompiledSerializer, 不创建model对象
+    """
+    queryset = Student.objects.all()
+    serializer_class = StudentSerializer
+    pagination_class = KeysetPagination
+
+    def get_fields(self) -> Optional[List[str]]:
+        value = self.request.query_params.get("fields")
+        if not value:
+            return None
+        fields = [field.strip() for field in value.split(",") if field.strip()]
+        unknown = set(fields) - set(StudentSerializer.Meta.fields)
+        if unknown:
+            raise ValidationError({"fields": f"不支持的字段: {', '.join(sorted(unknown))}"})
+        return fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault("fields", self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        only = self.get_serializer().get_only_fields()
+        # 条件请求要用 update_datetime
+        return super().get_queryset().only("id", "update_datetime", *only)
+
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        queryset = self.filter_queryset(self.get_queryset())
+        paginator: KeysetPagination = self.paginator
+        keys = paginator.get_keys(queryset, request)
+        etag = get_etag(self.get_fields(), paginator.next_key, keys=keys)
+        last_modified = max((update_datetime for _, update_datetime in keys), default=None)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is not None:
+            return set_validators(response, etag, timestamp)
+        compiled = CompiledSerializer(
+                self.get_serializer_class(), fields=self.get_fields(), context=self.get_serializer_context())
+        data = compiled.serialize(
+                queryset.filter(pk__in=[pk for pk, _ in keys]).order_by("update_datetime", "id"))
+        return set_validators(paginator.get_paginated_response(data), etag, timestamp)
+
+    def retrieve(self, request: Request, *args, **kwargs) -> Response:
+        instance = self.get_object()
+        etag = get_etag(self.get_fields(), keys=[(instance.pk, instance.update_datetime)])
+        timestamp = int(instance.update_datetime.timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = Response(self.get_serializer(instance).data)
+        return set_validators(response, etag, timestamp)
+
+    @action(detail=False)
+    def export(self, request: Request) -> StreamingHttpResponse:
+        """
+        ?type=ndjson|csv&fields=id,name&with_exams=1&gzip=1
+        format参数DRF用来选择renderer了, 所以用type
+        """
+        file_format = request.query_params.get("type", "ndjson")
+        if file_format not in export.FORMATS:
+            raise ValidationError({"type": f"只支持: {', '.join(export.FORMATS)}"})
+        fields = request.query_params.get("fields")
+        with_exams = request.query_params.get("with_exams") == "1"
+        compress = request.query_params.get("gzip") == "1"
+        try:
+            chunks = export.export(
+                    export.get_queryset(with_exams),
+                    file_format=file_format,
+                    fields=fields.split(",") if fields else None,
+                    with_exams=with_exams,
+                    compress=compress)
+        except ValueError as error:
+            raise ValidationError({"fields": str(error)}) from error
+        response = StreamingHttpResponse(chunks, content_type=export.CONTENT_TYPES[file_format])
+        response["Content-Disposition"] = f'attachment; filename="students.{file_format}"'
+        if compress:
+            response["Content-Encoding"] = "gzip"
+        return response
@@ -9,5 +9,9 @@ CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
         "LOCATION": f"{CONFIG['REDIS_LOCATION']}",
+        "OPTIONS": {
+            # 统计每个请求的redis调用, 见 school/requeststats.py
+            "REDIS_CLIENT_CLASS": "school.requeststats.InstrumentedRedis",
+        },
     },
 }
@@ -5,7 +5,9 @@
 
 import os
 
-from celery import Celery
+from celery import Celery, signals
+
+from . import log_handlers, log_sampling
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'schoolproject.settings')
 
@@ -17,3 +19,8 @@ app.conf.result_backend = "redis://localhost:6379/"
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 app.autodiscover_tasks()
+
+# prefork的子进程用 os._exit 退出, 不会执行atexit和 logging.shutdown
+# 先写出省略的日志条数, 再把日志队列写完
+signals.worker_process_shutdown.connect(log_sampling.flush_all, dispatch_uid="schoolproject.log_sampling")
+signals.worker_process_shutdown.connect(log_handlers.flush_all, dispatch_uid="schoolproject.log_handlers")
@@ -3,6 +3,9 @@
 # Xiang Wang <ramwin@qq.com>
 
 
+from .settings import CONFIG
+
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -13,3 +16,8 @@ DATABASES = {
         "NAME": "schoolproject_02",
     },
 }
+
+# 学生按主键分片, 见 school/sharding.py
+SHARDS = ["default", "db_02"]
+if CONFIG.get("SHARDING", "false") in ["true", "1", "yes"]:
+    DATABASE_ROUTERS = ["school.sharding.ShardRouter"]
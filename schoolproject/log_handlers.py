@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+日志相关的handler
+
+SafeRotatingFileHandler, SafeTimedRotatingFileHandler:
+    gunicorn和进程池的多个进程写同一个文件, 轮转的时候用文件锁保证只有一个进程轮转
+    目录不存在的话打开文件的时候创建
+    拿到锁以后发现已经被别的进程轮转过了, 只重新打开文件
+    标准库的 TimedRotatingFileHandler 会删掉别的进程刚轮转出来的文件
+
+QueueHandler: 非阻塞的日志, 业务线程只把record放进队列, 每个进程一个后台线程负责格式化和写文件
+    .env 里 LOG_QUEUE=true 开启, 见 logging_settings.py
+    后台线程每次最多取 batch_size 条, 同一个handler写完一批才flush一次
+    队列满了的策略 policy:
+        block: 等待, 不丢日志, 但是和同步写一样会拖慢业务
+        drop: 丢弃, 之后写一条WARNING说明丢了多少
+        drop_low: WARNING以下的丢弃, WARNING及以上的等待
+    fork之后子进程第一次写日志时重新创建队列和线程(gunicorn, celery prefork, multiprocessing.Pool)
+    进程退出时 logging.shutdown 会调用 close 写完剩下的日志
+        celery prefork的子进程用 os._exit 退出, 需要在 worker_process_shutdown 里调用 flush_all
+"""
+
+
+import fcntl
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import threading
+import time
+import traceback
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+LOGGER = logging.getLogger(__name__)
+QUEUE_SIZE = 10000
+BATCH_SIZE = 500
+POLICIES = ["block", "drop", "drop_low"]
+HANDLERS: "weakref.WeakSet[QueueHandler]" = weakref.WeakSet()
+ROTATING_HANDLERS = (logging.handlers.RotatingFileHandler, logging.handlers.TimedRotatingFileHandler)
+
+
+class LockedRolloverMixin:
+
+    baseFilename: str
+
+    def makedirs(self) -> None:
+        """delay的handler第一次写日志的时候才创建目录, import settings的时候不创建"""
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+
+    def _open(self):
+        self.makedirs()
+        return super()._open()  # type: ignore[misc]
+
+    def doRollover(self) -> None:
+        self.makedirs()
+        with open(self.baseFilename + ".lock", "a", encoding="utf-8") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.is_rotated():
+                self.reopen()
+            else:
+                super().doRollover()  # type: ignore[misc]
+
+    def is_rotated(self) -> bool:
+        raise NotImplementedError
+
+    def reopen(self) -> None:
+        raise NotImplementedError
+
+
+class SafeRotatingFileHandler(LockedRolloverMixin, logging.handlers.RotatingFileHandler):
+
+    def is_rotated(self) -> bool:
+        """文件已经不是自己打开的那个了"""
+        if self.stream is None or not os.path.exists(self.baseFilename):
+            return False
+        return os.fstat(self.stream.fileno()).st_ino != os.stat(self.baseFilename).st_ino
+
+    def reopen(self) -> None:
+        if self.stream:
+            self.stream.close()
+        self.stream = self._open()
+
+
+class SafeTimedRotatingFileHandler(LockedRolloverMixin, logging.handlers.TimedRotatingFileHandler):
+
+    def get_rotated_filename(self) -> str:
+        """这个周期轮转出来的文件名, 和 doRollover 里的算法一样, 不考虑夏令时"""
+        start = self.rolloverAt - self.interval
+        time_tuple = time.gmtime(start) if self.utc else time.localtime(start)
+        return self.rotation_filename(self.baseFilename + "." + time.strftime(self.suffix, time_tuple))
+
+    def is_rotated(self) -> bool:
+        return os.path.exists(self.get_rotated_filename())
+
+    def reopen(self) -> None:
+        if self.stream:
+            self.stream.close()
+            self.stream = None  # type: ignore[assignment]
+        if not self.delay:
+            self.stream = self._open()
+        now = int(time.time())
+        rollover_at = self.computeRollover(now)
+        while rollover_at <= now:
+            rollover_at += self.interval
+        self.rolloverAt = rollover_at
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    # None 表示后台线程退出
+    queue: "queue.Queue[Optional[logging.LogRecord]]"
+
+    def __init__(
+            self, handlers: Iterable[logging.Handler], maxsize: int = QUEUE_SIZE,
+            policy: str = "drop_low", batch_size: int = BATCH_SIZE):
+        if policy not in POLICIES:
+            raise ValueError(f"不支持的策略: {policy}, 只能是 {POLICIES}")
+        super().__init__(queue.Queue(maxsize))
+        self.targets = list(handlers)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.pid: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        # 比所有handler的级别都低的record不用进队列
+        self.setLevel(min((handler.level for handler in self.targets), default=logging.NOTSET))
+        HANDLERS.add(self)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """同一个进程里不需要pickle, 格式化留给后台线程"""
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # handle()里拿着self.lock, 不会有两个线程同时进来
+        self.start()
+        if self.policy == "block" or (self.policy == "drop_low" and record.levelno >= logging.WARNING):
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self) -> None:
+        if self.pid == os.getpid():
+            return
+        # fork出来的子进程: 父进程的队列里是父进程的日志, 线程也没有复制过来
+        self.queue = queue.Queue(self.maxsize)
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, name="log-queue", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch: List[logging.LogRecord] = []
+            record = self.queue.get()
+            count = 1
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                    count += 1
+                except queue.Empty:
+                    break
+            stopping = record is None
+            dropped, self.dropped = self.dropped, 0
+            if dropped:
+                batch.append(LOGGER.makeRecord(
+                        LOGGER.name, logging.WARNING, __file__, 0,
+                        "日志队列满了, 丢弃了 %d 条日志", (dropped,), None))
+            try:
+                self.write(batch)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # 线程退出的话 flush 会一直等下去
+                if logging.raiseExceptions:
+                    traceback.print_exc()
+            finally:
+                for _ in range(count):
+                    self.queue.task_done()
+
+    def write(self, batch: List[logging.LogRecord]) -> None:
+        for handler in self.targets:
+            if not isinstance(handler, logging.StreamHandler):
+                for record in batch:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+                continue
+            handler.acquire()
+            try:
+                for record in batch:
+                    if record.levelno < handler.level or not handler.filter(record):
+                        continue
+                    try:
+                        # emit 每条都会flush, 这里只写入, 一批写完再flush
+                        if isinstance(handler, ROTATING_HANDLERS) and handler.shouldRollover(record):
+                            handler.doRollover()
+                        if handler.stream is None:
+                            # delay=True 或者刚轮转完, emit会打开文件
+                            handler.emit(record)
+                            continue
+                        handler.stream.write(handler.format(record) + handler.terminator)
+                    except Exception:  # pylint: disable=broad-exception-caught
+                        handler.handleError(record)
+                try:
+                    handler.flush()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    handler.handleError(batch[-1])
+            finally:
+                handler.release()
+
+    def flush(self) -> None:
+        """等后台线程写完队列里已有的日志"""
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def close(self) -> None:
+        if self.pid == os.getpid() and self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+        self.pid = None
+        self.thread = None
+        super().close()
+
+
+def flush_all(**kwargs) -> None:
+    for handler in list(HANDLERS):
+        handler.flush()
+
+
+def install(names: Iterable[str], **options) -> List[QueueHandler]:
+    """
+    把这些logger的handler换成一个QueueHandler, handler完全相同的logger共用一个队列
+    所有handler共用的filter(比如抽样)也加到QueueHandler上, 抽掉的日志不用进队列
+    """
+    queues: Dict[Tuple[logging.Handler, ...], QueueHandler] = {}
+    for name in names:
+        logger = logging.getLogger(name)
+        targets = tuple(handler for handler in logger.handlers if not isinstance(handler, QueueHandler))
+        if not targets:
+            continue
+        if targets not in queues:
+            queues[targets] = QueueHandler(targets, **options)
+            for log_filter in targets[0].filters:
+                if all(log_filter in handler.filters for handler in targets[1:]):
+                    queues[targets].addFilter(log_filter)
+        for handler in targets:
+            logger.removeHandler(handler)
+        logger.addHandler(queues[targets])
+    return list(queues.values())
+
+
+def configure(config: Dict[str, Any]) -> None:
+    """
+    LOGGING_CONFIG, 先和django默认的一样 dictConfig
+    再按 config["queue"] 的参数把所有logger的handler换成 QueueHandler
+    """
+    options = dict(config.get("queue") or {})
+    logging.config.dictConfig({key: value for key, value in config.items() if key != "queue"})
+    names = list(config.get("loggers", {}))
+    if "root" in config:
+        names.append("")
+    install(names, **options)
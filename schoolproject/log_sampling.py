@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""
+热点循环里的日志: 按调用位置限流和抽样, 加上JSON格式方便汇总
+
+SamplingFilter: 放在handler的filters里, 每个调用位置(logger, 文件, 行号)单独计数
+    rules 的key是 "logger名:函数名" 或者 logger名(包括子logger), 优先匹配函数名, 再匹配最长的logger名
+        rate: 每 interval 秒前 rate 条都写
+        sample: 超过rate以后按这个概率写, 0就是都不写
+        level: 这个级别及以上的都写, 默认WARNING
+    被省略的日志会计数, 同一个位置下一条写出去的日志带上 suppressed=省略的条数, 消息后面也会加上
+        进程退出时(或者调用flush_all)还没带出去的数量单独写一条, 带上 summary=True
+        所以 不是summary的条数 + suppressed 的总和 就是实际调用的次数
+    一条record第一次经过filter时决定写不写, 存在record上, 所有handler结果一样
+
+JsonFormatter: 每行一个json
+    event 是没有格式化的消息模板, 同一个位置的日志event一样, 可以直接group by
+    args 是参数, extra 传进来的字段原样输出
+"""
+
+
+import atexit
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional, Tuple, Union
+
+
+LOGGER = logging.getLogger(__name__)
+INTERVAL = 60
+# LogRecord 自带的属性, 其他的都是 extra 传进来的
+RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {
+    "message", "asctime", "sampled", "suppressed", "template", "summary",
+}
+FILTERS: "weakref.WeakSet[SamplingFilter]" = weakref.WeakSet()
+Site = Tuple[str, str, int]
+
+
+class Rule:
+
+    def __init__(self, rate: int = 10, sample: float = 0, level: Union[int, str] = logging.WARNING):
+        self.rate = rate
+        self.sample = sample
+        self.level: int = level if isinstance(level, int) else logging.getLevelName(level)
+
+
+class SiteState:
+
+    def __init__(self):
+        self.window = 0
+        self.passed = 0
+        self.suppressed = 0
+        self.template = ""
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rules: Optional[Dict[str, Dict[str, Any]]] = None, interval: float = INTERVAL):
+        super().__init__()
+        self.rules = {key: Rule(**options) for key, options in (rules or {}).items()}
+        self.interval = interval
+        self.sites: Dict[Site, SiteState] = {}
+        self.lock = threading.Lock()
+        FILTERS.add(self)
+        atexit.register(self.flush)
+
+    def get_rule(self, record: logging.LogRecord) -> Optional[Rule]:
+        rule = self.rules.get(f"{record.name}:{record.funcName}")
+        if rule is not None:
+            return rule
+        name = record.name
+        while name:
+            if name in self.rules:
+                return self.rules[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sampled = getattr(record, "sampled", None)
+        if sampled is not None:
+            return sampled
+        rule = self.get_rule(record)
+        if rule is None or record.levelno >= rule.level:
+            record.sampled = True
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        window = int(time.time() // self.interval)
+        with self.lock:
+            state = self.sites.get(site)
+            if state is None:
+                state = self.sites[site] = SiteState()
+            if state.window != window:
+                state.window = window
+                state.passed = 0
+            if state.passed < rule.rate or random.random() < rule.sample:
+                state.passed += 1
+                suppressed, state.suppressed = state.suppressed, 0
+                record.sampled = True
+            else:
+                state.suppressed += 1
+                state.template = str(record.msg)
+                record.sampled = False
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+            record.template = record.msg
+            record.msg = f"{record.msg} (之前省略了 {suppressed} 条相同的日志)"
+        return True
+
+    def flush(self) -> None:
+        """还没有带出去的省略数量, 每个位置写一条"""
+        with self.lock:
+            pending = [
+                (site, state.suppressed, state.template)
+                for site, state in self.sites.items() if state.suppressed
+            ]
+            for site, _, _ in pending:
+                self.sites[site].suppressed = 0
+        for (name, pathname, lineno), suppressed, template in pending:
+            logger = logging.getLogger(name)
+            record = logger.makeRecord(
+                    name, logging.INFO, pathname, lineno,
+                    "省略了 %d 条相同的日志: %s", (suppressed, template), None)
+            record.sampled = True
+            record.suppressed = suppressed
+            record.template = template
+            record.summary = True
+            logger.handle(record)
+
+
+def flush_all(**kwargs) -> None:
+    for sampling_filter in list(FILTERS):
+        sampling_filter.flush()
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        data: Dict[str, Any] = {
+            "time": datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "line": record.lineno,
+            "process": record.process,
+            "event": str(getattr(record, "template", record.msg)),
+            "message": record.getMessage(),
+        }
+        if isinstance(record.args, (tuple, dict)) and record.args:
+            data["args"] = record.args
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            data["suppressed"] = suppressed
+        if getattr(record, "summary", False):
+            data["summary"] = True
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc"] = record.exc_text
+        if record.stack_info:
+            data["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
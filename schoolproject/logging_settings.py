@@ -7,10 +7,12 @@ import os
 import sys
 from pathlib import Path
 
+from .settings import CONFIG
+
 
 BASE_DIR = Path(__file__).resolve().parent.parent
+# 目录在handler第一次打开文件的时候创建, 见 schoolproject/log_handlers.py
 LOG_DIR = BASE_DIR / 'log'
-LOG_DIR.mkdir(exist_ok=True)
 
 DEFAULT_HANDLERS = [
         'debug_file',
@@ -19,38 +21,43 @@ DEFAULT_HANDLERS = [
         'error_file',
         "console",
 ]
+# delay: 第一次写日志的时候才打开文件, 启动的时候不用打开所有日志文件
 handlers = {
     'error_file': {
         'level': "ERROR",
-        'class': 'logging.handlers.TimedRotatingFileHandler',
+        'class': 'schoolproject.log_handlers.SafeTimedRotatingFileHandler',
         'filename': LOG_DIR / 'error.log',
         'backupCount': 100,
         'when': 'D',
         'formatter': 'verbose',
+        'delay': True,
     },
     'warning_file': {
         'level': "WARNING",
-        'class': 'logging.handlers.RotatingFileHandler',
+        'class': 'schoolproject.log_handlers.SafeRotatingFileHandler',
         'filename': LOG_DIR / 'warning.log',
         'maxBytes': 1024 * 1024 * 10,
         'backupCount': 20,
         'formatter': 'verbose',
+        'delay': True,
     },
     'info_file': {
         'level': "INFO",
-        'class': 'logging.handlers.TimedRotatingFileHandler',
+        'class': 'schoolproject.log_handlers.SafeTimedRotatingFileHandler',
         'when': 'H',
         'backupCount': 100,
         'filename': LOG_DIR / 'info.log',
         'formatter': 'verbose',
+        'delay': True,
     },
     'debug_file': {
         'level': "DEBUG",
-        'class': 'logging.handlers.TimedRotatingFileHandler',
+        'class': 'schoolproject.log_handlers.SafeTimedRotatingFileHandler',
         'when': 'm',
         'backupCount': 100,
         'filename': LOG_DIR / 'debug.log',
         'formatter': 'verbose',
+        'delay': True,
     },
     'console': {
         'class': 'colorlog.StreamHandler',
@@ -59,6 +66,25 @@ handlers = {
         'stream': sys.stdout,
     },
 }
+# 热点循环里每个范围/每次signal一条的日志, 每个调用位置每分钟前10条都写, 之后千分之一, 省略的条数会带在后面的日志上
+SAMPLING_RULES = {
+    "school.commands:handle_single_task": {"rate": 10, "sample": 0.001},
+    "school.scripts.student_grows": {"rate": 10, "sample": 0.001},
+    "school.models.relations": {"rate": 10, "sample": 0.001},
+    # 同一个视图的N+1每次请求都会报, 每分钟写10条, 省略的条数带在后面
+    "school.requeststats": {"rate": 10, "sample": 0, "level": "ERROR"},
+}
+if CONFIG.get("LOG_JSON", "false") in ["true", "1", "yes"]:
+    DEFAULT_HANDLERS.append("json_file")
+    handlers["json_file"] = {
+        'level': "INFO",
+        'class': 'schoolproject.log_handlers.SafeTimedRotatingFileHandler',
+        'when': 'h',
+        'backupCount': 100,
+        'filename': LOG_DIR / 'json.log',
+        'formatter': 'json',
+        'delay': True,
+    }
 loggers = {
     'default': {
         'handlers': DEFAULT_HANDLERS,
@@ -98,19 +124,40 @@ LOGGING = {
         'simple': {
             'format': '[%(levelname)s] %(module)s:%(lineno)d %(message)s ',
         },
+        'json': {
+            '()': 'schoolproject.log_sampling.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'schoolproject.log_sampling.SamplingFilter',
+            'rules': SAMPLING_RULES,
+        },
     },
     'handlers': handlers,
     'loggers': loggers,
 }
 
 if sys.argv[0] == 'manage.py':
-    (LOG_DIR / sys.argv[1]).mkdir(exist_ok=True, parents=True)
     DEFAULT_HANDLERS.append("command_file")
     handlers["command_file"] = {
         'level': "INFO",
-        'class': 'logging.handlers.TimedRotatingFileHandler',
+        'class': 'schoolproject.log_handlers.SafeTimedRotatingFileHandler',
         'when': 'h',
         'backupCount': 100,
         'filename': LOG_DIR / sys.argv[1] / 'info.log',
         'formatter': 'verbose',
+        'delay': True,
+    }
+
+# 所有handler共用一个抽样的filter, 同一条日志在所有文件里要么都写要么都不写
+for handler in handlers.values():
+    handler['filters'] = ['sampling']
+
+# 业务线程只把日志放进队列, 后台线程写文件, 见 schoolproject/log_handlers.py
+if CONFIG.get("LOG_QUEUE", "false") in ["true", "1", "yes"]:
+    LOGGING_CONFIG = "schoolproject.log_handlers.configure"
+    LOGGING["queue"] = {
+        "policy": CONFIG.get("LOG_QUEUE_POLICY", "drop_low"),
+        "maxsize": int(CONFIG.get("LOG_QUEUE_SIZE", 10000)),
     }
@@ -19,7 +19,8 @@ SECRET_KEY = 'django-insecure-t=l0aupwp(*ktptudw*qork@1!e519lb5=2en^%g45x%=-1kms
 
 # SECURITY WARNING: don't run with debug turned on in production!
 
-ALLOWED_HOSTS: List[str] = []
+# 逗号分隔, 默认只允许本机访问, 压测和ASGI/WSGI服务都需要
+ALLOWED_HOSTS: List[str] = CONFIG.get("ALLOWED_HOSTS", "localhost,127.0.0.1").split(",")
 
 DEBUG = CONFIG["DEBUG"] in ["true", "1", "yes"]
 
@@ -59,7 +60,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    "school.requeststats.RequestStatsMiddleware",
 ]
+# 统计多少比例的请求的SQL和redis调用, 0是关闭, 见 school/requeststats.py
+REQUEST_STATS_SAMPLE = float(CONFIG.get("REQUEST_STATS_SAMPLE", 0.01))
+# 同样结构的SQL一个请求里执行几次算N+1
+REQUEST_STATS_REPEAT = 10
+# 抽中的请求返回 Server-Timing 头, 会暴露SQL数量, 默认只在DEBUG的时候打开
+REQUEST_STATS_HEADER = CONFIG.get("REQUEST_STATS_HEADER", CONFIG["DEBUG"]) in ["true", "1", "yes"]
 
 ROOT_URLCONF = 'schoolproject.urls'
 
@@ -117,6 +125,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 DJANGO_COMMANDS_ALLOW_REMOTE_CALL = ["slow_command"]
 
+# 健康检查在后台每隔多少秒执行一次, 结果超过 HEALTH_MAX_AGE 秒没有更新就算不健康, 见 school/health.py
+HEALTH_INTERVAL = int(CONFIG.get("HEALTH_INTERVAL", 10))
+HEALTH_MAX_AGE = int(CONFIG.get("HEALTH_MAX_AGE", 60))
+# 只执行这些插件, None是所有安装的插件, 名字见 manage.py health_check
+HEALTH_CHECKS = None
+
 include(
         "logging_settings.py",
         "cache_settings.py",
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Xiang Wang <ramwin@qq.com>
+
+
+"""测试用的配置, 见 pytest.ini"""
+
+
+from .settings import *  # noqa: F401,F403  # pylint: disable=wildcard-import,unused-wildcard-import
+
+
+# 抽样是随机的, 测试里默认不统计, 需要的测试用 override_settings 打开
+REQUEST_STATS_SAMPLE = 0.0
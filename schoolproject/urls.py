@@ -17,7 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from school import health
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/django-commands/', include("django_commands.urls")),
+    path('api/', include("school.urls")),
+    path('health/', health.ready),
+    path('health/live/', health.live),
 ]